@@ -1,6 +1,5 @@
 # !/usr/bin/env python
 # -*- coding: UTF-8 -*-
-import random
 import gc
 import logging
 import numpy as np
@@ -8,6 +7,7 @@ import torch
 import os
 from PIL import ImageFont,Image
 from diffusers import (StableDiffusionXLPipeline, DiffusionPipeline,EulerDiscreteScheduler, UNet2DConditionModel,UniPCMultistepScheduler, AutoencoderKL,)
+from diffusers.models.attention_processor import AttnProcessor2_0 as GraphAttnProcessor
 from transformers import CLIPVisionModelWithProjection
 from transformers import CLIPImageProcessor
 import datetime
@@ -19,23 +19,27 @@ from comfy.model_management import total_vram
 from .utils.utils import get_comic
 from .utils.load_models_utils import load_models
 from .model_loader_utils import  (story_maker_loader,kolor_loader,phi2narry,
-                                  extract_content_from_brackets,narry_list,remove_punctuation_from_strings,phi_list,center_crop_s,center_crop,
+                                  extract_content_from_brackets,panels_to_tensor,remove_punctuation_from_strings,phi_list,center_crop_s,center_crop,
                                   narry_list_pil,setup_seed,find_directories,
                                   apply_style,get_scheduler,apply_style_positive,SD35Wrapper,
                                   nomarl_upscale,SAMPLER_NAMES,SCHEDULER_NAMES,lora_lightning_list,pre_checkpoint,get_easy_function,sd35_loader)
-from .utils.gradio_utils import cal_attn_indice_xl_effcient_memory,is_torch2_available,process_original_prompt,get_ref_character,character_to_dict
+from .utils.gradio_utils import AttentionPlan,AttnIndiceSchedule,is_torch2_available,process_original_prompt,get_ref_character,character_to_dict,group_read_batches,CONSISTENCY_PROFILES,draft_settings,parse_panel_selection
+from .utils.character_bank import CHARACTER_BANK_SUFFIX,CharacterBankCache,CharacterBankFile,LazySteps,model_fingerprint,save_character_bank_async
+from .utils.chunked_attention import scaled_dot_product_attention
+from .utils.panel_stream import PanelStreamer
+from .utils.prompt_cache import install_prompt_cache,prompt_embed_cache
+from .utils.story_record import StoryRecord
+from .utils.model_registry import model_registry
+from .utils.lora_cache import swap_lora
+from .utils.bank_utils import BankQuantizationStats,PagedIdBank,get_bank_device,pack_entry,unpack_entry,log_bank_report
 from .ip_adapter.attention_processor import IPAttnProcessor2_0
 if is_torch2_available():
     from .utils.gradio_utils import AttnProcessor2_0 as AttnProcessor
 else:
     from .utils.gradio_utils import AttnProcessor
 import torch.nn.functional as F
-import copy
 import math
-global total_count, attn_count, cur_step, mask1024, mask4096, attn_procs, unet
-global sa32, sa64
-global write
-global height_s, width_s
+import contextvars
 
 photomaker_dir=os.path.join(folder_paths.models_dir, "photomaker")
 device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
@@ -49,10 +53,28 @@ fonts_lists = os.listdir(fonts_path)
 base_pt = os.path.join(photomaker_dir,"pt")
 if not os.path.exists(base_pt):
     os.makedirs(base_pt)
+# 自动缓存的角色权重（重复出现的角色跳过参考图生成）
+character_bank_cache = CharacterBankCache(os.path.join(photomaker_dir, "bank_cache"))
     
-def set_attention_processor(unet, id_length, is_ipadapter=False):
-    global attn_procs
+# latent 相对图像的缩放倍数
+VAE_SCALE_FACTOR = 8
+
+
+def layer_downsample(unet, block_id):
+    """Downsample factor (image pixels per token side) of the attention layers in up_blocks.block_id."""
+    return VAE_SCALE_FACTOR * 2 ** (len(unet.config.block_out_channels) - 1 - block_id)
+
+
+def set_attention_processor(unet, id_length, is_ipadapter=False, graph_safe=False):
+    r"""
+    Install the StoryDiffusion processors, SpatialAttnProcessor2_0 on the self-attention of the up blocks.
+    With `graph_safe` the up blocks get GraphSafeSpatialAttnProcessor2_0 sharing one StoryGraphState and
+    the other layers use the diffusers processor (not an nn.Module), so `torch.compile(unet)` traces the
+    read phase without graph breaks.
+    """
     attn_procs = {}
+    graph_state = StoryGraphState() if graph_safe else None
+    layer_index = 0
     for name in unet.attn_processors.keys():
         cross_attention_dim = (
             None
@@ -69,9 +91,25 @@ def set_attention_processor(unet, id_length, is_ipadapter=False):
             hidden_size = unet.config.block_out_channels[block_id]
         if cross_attention_dim is None:
             if name.startswith("up_blocks"):
-                attn_procs[name] = SpatialAttnProcessor2_0(id_length=id_length)
+                if graph_safe:
+                    attn_procs[name] = GraphSafeSpatialAttnProcessor2_0(
+                        id_length=id_length,
+                        name=name,
+                        block_id=block_id,
+                        downsample=layer_downsample(unet, block_id),
+                        graph_state=graph_state,
+                        layer_index=layer_index,
+                    )
+                else:
+                    attn_procs[name] = SpatialAttnProcessor2_0(
+                        id_length=id_length,
+                        name=name,
+                        block_id=block_id,
+                        downsample=layer_downsample(unet, block_id),
+                    )
+                layer_index += 1
             else:
-                attn_procs[name] = AttnProcessor()
+                attn_procs[name] = GraphAttnProcessor() if graph_safe else AttnProcessor()
         else:
             if is_ipadapter:
                 attn_procs[name] = IPAttnProcessor2_0(
@@ -81,81 +119,410 @@ def set_attention_processor(unet, id_length, is_ipadapter=False):
                     num_tokens=4,
                 ).to(unet.device, dtype=torch.float16)
             else:
-                attn_procs[name] = AttnProcessor()
+                attn_procs[name] = GraphAttnProcessor() if graph_safe else AttnProcessor()
 
-    unet.set_attn_processor(copy.deepcopy(attn_procs))
+    if graph_state is not None:
+        graph_state.total_count = layer_index
+    # 每次都是新建的处理器，直接安装，不需要深拷贝
+    unet.set_attn_processor(attn_procs)
+    unet.story_attention_plan = None
+    unet.story_graph_state = graph_state
 
-def load_single_character_weights(unet, filepath):
+
+def build_attention_plan(unet, height, width, sa32, sa64):
+    r"""
+    The AttentionPlan of the installed SpatialAttnProcessor2_0 layers at this resolution. The plan is
+    kept on the unet and only rebuilt when the resolution or the sampled ratios change.
+    """
+    plan = getattr(unet, "story_attention_plan", None)
+    if plan is not None and plan.matches(height, width) and plan.ratios == (sa32, sa64):
+        return plan
+    layers = {
+        name: processor.downsample
+        for name, processor in unet.attn_processors.items()
+        if isinstance(processor, SpatialAttnProcessor2_0)
+    }
+    plan = AttentionPlan(layers, height, width, sa32, sa64)
+    unet.story_attention_plan = plan
+    return plan
+
+def bank_entry_to(entry, device):
+    # id_bank 条目: {"key","value"} 为投影后的参考token，旧格式为 hidden states 列表
+    if isinstance(entry, dict):
+        return {name: tensor.to(device) for name, tensor in entry.items()}
+    return [tensor.to(device) for tensor in entry]
+
+def load_single_character_weights(unet, id_bank, filepath):
     """
-    从指定文件中加载权重到 attention_processor 类的 id_bank 中。
+    从指定文件中加载权重到 id_bank 中。
     参数:
     - model: 包含 attention_processor 类实例的模型。
-    - filepath: 权重文件的路径。
+    - id_bank: 加载目标（{attn_name: {character: {step: entry}}}），之后交给 StoryAttentionContext 使用。
+    - filepath: 权重文件的路径，.safetensors 按步懒加载，旧的 .pt 文件整体读入。
     """
+    if filepath.endswith(CHARACTER_BANK_SUFFIX):
+        bank_file = CharacterBankFile(filepath)
+        model_hash = bank_file.metadata.get("model_hash")
+        if model_hash and model_hash != model_fingerprint(unet):
+            logging.warning(f"{filepath} was saved with another model, the character may not be consistent.")
+        for attn_name, attn_processor in unet.attn_processors.items():
+            if isinstance(attn_processor, SpatialAttnProcessor2_0) and attn_name in bank_file.index:
+                id_bank.setdefault(attn_name, {})[bank_file.character] = bank_file.steps(attn_name)
+        print(f"successsfully,load_single_character_weights {bank_file.character}:{bank_file.metadata}")
+        return
     # 使用torch.load来读取权重
     weights_to_load = torch.load(filepath, map_location=torch.device("cpu"))
-    weights_to_load.eval()
     character = weights_to_load["character"]
     description = weights_to_load["description"]
     #print(character)
     for attn_name, attn_processor in unet.attn_processors.items():
         if isinstance(attn_processor, SpatialAttnProcessor2_0):
             # 转移权重到GPU（如果GPU可用的话）并赋值给id_bank
-            attn_processor.id_bank[character] = {}
+            id_bank.setdefault(attn_name, {})[character] = {}
             for step_key in weights_to_load[attn_name].keys():
 
-                attn_processor.id_bank[character][step_key] = [
-                    tensor.to(unet.device)
-                    for tensor in weights_to_load[attn_name][step_key]
-                ]
+                id_bank[attn_name][character][step_key] = bank_entry_to(
+                    weights_to_load[attn_name][step_key], unet.device
+                )
     print("successsfully,load_single_character_weights")
 
-def load_character_files_on_running(unet, character_files: str):
+def load_character_files_on_running(unet, id_bank, character_files: str):
     if character_files == "":
         return False
     weights_list = os.listdir(character_files)#获取路径下的权重列表
     #character_files_arr = character_files.splitlines()
     for character_file in weights_list:
+        if not character_file.endswith((".pt", CHARACTER_BANK_SUFFIX)):
+            continue
         path_cur=os.path.join(character_files,character_file)
-        load_single_character_weights(unet, path_cur)
+        load_single_character_weights(unet, id_bank, path_cur)
     return True
-def save_single_character_weights(unet, character, description, filepath):
+def save_single_character_weights(unet, id_bank, character, description, filepath, metadata=None):
     """
-    保存 attention_processor 类中的 id_bank GPU Tensor 列表到指定文件中。
+    保存 id_bank 中一个角色的权重到 safetensors 文件（后台线程写入）。
     参数:
     - model: 包含 attention_processor 类实例的模型。
+    - id_bank: 本次生成的 StoryAttentionContext.id_bank。
     - filepath: 权重要保存到的文件路径。
+    - metadata: 分辨率、sa32/sa64、id_length 等生成参数。
     """
-    weights_to_save = {}
-    weights_to_save["description"] = description
-    weights_to_save["character"] = character
-    for attn_name, attn_processor in unet.attn_processors.items():
-        if isinstance(attn_processor, SpatialAttnProcessor2_0):
-            # 将每个 Tensor 转到 CPU 并转为列表，以确保它可以被序列化
-            #print(attn_name, attn_processor)
-            weights_to_save[attn_name] = {}
-            for step_key in attn_processor.id_bank[character].keys():
-                weights_to_save[attn_name][step_key] = [
-                    tensor.cpu()
-                    for tensor in attn_processor.id_bank[character][step_key]
-                ]
-    # 使用torch.save保存权重
-    torch.save(weights_to_save, filepath)
+    bank = {
+        attn_name: id_bank[attn_name]
+        for attn_name, attn_processor in unet.attn_processors.items()
+        if isinstance(attn_processor, SpatialAttnProcessor2_0) and attn_name in id_bank
+    }
+    metadata = dict(metadata or {})
+    metadata["description"] = description
+    metadata["model_hash"] = model_fingerprint(unet)
+    return save_character_bank_async(filepath, bank, character, metadata)
     
-def save_results(unet):
+def save_results(unet, story_context):
     timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     weight_folder_name =os.path.join(base_pt,f"{timestamp}")
     #创建文件夹
     if not os.path.exists(weight_folder_name):
         os.makedirs(weight_folder_name)
-    global character_dict
+    character_dict = story_context.character_dict
+    story_context.synchronize()  # 等待分页的 id_bank 拷贝到主机内存
+    metadata = story_context.bank_metadata()
     for char in character_dict:
         description = character_dict[char]
-        save_single_character_weights(unet,char,description,os.path.join(weight_folder_name, f'{char}.pt'))
-        
+        save_single_character_weights(unet, story_context.id_bank, char, description,
+                                      os.path.join(weight_folder_name, f'{char}{CHARACTER_BANK_SUFFIX}'), metadata)
+
+
+_story_context = contextvars.ContextVar("story_attention_context", default=None)
+
+
+class StoryAttentionContext:
+    r"""
+    Per-run state of consistent self-attention (step counters, write/read phase, current
+    characters, sampled token indices and the character id_bank).
+    One context is created by `process_generation` for every story, so several stories can
+    share one resident unet: the context is bound with `with story_context:` around each pipe
+    call and `SpatialAttnProcessor2_0` reads it from a context variable.
+    Args:
+        unet (`UNet2DConditionModel`):
+            The unet whose up-block self-attention uses `SpatialAttnProcessor2_0`.
+        id_length (`int`):
+            The number of reference images per character.
+        sa32 (`float`), sa64 (`float`):
+            The sampling ratio of reference tokens at the 1/32 and 1/16 resolutions.
+        height (`int`), width (`int`):
+            The image size of this run.
+        num_steps (`int`), seed (`int`):
+            Used to build the `AttnIndiceSchedule` of sampled tokens and per-layer on/off decisions.
+        bank_dtype (`str`, defaults to "fp16"):
+            Storage of id_bank entries, "int8" or "fp8" keep per-channel quantized keys/values.
+        attention_budget_mb (`int`, *optional*):
+            Split consistent attention into query (and key) tiles whose attention matrix fits this
+            budget on backends without a memory-efficient SDPA kernel; defaults to 1024 off CUDA.
+        token_selector (`str`, defaults to "uniform"):
+            How reference tokens are chosen in the write phase: "uniform", "grid", "crossref" or "mask".
+        policy (`ConsistencyPolicy`, *optional*):
+            The steps and layers that use consistent self-attention, defaults to all of them.
+        bank_offload (`bool`, defaults to False):
+            Keep the id_bank in (pinned) host memory and only page the current and next step onto
+            the compute device, so the number of characters is not limited by VRAM.
+        id_bank (`dict`, *optional*):
+            Character weights loaded from disk, {attn_name: {character: {step: entry}}}, where an
+            entry holds the projected {"key", "value"} of the sampled reference tokens.
+    """
+
+    def __init__(
+            self,
+            unet,
+            id_length,
+            sa32,
+            sa64,
+            height,
+            width,
+            num_steps=20,
+            seed=0,
+            id_bank=None,
+            character_dict=None,
+            bank_dtype="fp16",
+            bank_offload=False,
+            policy=None,
+            token_selector="uniform",
+            attention_budget_mb=None,
+            device=device,
+            dtype=torch.float16,
+    ):
+        self.id_length = id_length
+        self.total_length = 5 * id_length + 1
+        self.sa32 = sa32
+        self.sa64 = sa64
+        self.height = height
+        self.width = width
+        self.plan = build_attention_plan(unet, height, width, sa32, sa64)
+        self.height_s = self.plan.height_s
+        self.width_s = self.plan.width_s
+        self.device = device
+        self.dtype = dtype
+        # 每个去噪步中 SpatialAttnProcessor2_0 被调用的次数
+        self.total_count = len(self.plan.layers)
+        self.character_dict = character_dict if character_dict is not None else {}
+        self.bank_dtype = bank_dtype
+        self.bank_stats = BankQuantizationStats() if bank_dtype != "fp16" else None
+        self.pager = PagedIdBank(get_bank_device(device)) if bank_offload else None
+        if attention_budget_mb is None and torch.device(device).type != "cuda":
+            attention_budget_mb = 1024
+        self.attention_budget = int(attention_budget_mb * 1024 ** 2) if attention_budget_mb else None
+        self.policy = policy if policy is not None else CONSISTENCY_PROFILES["full"]
+        self.policy_steps = self.policy.steps(max(num_steps, 1))
+        self.policy_layers = {name: self.policy.allows_layer(name) for name in unet.attn_processors}
+        self.id_bank = {}
+        if id_bank:
+            # 每次运行使用自己的字典，加载的权重张量本身是共享的；
+            # 懒加载的角色权重读出后留在计算设备上(分页时由 pager 拷贝，保持在主机内存)
+            steps_device = None if self.pager is not None else device
+            for attn_name, characters in id_bank.items():
+                self.id_bank[attn_name] = {
+                    char: steps.copy(device=steps_device) if isinstance(steps, LazySteps) else steps.copy()
+                    for char, steps in characters.items()
+                }
+        self.write = False
+        self.cur_character = []
+        self.cur_step = 0
+        self.attn_count = 0
+        self.schedule = AttnIndiceSchedule(
+            num_steps,
+            self.total_count,
+            self.total_length,
+            self.plan,
+            seed=seed,
+            device=device,
+            selector=token_selector,
+        )
+        self.token_selector = self.schedule.selector.name
+        self.unet = unet
+        self.graph_state = getattr(unet, "story_graph_state", None)
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_story_context.set(self))
+        if self.graph_state is not None:
+            # 编译的 UNet 同一时间只运行一个故事，读取阶段走图安全的路径
+            self.graph_state.active = not self.write
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.graph_state is not None:
+            self.graph_state.active = False
+        _story_context.reset(self._tokens.pop())
+
+    def start(self, cur_character, write):
+        """Prepare the context for the next pipe call."""
+        self.cur_character = cur_character
+        self.write = write
+        self.cur_step = 0
+        self.attn_count = 0
+        if self.pager is not None:
+            self.pager.reset()
+            if not write:
+                self.pager.advance(self.id_bank, cur_character, 0)
+        if self.graph_state is not None and not write:
+            self.load_graph_state()
+
+    def bank(self, attn_name):
+        return self.id_bank.setdefault(attn_name, {})
+
+    def pack_entry(self, entry):
+        packed = pack_entry(entry, self.bank_dtype)
+        if self.bank_stats is not None:
+            self.bank_stats.update(entry, packed)
+        return self.offload(packed)
+
+    def offload(self, entry):
+        return self.pager.offload(entry) if self.pager is not None else entry
+
+    def fetch(self, attn_name, character, step):
+        """The id_bank entry of a character at this step, paged onto the compute device if offloaded."""
+        if self.pager is not None:
+            return self.pager.get(self.id_bank, attn_name, character, step)
+        return self.id_bank[attn_name][character][step]
+
+    def synchronize(self):
+        if self.pager is not None:
+            self.pager.synchronize()
+
+    def bank_metadata(self):
+        """Generation parameters stored with saved or cached character weights."""
+        return {
+            "height": self.height,
+            "width": self.width,
+            "sa32": self.sa32,
+            "sa64": self.sa64,
+            "id_length": self.id_length,
+            "bank_dtype": self.bank_dtype,
+            "consistency": self.policy.describe(),
+            "token_selector": self.token_selector,
+        }
+
+    def bank_report(self):
+        """Log the id_bank memory (and the quantization error against fp16 storage)."""
+        return log_bank_report(self.id_bank, self.bank_dtype, self.bank_stats)
+
+    def get_indices(self, downsample, hidden_states=None):
+        return self.schedule.get_indices(self.cur_step, downsample, hidden_states)
+
+    def in_policy(self, attn_name):
+        """Whether this layer at the current step is inside the consistency policy at all."""
+        return self.policy_steps[self.cur_step % len(self.policy_steps)] and self.policy_layers.get(attn_name, True)
+
+    def is_consistent(self, attn_name):
+        if not self.write:
+            # 读取的角色权重可能来自更窄的策略，缺少的步按普通注意力处理
+            bank = self.bank(attn_name)
+            if not all(character in bank and self.cur_step in bank[character] for character in self.cur_character):
+                return False
+        return self.schedule.is_consistent(self.cur_step, self.attn_count)
+
+    def load_graph_state(self):
+        r"""
+        Fill the StoryGraphState for a read-phase pipe call: the step tensor, the consistency decisions
+        of every (step, layer) with the policy and missing bank steps folded in, and the current
+        characters' id_bank stacked per layer as (num_steps, 2, tokens, channel) on the compute device.
+        """
+        num_steps = self.schedule.num_steps
+        consistent = torch.tensor(self.schedule.consistent, dtype=torch.bool)
+        consistent &= torch.tensor(self.policy_steps[:num_steps] + [True] * (num_steps - len(self.policy_steps)))[:, None]
+        keys, values = {}, {}
+        for layer_index, attn_name in enumerate(self.plan.layers):
+            if not self.policy_layers.get(attn_name, True):
+                consistent[:, layer_index] = False
+                continue
+            processor = self.unet.attn_processors[attn_name]
+            attn = self.unet.get_submodule(attn_name[:-len(".processor")])
+            bank = self.bank(attn_name)
+            layer_keys, layer_values = [None] * num_steps, [None] * num_steps
+            for step in range(num_steps):
+                if not all(character in bank and step in bank[character] for character in self.cur_character):
+                    consistent[step, layer_index] = False
+                    continue
+                entries = [processor.get_bank_kv(attn, self, character, step, self.dtype) for character in self.cur_character]
+                layer_keys[step] = torch.cat([entry["key"] for entry in entries], dim=1)
+                layer_values[step] = torch.cat([entry["value"] for entry in entries], dim=1)
+            present = [step for step in range(num_steps) if layer_keys[step] is not None]
+            if not present:
+                continue
+            # 缺少的步用 0 占位，对应的 consistent 为 False，注意力中会被屏蔽
+            for step in range(num_steps):
+                if layer_keys[step] is None:
+                    layer_keys[step] = torch.zeros_like(layer_keys[present[0]])
+                    layer_values[step] = torch.zeros_like(layer_values[present[0]])
+            keys[attn_name] = torch.stack(layer_keys)
+            values[attn_name] = torch.stack(layer_values)
+        self.synchronize()
+        self.graph_state.load(
+            torch.zeros((), dtype=torch.long, device=self.device),
+            consistent.to(self.device),
+            keys,
+            values,
+        )
+
+    def step_end(self):
+        self.attn_count += 1
+        if self.attn_count == self.total_count:
+            self.attn_count = 0
+            self.cur_step += 1
+            if self.pager is not None and not self.write:
+                # 预取下一步的角色条目，释放用完的步
+                self.pager.advance(self.id_bank, self.cur_character, self.cur_step)
+
+
+class StoryGraphState:
+    r"""
+    Read-phase run state of the GraphSafeSpatialAttnProcessor2_0 layers of one UNet, kept in tensors so a
+    compiled UNet sees the same graph every step: the step is a device tensor advanced inside the graph,
+    the per-(step, layer) consistency decisions and the current characters' id_bank are preloaded tensors
+    indexed by it. Filled by the active StoryAttentionContext before every read-phase pipe call.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.total_count = 0
+        self.step = None
+        self.consistent = None
+        self.keys = {}
+        self.values = {}
+
+    def load(self, step, consistent, keys, values):
+        self.step = step
+        self.consistent = consistent
+        self.keys = keys
+        self.values = values
+
+
+class StoryContextPipe:
+    """Binds a StoryAttentionContext around every call of the wrapped pipeline."""
+
+    def __init__(self, pipe, story_context):
+        self.pipe = pipe
+        self.story_context = story_context
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def __call__(self, *args, **kwargs):
+        with self.story_context:
+            unet = getattr(self.pipe, "unet", None)
+            if not self.story_context.write or not hasattr(unet, "_orig_mod"):
+                return self.pipe(*args, **kwargs)
+            # 编译只覆盖读取阶段，写入阶段(每个角色一次)直接用未编译的 UNet，避免 dynamo 追踪读取 ContextVar 的 eager 路径
+            self.pipe.unet = unet._orig_mod
+            try:
+                return self.pipe(*args, **kwargs)
+            finally:
+                self.pipe.unet = unet
+
+
 class SpatialAttnProcessor2_0(torch.nn.Module):
     r"""
     Attention processor for IP-Adapater for PyTorch 2.0.
+    The run state (step, phase, characters, id_bank) lives in the active `StoryAttentionContext`;
+    without one the processor behaves like plain self-attention.
     Args:
         hidden_size (`int`):
             The hidden size of the attention layer.
@@ -165,6 +532,13 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
             The context length of the text features.
         scale (`float`, defaults to 1.0):
             the weight scale of image prompt.
+        name (`str`):
+            The attention layer name in `unet.attn_processors`, used as the id_bank key.
+        block_id (`int`):
+            The index of the up block the layer belongs to.
+        downsample (`int`, defaults to 32):
+            Image pixels per token side of this layer, selects the index buffer shared by the layers
+            of the same resolution in the run's AttentionPlan.
     """
 
     def __init__(
@@ -174,6 +548,9 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
             id_length=4,
             device=device,
             dtype=torch.float16,
+            name=None,
+            block_id=None,
+            downsample=32,
     ):
         super().__init__()
         if not hasattr(F, "scaled_dot_product_attention"):
@@ -186,7 +563,22 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
         self.cross_attention_dim = cross_attention_dim
         self.total_length = 5*id_length + 1
         self.id_length = id_length
-        self.id_bank = {}
+        self.name = name
+        self.block_id = block_id
+        self.downsample = downsample
+
+    @staticmethod
+    def attention_budget():
+        """Memory budget (bytes) of one attention matrix of this run, None for plain SDPA."""
+        story_context = _story_context.get()
+        return story_context.attention_budget if story_context is not None else None
+
+    @property
+    def id_bank(self):
+        story_context = _story_context.get()
+        if story_context is None:
+            return {}
+        return story_context.bank(self.name)
 
     def __call__(
             self,
@@ -198,149 +590,174 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
     ):
         # un_cond_hidden_states, cond_hidden_states = hidden_states.chunk(2)
         # un_cond_hidden_states = self.__call2__(attn, un_cond_hidden_states,encoder_hidden_states,attention_mask,temb)
-        # 生成一个0到1之间的随机数
-        global total_count, attn_count, cur_step, indices1024, indices4096
-        global sa32, sa64
-        global write
-        global height_s, width_s
-        global character_dict
-        global  character_index_dict, invert_character_index_dict, cur_character, ref_indexs_dict, ref_totals, cur_character
-        if attn_count == 0 and cur_step == 0:
-            indices1024, indices4096 = cal_attn_indice_xl_effcient_memory(
-                self.total_length,
-                self.id_length,
-                sa32,
-                sa64,
-                height_s,
-                width_s,
-                device=self.device,
-                dtype=self.dtype,
-            )
-        if write:
-            assert len(cur_character) == 1
+        ctx = _story_context.get()
+        if ctx is None:
+            # 不在故事生成中，按普通自注意力处理
+            return self.__call2__(attn, hidden_states, None, attention_mask, temb)
+        if not ctx.in_policy(self.name):
+            # 不在一致性策略的步/层内，直接按普通自注意力处理，也不写入 id_bank
+            hidden_states = self.__call2__(attn, hidden_states, None, attention_mask, temb)
+            ctx.step_end()
+            return hidden_states
+        id_bank = ctx.bank(self.name)
+        cur_step = ctx.cur_step
+        if ctx.write:
+            assert len(ctx.cur_character) == 1
             #print("!!!!!!before attention", hidden_states.shape)
-            if hidden_states.shape[1] == (height_s // 32) * (width_s // 32):
-                indices = indices1024
-            else:
-                indices = indices4096
             #print("before attention", hidden_states.shape)
             # print(f"white:{cur_step}")
             total_batch_size, nums_token, channel = hidden_states.shape
             img_nums = total_batch_size // 2
             hidden_states = hidden_states.reshape(-1, img_nums, nums_token, channel)
+            # 动态选择器根据条件分支的参考图 hidden states 选择 token，本层写入和注意力共用
+            indices = ctx.get_indices(self.downsample, hidden_states[-1])
             #print('!!!!!!!!!', img_nums,len(indices),hidden_states.shape,self.total_length)
-            if cur_character[0] not in self.id_bank:
-                self.id_bank[cur_character[0]] = {}
-            self.id_bank[cur_character[0]][cur_step] = [
-                hidden_states[:, img_ind, indices[img_ind], :]
-                .reshape(2, -1, channel)
-                .clone()
-                for img_ind in range(img_nums)
-            ]
+            if ctx.cur_character[0] not in id_bank:
+                id_bank[ctx.cur_character[0]] = {}
+            # 只在写入时投影一次参考token，读取阶段的每个场景直接复用 key/value
+            sampled = torch.cat(
+                [hidden_states[:, img_ind, indices[img_ind], :] for img_ind in range(img_nums)], dim=1
+            )
+            id_bank[ctx.cur_character[0]][cur_step] = ctx.pack_entry({
+                "key": attn.to_k(sampled),
+                "value": attn.to_v(sampled),
+            })
             hidden_states = hidden_states.reshape(-1, nums_token, channel)
             # self.id_bank[cur_step] = [hidden_states[:self.id_length].clone(), hidden_states[self.id_length:].clone()]
-        else:
-            # encoder_hidden_states = torch.cat((self.id_bank[cur_step][0].to(self.device),self.id_bank[cur_step][1].to(self.device)))
-            # TODO: ADD Multipersion Control
-            encoder_arr = []
-            for character in cur_character:
-                encoder_arr = encoder_arr + [
-                    tensor.to(self.device)
-                    for tensor in self.id_bank[character][cur_step]
-                ]
-        # 判断随机数是否大于0.5
-        if cur_step < 1:
+        # 是否使用一致性注意力由预先生成的 schedule 决定（第0步不使用）
+        if not ctx.is_consistent(self.name):
             hidden_states = self.__call2__(
                 attn, hidden_states, None, attention_mask, temb
             )
         else:  # 256 1024 4096
-            random_number = random.random()
-            if cur_step < 20:
-                rand_num = 0.3
+            # print("before attention",hidden_states.shape,attention_mask.shape,encoder_hidden_states.shape if encoder_hidden_states is not None else "None")
+            if ctx.write:
+                total_batch_size, nums_token, channel = hidden_states.shape
+                img_nums = total_batch_size // 2
+                hidden_states = self.__call_write__(
+                    attn,
+                    hidden_states.reshape(-1, img_nums, nums_token, channel),
+                    indices,
+                    temb,
+                )
             else:
-                rand_num = 0.1
-            # print(f"hidden state shape {hidden_states.shape[1]}")
-            if random_number > rand_num:
-                if hidden_states.shape[1] == (height_s // 32) * (width_s // 32):
-                    indices = indices1024
-                else:
-                    indices = indices4096
-                # print("before attention",hidden_states.shape,attention_mask.shape,encoder_hidden_states.shape if encoder_hidden_states is not None else "None")
-                if write:
-                    total_batch_size, nums_token, channel = hidden_states.shape
-                    img_nums = total_batch_size // 2
-                    hidden_states = hidden_states.reshape(
-                        -1, img_nums, nums_token, channel
-                    )
-                    encoder_arr = [
-                        hidden_states[:, img_ind, indices[img_ind], :].reshape(
-                            2, -1, channel
-                        )
-                        for img_ind in range(img_nums)
-                    ]
-                    for img_ind in range(img_nums):
-                        # print(img_nums)
-                        # assert img_nums != 1
-                        img_ind_list = [i for i in range(img_nums)]
-                        # print(img_ind_list,img_ind)
-                        img_ind_list.remove(img_ind)
-                        # print(img_ind,invert_character_index_dict[img_ind])
-                        # print(character_index_dict[invert_character_index_dict[img_ind]])
-                        # print(img_ind_list)
-                        # print(img_ind,img_ind_list)
-                        encoder_hidden_states_tmp = torch.cat(
-                            [encoder_arr[img_ind] for img_ind in img_ind_list]
-                            + [hidden_states[:, img_ind, :, :]],
-                            dim=1,
-                        )
+                total_batch_size, nums_token, channel = hidden_states.shape
+                img_nums = total_batch_size // 2
 
-                        hidden_states[:, img_ind, :, :] = self.__call2__(
-                            attn,
-                            hidden_states[:, img_ind, :, :],
-                            encoder_hidden_states_tmp,
-                            None,
-                            temb,
-                        )
-                else:
-                    _, nums_token, channel = hidden_states.shape
-                    # img_nums = total_batch_size // 2
-                    # encoder_hidden_states = encoder_hidden_states.reshape(-1,img_nums,nums_token,channel)
-                    hidden_states = hidden_states.reshape(2, -1, nums_token, channel)
-
-                    # encoder_arr = [encoder_hidden_states[:,img_ind,indices[img_ind],:].reshape(2,-1,channel) for img_ind in range(img_nums)]
-                    encoder_hidden_states_tmp = torch.cat(
-                        encoder_arr + [hidden_states[:, 0, :, :]], dim=1
-                    )
-
-                    hidden_states[:, 0, :, :] = self.__call2__(
-                        attn,
-                        hidden_states[:, 0, :, :],
-                        encoder_hidden_states_tmp,
-                        None,
-                        temb,
-                    )
-                hidden_states = hidden_states.reshape(-1, nums_token, channel)
-            else:
+                # TODO: ADD Multipersion Control
+                entries = [
+                    self.get_bank_kv(attn, ctx, character, cur_step, hidden_states.dtype)
+                    for character in ctx.cur_character
+                ]
+                # 批量读取时同一批场景共享角色，id_bank 广播到 (uncond, cond) 两半的每个场景
                 hidden_states = self.__call2__(
-                    attn, hidden_states, None, attention_mask, temb
+                    attn,
+                    hidden_states,
+                    hidden_states,
+                    None,
+                    temb,
+                    cached_key=[entry["key"].repeat_interleave(img_nums, dim=0) for entry in entries],
+                    cached_value=[entry["value"].repeat_interleave(img_nums, dim=0) for entry in entries],
                 )
-        attn_count += 1
-        if attn_count == total_count:
-            attn_count = 0
-            cur_step += 1
-            indices1024, indices4096 = cal_attn_indice_xl_effcient_memory(
-                self.total_length,
-                self.id_length,
-                sa32,
-                sa64,
-                height_s,
-                width_s,
-                device=self.device,
-                dtype=self.dtype,
-            )
+            hidden_states = hidden_states.reshape(-1, nums_token, channel)
+        ctx.step_end()
 
         return hidden_states
 
+    def get_bank_kv(self, attn, ctx, character, cur_step, dtype=torch.float16):
+        """Return the projected {"key", "value"} of a character at this step, dequantized if needed."""
+        entry = ctx.fetch(self.name, character, cur_step)
+        if not isinstance(entry, dict):
+            # 旧格式的角色权重保存的是未投影的 hidden states，首次使用时投影并替换
+            hidden_states = torch.cat([tensor.to(self.device) for tensor in entry], dim=1)
+            entry = {"key": attn.to_k(hidden_states), "value": attn.to_v(hidden_states)}
+            ctx.bank(self.name)[character][cur_step] = ctx.offload(entry)
+        return unpack_entry(bank_entry_to(entry, self.device), dtype)
+
+    def __call_write__(
+            self,
+            attn,
+            hidden_states,
+            indices,
+            temb=None,
+    ):
+        r"""
+        Write-phase consistent self-attention for all reference images in one SDPA call.
+        Each image attends to its own tokens and to the sampled tokens of the other images, the
+        same as calling `__call2__` once per image. The sampled tokens of all images are projected
+        once and shared by the whole batch; a block mask hides an image's own sampled tokens.
+        Args:
+            hidden_states (`torch.Tensor`):
+                Shape (2, img_nums, nums_token, channel), uncond and cond halves of the batch.
+            indices (`list`):
+                The sampled token indices of every image.
+        """
+        _, img_nums, nums_token, channel = hidden_states.shape
+        batch_size = 2 * img_nums
+        sampled = [hidden_states[:, img_ind, indices[img_ind], :] for img_ind in range(img_nums)]
+        owner = torch.cat(
+            [
+                torch.full((tensor.shape[1],), img_ind, device=hidden_states.device)
+                for img_ind, tensor in enumerate(sampled)
+            ]
+        )
+        sampled = torch.cat(sampled, dim=1)  # 2, S, C
+        hidden_states = hidden_states.reshape(batch_size, nums_token, channel)  # 按 [uncond/cond][img] 排列
+        residual = hidden_states
+
+        # mask[b, j]: 图像 b 能否看到第 j 个 key，自己的采样token已包含在自己的完整token中
+        attention_mask = owner.unsqueeze(0) != torch.arange(img_nums, device=hidden_states.device).unsqueeze(1)
+        attention_mask = torch.cat(
+            [
+                attention_mask,
+                torch.ones(img_nums, nums_token, dtype=torch.bool, device=hidden_states.device),
+            ],
+            dim=1,
+        )
+        attention_mask = attention_mask.repeat(2, 1)[:, None, None, :]
+
+        query_states = hidden_states
+        if attn.spatial_norm is not None:
+            query_states = attn.spatial_norm(query_states, temb)
+        if attn.group_norm is not None:
+            query_states = attn.group_norm(query_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(query_states)
+        key = torch.cat(
+            [attn.to_k(sampled).repeat_interleave(img_nums, dim=0), attn.to_k(hidden_states)], dim=1
+        )
+        value = torch.cat(
+            [attn.to_v(sampled).repeat_interleave(img_nums, dim=0), attn.to_v(hidden_states)], dim=1
+        )
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask, memory_budget=self.attention_budget()
+        )
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(
+            batch_size, -1, attn.heads * head_dim
+        )
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states.reshape(2, img_nums, nums_token, channel)
+
     def __call2__(
             self,
             attn,
@@ -348,7 +765,12 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
             encoder_hidden_states=None,
             attention_mask=None,
             temb=None,
+            cached_key=None,
+            cached_value=None,
+            graph_safe=False,
     ):
+        # cached_key/cached_value: id_bank 中已投影的参考 key/value 列表，拼接在当前 key/value 之前
+        # graph_safe: 图安全的读取路径，attention_mask 是对全部 key 的加性偏置，不读取运行上下文
         residual = hidden_states
 
         if attn.spatial_norm is not None:
@@ -364,7 +786,7 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
 
         batch_size, sequence_length, channel = hidden_states.shape
 
-        if attention_mask is not None:
+        if attention_mask is not None and not graph_safe:
             attention_mask = attn.prepare_attention_mask(
                 attention_mask, sequence_length, batch_size
             )
@@ -388,6 +810,9 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
 
         key = attn.to_k(encoder_hidden_states)
         value = attn.to_v(encoder_hidden_states)
+        if cached_key:
+            key = torch.cat(cached_key + [key], dim=1)
+            value = torch.cat(cached_value + [value], dim=1)
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -399,8 +824,8 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+        hidden_states = scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask, memory_budget=None if graph_safe else self.attention_budget()
         )
 
         hidden_states = hidden_states.transpose(1, 2).reshape(
@@ -426,6 +851,99 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
         return hidden_states
 
 
+class GraphSafeSpatialAttnProcessor2_0(SpatialAttnProcessor2_0):
+    r"""
+    SpatialAttnProcessor2_0 that `torch.compile` can trace in the read phase without graph breaks.
+    The read phase only touches tensors of the shared StoryGraphState: the id_bank of the step is picked
+    by indexing with the step tensor, and a layer/step without consistent attention masks the bank
+    tokens out instead of branching, which gives the same output as plain self-attention.
+    Compile only covers the read phase: the write phase (reference images, run once per character) uses
+    the eager implementation, and StoryContextPipe runs it on the uncompiled UNet. The step counter lives in
+    the StoryGraphState shared by the UNet, so a compiled UNet runs one story at a time.
+    Args:
+        graph_state (`StoryGraphState`):
+            The state shared by the graph-safe processors of the UNet.
+        layer_index (`int`):
+            The call order of this layer within a denoising step.
+    """
+
+    def __init__(self, *args, graph_state=None, layer_index=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.graph_state = graph_state
+        self.layer_index = layer_index
+
+    def forward(self, *args, **kwargs):
+        # dynamo 把 nn.Module 的调用当作 forward，这里转到 __call__
+        return self.__call__(*args, **kwargs)
+
+    def __call__(
+            self,
+            attn,
+            hidden_states,
+            encoder_hidden_states=None,
+            attention_mask=None,
+            temb=None,
+    ):
+        state = self.graph_state
+        if state is None or not state.active:
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb)
+        # 用 index_select 取当前步，0 维张量直接做下标会触发 .item() 同步
+        step = (state.step % state.consistent.shape[0]).view(1)
+        if self.name in state.keys:
+            total_batch_size = hidden_states.shape[0]
+            img_nums = total_batch_size // 2
+            key = state.keys[self.name].index_select(0, step)[0].repeat_interleave(img_nums, dim=0)
+            value = state.values[self.name].index_select(0, step)[0].repeat_interleave(img_nums, dim=0)
+            # 不使用一致性注意力时屏蔽 id_bank 的 token
+            consistent = state.consistent[:, self.layer_index].index_select(0, step)
+            bank_bias = torch.where(consistent, 0.0, float("-inf"))
+            attention_bias = torch.cat(
+                [
+                    bank_bias.expand(key.shape[1]),
+                    torch.zeros(hidden_states.shape[1], device=hidden_states.device),
+                ]
+            ).to(hidden_states.dtype).view(1, 1, 1, -1)
+            hidden_states = self.__call2__(
+                attn,
+                hidden_states,
+                hidden_states,
+                attention_bias,
+                temb,
+                cached_key=[key],
+                cached_value=[value],
+                graph_safe=True,
+            )
+        else:
+            hidden_states = self.__call2__(attn, hidden_states, None, attention_mask, temb, graph_safe=True)
+        if self.layer_index == state.total_count - 1:
+            state.step += 1
+        return hidden_states
+
+
+def max_story_characters(bank_dtype="fp16", bank_offload=False):
+    """Characters a story can hold in the id_bank: 2 in fp16, 4 quantized, no limit when it is offloaded."""
+    if bank_offload:
+        return None  # id_bank 放在主机内存，按步分页到显存
+    return 2 if bank_dtype == "fp16" else 4  # 量化的 id_bank 约为 fp16 的一半
+
+
+def story_id_length(character_prompt, bank_dtype="fp16", bank_offload=False):
+    """The id_length of a story: one per line of the character prompt, up to max_story_characters."""
+    id_number = len(character_prompt.splitlines())
+    max_characters = max_story_characters(bank_dtype, bank_offload)
+    return id_number if max_characters is None else min(id_number, max_characters)
+
+
+def bind_resident_lora(pipe, lora, lora_path, lora_scale, trigger_words):
+    """Fuse the LoRA of one loader into a resident pipeline that several loaders may share."""
+    if not getattr(pipe, "lora_swap", False):
+        return pipe
+    if not swap_lora(pipe, lora_path if lora else None, 1.0 if lora in lora_lightning_list else lora_scale):
+        raise RuntimeError("the resident pipeline has another LoRA fused and can't swap it, reload the model.")
+    pipe.prompt_cache_state = (lora_path, lora_scale, trigger_words) if lora else None
+    return pipe
+
+
 def process_generation(
         pipe,
         upload_images,
@@ -447,21 +965,22 @@ def process_generation(
         lora,
         trigger_words, photomake_mode, use_kolor, use_flux, make_dual_only, kolor_face, pulid, story_maker,
         input_id_emb_s_dict, input_id_img_s_dict, input_id_emb_un_dict, input_id_cloth_dict, guidance, condition_image,
-        empty_emb_zero, use_cf, cf_scheduler, controlnet_path, controlnet_scale, cn_dict,input_tag_dict,SD35_mode,use_wrapper
+        empty_emb_zero, use_cf, cf_scheduler, controlnet_path, controlnet_scale, cn_dict,input_tag_dict,SD35_mode,use_wrapper,
+        sa32=0.5, sa64=0.5, char_bank=None, save_character=False, bank_dtype="fp16",
+        bank_offload=False, bank_cache=None, model_key=None, read_batch_size=1,
+        consistency_profile="full", token_selector="uniform", attention_budget_mb=None, panels=None,
+        story_record=None,
 ):  # Corrected font_choice usage
     
-    if len(general_prompt.splitlines()) >= 3:
-        raise "Support for more than three characters is temporarily unavailable due to VRAM limitations, but this issue will be resolved soon."
+    max_characters = max_story_characters(bank_dtype, bank_offload)
+    if max_characters is not None and len(general_prompt.splitlines()) > max_characters:
+        raise ValueError(f"Support for more than {max_characters} characters is temporarily unavailable due to VRAM limitations, try 'bank_int8' in easy_function.")
     # _model_type = "Photomaker" if _model_type == "Using Ref Images" else "original"
     
     if not use_kolor and not use_flux and not story_maker:
         if model_type == "img2img" and "img" not in general_prompt:
             raise 'if using normal SDXL img2img ,need add the triger word " img "  behind the class word you want to customize, such as: man img or woman img'
     
-    global total_length, attn_procs, cur_model_type
-    global write
-    global cur_step, attn_count
-    
     # load_chars = load_character_files_on_running(unet, character_files=char_files)
     
     prompts_origin = prompt_array.splitlines()
@@ -478,9 +997,6 @@ def process_generation(
             prompts = remove_punctuation_from_strings(prompts)
             prompts = [item + add_trigger_words for item in prompts]
     
-    global character_index_dict, invert_character_index_dict, ref_indexs_dict, ref_totals
-    global character_dict
-    
     character_dict, character_list = character_to_dict(general_prompt, lora, add_trigger_words)
     # print(character_dict)
     start_merge_step = int(float(_style_strength_ratio) / 100 * _num_steps)
@@ -546,20 +1062,115 @@ def process_generation(
         for ind, img in enumerate(upload_images):
             input_id_images_dict[character_list[ind]] = [img]  # 已经pil转化了 不用load {a:[img],b:[img]}
             # input_id_images_dict[character_list[ind]] = [load_image(img)]
+    # 部分重绘: 与上一次故事的记录比对签名，输入没有变化的分镜直接复用
+    run_panels = panels
+    reused_results = {}
+    record_units = {}  # 签名 -> 结果所在的分镜索引
+    if story_record is not None:
+        common = dict(model=model_key, model_type=model_type, style=style_name, negative_prompt=negative_prompt,
+                      seed=seed_, steps=_num_steps, cfg=cfg, guidance=guidance, height=height, width=width,
+                      num_images_per_prompt=num_images_per_prompt, sa32=sa32, sa64=sa64,
+                      consistency_profile=consistency_profile, token_selector=token_selector,
+                      bank_dtype=bank_dtype, bank_offload=bank_offload,
+                      char_bank=id(char_bank) if load_chars else None, strength=_style_strength_ratio)
+        # id_bank 由角色描述和参考分镜的提示词决定
+        banks = {key: dict(description=character_dict[key], refs=[replace_prompts[ind] for ind in ref_inds])
+                 for key, ref_inds in ref_indexs_dict.items()}
+        ref_units = {} if load_chars else ref_indexs_dict
+        for key, ref_inds in ref_units.items():
+            record_units[StoryRecord.signature(bank=banks[key], **common)] = list(ref_inds)
+        for ind in range(len(prompts)):
+            if ind in ref_totals and not load_chars:
+                continue
+            cur_banks = [banks[key] for key in get_ref_character(prompts[ind], character_dict) if key in banks]
+            record_units[StoryRecord.signature(prompt=replace_prompts[ind], banks=cur_banks, **common)] = [ind]
+        candidates = set(range(len(prompts)) if panels is None else panels)
+        run_panels = []
+        for signature, inds in record_units.items():
+            if not candidates & set(inds):
+                continue
+            previous = story_record.lookup(signature)
+            if previous is None:
+                run_panels.extend(inds)
+            else:
+                # 参考分镜的结果可能整组存在第一个参考分镜的位置，按相对位置放回
+                reused_results.update({inds[position]: image for position, image in previous.items()})
+        run_panels = sorted(set(run_panels) & candidates)
+        print(f"story record: {len(run_panels)} panels to generate, {len(reused_results)} reused")
+
+    # 精修模式(panels)或部分重绘只生成部分分镜，写入阶段只需要这些分镜里出现的角色
+    if run_panels is not None:
+        selected_characters = set()
+        for ind in run_panels:
+            selected_characters.update(get_ref_character(prompts[ind], character_dict))
+        write_characters = [key for key in character_dict.keys() if key in selected_characters]
+    else:
+        write_characters = list(character_dict.keys())
+
+    visible_inds = None
+    if panels is not None:
+        # 角色的参考分镜是一批生成的，结果可能整批存在第一个参考分镜的位置
+        visible_inds = set(panels)
+        for ref_inds in ref_indexs_dict.values():
+            if visible_inds & set(ref_inds):
+                visible_inds.add(ref_inds[0])
+
+    def visible_results():
+        return [results_dict[ind] for ind in results_dict.keys() if visible_inds is None or ind in visible_inds]
     # real_prompts = prompts[id_length:]
     # if device == "cuda":
     #     torch.cuda.empty_cache()
-    write = True
-    cur_step = 0
-    attn_count = 0
+    story_context = None
+    if hasattr(pipe, "unet"):
+        # 本次故事独立的注意力状态，多个故事可共用同一个常驻unet
+        story_context = StoryAttentionContext(pipe.unet, id_length, sa32, sa64, height, width,
+                                              num_steps=_num_steps, seed=seed_,
+                                              id_bank=char_bank, character_dict=character_dict,
+                                              bank_dtype=bank_dtype, bank_offload=bank_offload,
+                                              policy=CONSISTENCY_PROFILES[consistency_profile],
+                                              token_selector=token_selector,
+                                              attention_budget_mb=attention_budget_mb)
+        pipe = StoryContextPipe(pipe, story_context)
+    results_dict = dict(reused_results)
+    bank_cache_keys = {}
+    cached_refs = False  # 参考分镜来自角色权重缓存，不在读取阶段重新生成
+    if bank_cache is not None and story_context is not None and model_type == "txt2img" and not load_chars:
+        # 角色权重只由模型、角色描述和生成参数决定，全部命中时跳过参考图的写入阶段，
+        # 参考分镜使用缓存中保存的图片，与未命中时生成的结果相同
+        model_hash = model_fingerprint(pipe.unet)
+        for character_key in write_characters:
+            description = character_dict[character_key]
+            bank_cache_keys[character_key] = bank_cache.key(
+                model=model_key, model_hash=model_hash, character=character_key, description=description,
+                ref_prompts=[replace_prompts[ind] for ind in ref_indexs_dict[character_key]],
+                style=style_name, negative_prompt=negative_prompt, seed=seed_, height=height, width=width,
+                steps=_num_steps, cfg=cfg, **story_context.bank_metadata())
+        cached_files = [bank_cache.lookup(cache_key) for cache_key in bank_cache_keys.values()]
+        hit = bool(cached_files) and all(cached_files)
+        if hit:
+            reference_panels = {}
+            for character_key, cached_file in zip(bank_cache_keys, cached_files):
+                load_single_character_weights(pipe.unet, story_context.id_bank, cached_file)
+                reference_panels[character_key] = CharacterBankFile(cached_file).reference_panels()
+            load_chars = True
+            bank_cache_keys = {}
+            if all(panels is not None for panels in reference_panels.values()):
+                for character_key, panels in reference_panels.items():
+                    for ind, panel in zip(ref_indexs_dict[character_key], panels):
+                        if panel is not None:
+                            results_dict[ind] = panel
+                cached_refs = True
+            else:
+                logging.warning("the cached character weights have no reference panels, they are rendered again "
+                                "in the read phase and differ from the first run")
+        bank_cache.record(hit)
+        logging.info(f"character bank cache: {bank_cache.stats()}")
     total_results = []
     id_images = []
-    results_dict = {}
     p_num = 0
     
-    global cur_character
     if not load_chars:
-        for character_key in character_dict.keys():  # 先生成角色对应第一句场景提示词的图片,图生图是批次生成
+        for character_key in write_characters:  # 先生成角色对应第一句场景提示词的图片,图生图是批次生成
             character_key_str = character_key
             cur_character = [character_key]
             ref_indexs = ref_indexs_dict[character_key]
@@ -568,7 +1179,8 @@ def process_generation(
             if model_type == "txt2img":
                 setup_seed(seed_)
             generator = torch.Generator(device=device).manual_seed(seed_)
-            cur_step = 0
+            if story_context is not None:
+                story_context.start(cur_character, write=True)
             cur_positive_prompts, cur_negative_prompt = apply_style(
                 style_name, current_prompts, negative_prompt
             )
@@ -952,20 +1564,64 @@ def process_generation(
                     results_dict[ref_indexs[ind]] = img
             # real_images = []
             # print(results_dict)
-            yield [results_dict[ind] for ind in results_dict.keys()]
+            yield visible_results()
+        if story_context is not None:
+            story_context.bank_report()
+        if bank_cache_keys:
+            story_context.synchronize()
+            metadata = story_context.bank_metadata()
+            metadata["model_hash"] = model_hash
+            for character_key, cache_key in bank_cache_keys.items():
+                # 没有 SpatialAttnProcessor2_0 的管线(Kolors、PhotoMaker)不写角色权重，不缓存空的 bank
+                if not any(characters.get(character_key) for characters in story_context.id_bank.values()):
+                    continue
+                bank_cache.store(cache_key, story_context.id_bank, character_key,
+                                 dict(metadata, description=character_dict[character_key]),
+                                 reference_panels=[results_dict.get(ind) for ind in ref_indexs_dict[character_key]])
+    if cached_refs:
+        yield visible_results()
     
-    write = False
-    if not load_chars:
+    if not load_chars or cached_refs:
         real_prompts_inds = [
             ind for ind in range(len(prompts)) if ind not in ref_totals
         ]
     else:
         real_prompts_inds = [ind for ind in range(len(prompts))]
+    if run_panels is not None:
+        real_prompts_inds = [ind for ind in real_prompts_inds if ind in run_panels]
     print(real_prompts_inds)
     real_prompt_no, negative_prompt_style = apply_style_positive(style_name, "real_prompt")
     negative_prompt = str(negative_prompt) + str(negative_prompt_style)
     # print(f"real_prompts_inds is {real_prompts_inds}")
-    for real_prompts_ind in real_prompts_inds:  #
+    # SDXL 文生图可以把角色相同的场景合成小批次一起采样，每个场景使用自己的同种子 generator，结果与逐个采样一致
+    batched_read = (read_batch_size > 1 and num_images_per_prompt == 1 and model_type == "txt2img"
+                    and story_context is not None and not use_flux and not use_cf and not SD35_mode)
+    sequential_prompts_inds = [] if batched_read else real_prompts_inds
+    if batched_read:
+        read_batches = group_read_batches(
+            real_prompts_inds,
+            [get_ref_character(prompts[ind], character_dict) for ind in real_prompts_inds],
+            read_batch_size,
+        )
+        for batch_inds, cur_character in read_batches:
+            setup_seed(seed_)
+            generator = [torch.Generator(device=device).manual_seed(seed_) for _ in batch_inds]
+            story_context.start(cur_character, write=False)
+            real_prompts = [apply_style_positive(style_name, replace_prompts[ind])[0] for ind in batch_inds]
+            print(f"Sample real_prompt batch : {real_prompts}")
+            batch_images = pipe(
+                real_prompts,
+                num_inference_steps=_num_steps,
+                guidance_scale=cfg,
+                height=height,
+                width=width,
+                negative_prompt=negative_prompt,
+                generator=generator,
+            ).images
+            for ind, image in zip(batch_inds, batch_images):
+                results_dict[ind] = [image]
+            yield visible_results()
+    for real_prompts_ind in sequential_prompts_inds:  #
         real_prompt = replace_prompts[real_prompts_ind]
         cur_character = get_ref_character(prompts[real_prompts_ind], character_dict)
         
@@ -975,7 +1631,8 @@ def process_generation(
         
         if len(cur_character) > 1 and model_type == "img2img":
             raise "Temporarily Not Support Multiple character in Ref Image Mode!"
-        cur_step = 0
+        if story_context is not None:
+            story_context.start(cur_character, write=False)
         real_prompt, negative_prompt_style_no = apply_style_positive(style_name, real_prompt)
         print(f"Sample real_prompt : {real_prompt}")
         if model_type == "txt2img":
@@ -1284,10 +1941,22 @@ def process_generation(
                 "You should choice between original and Photomaker!",
                 f"But you choice {model_type}",
             )
-        yield [results_dict[ind] for ind in results_dict.keys()]
+        yield visible_results()
     print('!!!!!!!!!!!results_dict', results_dict.keys())
     sorted_dict = dict(sorted(results_dict.items()))
-    total_results = [results_dict[ind] for ind in sorted_dict.keys()]
+    total_results = [results_dict[ind] for ind in sorted_dict.keys() if visible_inds is None or ind in visible_inds]
+    if story_record is not None:
+        entries = {}
+        for signature, inds in record_units.items():
+            outputs = {position: results_dict[ind] for position, ind in enumerate(inds) if ind in results_dict}
+            if outputs:
+                entries[signature] = outputs
+            elif story_record.lookup(signature) is not None:
+                entries[signature] = story_record.lookup(signature)  # 精修模式下未选中的分镜
+        story_record.update(entries, reused=len(reused_results), generated=len(set(results_dict) - set(reused_results)))
+    if save_character and story_context is not None:
+        print("saving character...")
+        save_results(pipe.unet, story_context)
     torch.cuda.empty_cache()
     yield total_results
 
@@ -1345,9 +2014,22 @@ class Storydiffusion_Model_Loader:
         
         scheduler_choice = get_scheduler(sampeler_name,scheduler)
         scheduler={"name":sampeler_name,"scheduler":scheduler}
-        id_number=len(character_prompt.splitlines())
-        if id_number > 2:
-            id_number=2
+        if controlnet_model=="none":
+            controlnet_path=None
+        else:
+            controlnet_path=folder_paths.get_full_path("controlnet", controlnet_model)
+
+        condition_image=kwargs.get("condition_image")
+        photomaker_path = os.path.join(photomaker_dir, f"photomaker-{photomake_mode}.bin")
+        photomake_mode_=photomake_mode
+       
+        # load model
+        (auraface, NF4, save_model, kolor_face,flux_pulid_name,pulid,quantized_mode,story_maker,make_dual_only,
+         clip_vision_path,char_files,ckpt_path,lora,lora_path,use_kolor,photomake_mode,use_flux,onnx_provider,low_vram,TAG_mode,SD35_mode,bank_dtype,bank_offload,bank_cache,consistency_profile,token_selector,attention_budget_mb,compile_unet,panel_reuse,model_cache,model_cache_gb)=get_easy_function(
+            easy_function,clip_vision,character_weights,ckpt_name,lora,repo_id,photomake_mode)
+        
+        # 角色数上限由 id_bank 的存储方式决定(fp16 为 2 个，量化为 4 个，offload 不限制)
+        id_number=story_id_length(character_prompt, bank_dtype, bank_offload)
         
         image = kwargs.get("image")
         if isinstance(image,torch.Tensor):
@@ -1362,20 +2044,6 @@ class Storydiffusion_Model_Loader:
             
         logging.info(f"Process using {id_number} roles,mode is {model_type}....")
         
-        if controlnet_model=="none":
-            controlnet_path=None
-        else:
-            controlnet_path=folder_paths.get_full_path("controlnet", controlnet_model)
-
-        condition_image=kwargs.get("condition_image")
-        photomaker_path = os.path.join(photomaker_dir, f"photomaker-{photomake_mode}.bin")
-        photomake_mode_=photomake_mode
-       
-        # load model
-        (auraface, NF4, save_model, kolor_face,flux_pulid_name,pulid,quantized_mode,story_maker,make_dual_only,
-         clip_vision_path,char_files,ckpt_path,lora,lora_path,use_kolor,photomake_mode,use_flux,onnx_provider,low_vram,TAG_mode,SD35_mode)=get_easy_function(
-            easy_function,clip_vision,character_weights,ckpt_name,lora,repo_id,photomake_mode)
-        
         print('!!!!!!!!!!ckpt_path,lora,lora_path,use_kolor,photomake_mode,use_flux,SD35_mode', ckpt_path,lora,lora_path,use_kolor,photomake_mode,use_flux,SD35_mode)
         photomaker_path,face_ckpt,photomake_mode,pulid_ckpt,face_adapter,kolor_ip_path=pre_checkpoint(
             photomaker_path, photomake_mode, kolor_face, pulid, story_maker, clip_vision_path,use_kolor,model_type)
@@ -1390,26 +2058,42 @@ class Storydiffusion_Model_Loader:
             aggressive_offload = True
             offload = True
         logging.info(f"total_vram is {total_vram},aggressive_offload is {aggressive_offload},offload is {offload}")
-        # global
-        global  attn_procs
-        global sa32, sa64, write, height_s, width_s
-        global attn_count, total_count, id_length, total_length, cur_step
-
-        sa32 = sa32_degree
-        sa64 = sa64_degree
-        attn_count = 0
-        total_count = 0
-        cur_step = 0
+        # 注意力的运行状态由 process_generation 中的 StoryAttentionContext 管理
         id_length = id_number
-        total_length = 5
-        attn_procs = {}
-        write = False
-        height_s = math.ceil(height / 32) * 32
-        width_s = math.ceil(width / 32) * 32
         use_cf=False
         use_storydif=False
         use_wrapper = False
-        if not repo_id and not ckpt_path and not cf_model:
+        # 加载配置相同时复用常驻的管线(ComfyUI 的 MODEL 输入由 ComfyUI 自己管理，不进注册表)
+        if model_cache_gb is not None:
+            model_registry.set_budget(model_cache_gb * 1024 ** 3)
+        registry_key = None
+        lora_registry_key = None
+        if model_cache and not cf_model and (repo_id or ckpt_path):
+            registry_config = dict(
+                model_type=model_type, repo_id=repo_id, ckpt_path=ckpt_path, vae_id=vae_id, photomake_mode=photomake_mode,
+                photomaker_path=photomaker_path, controlnet_path=controlnet_path, clip_vision_path=clip_vision_path,
+                NF4=NF4, save_model=save_model, kolor_face=kolor_face, flux_pulid_name=flux_pulid_name, pulid=pulid,
+                quantized_mode=quantized_mode, story_maker=story_maker, make_dual_only=make_dual_only,
+                use_kolor=use_kolor, use_flux=use_flux, SD35_mode=SD35_mode, onnx_provider=onnx_provider,
+                low_vram=low_vram, compile_unet=compile_unet, offload=offload, aggressive_offload=aggressive_offload,
+                clip=id(clip) if clip is not None else None, vae=id(front_vae) if front_vae is not None else None)
+            # load_models 载入的管线可以热切换 LoRA，键里不含 LoRA；其他管线的 LoRA 在加载时融合，键里包含 LoRA
+            registry_key = model_registry.key(**registry_config)
+            lora_registry_key = model_registry.key(lora_path=lora_path, lora_scale=lora_scale,
+                                                   trigger_words=trigger_words, **registry_config)
+        registry_entry = model_registry.get(registry_key) if registry_key else None
+        if registry_entry is not None and not swap_lora(registry_entry.pipe, lora_path if lora else None,
+                                                        1.0 if lora in lora_lightning_list else lora_scale):
+            registry_entry = None
+        if registry_entry is None and lora_registry_key:
+            registry_entry = model_registry.get(lora_registry_key)
+        if registry_entry is not None:
+            logging.info("reuse the resident pipeline of the same load config...")
+            pipe = registry_entry.pipe
+            use_storydif, use_wrapper, use_flux = (registry_entry.state[name] for name in ("use_storydif", "use_wrapper", "use_flux"))
+            if use_storydif and not compile_unet:
+                set_attention_processor(pipe.unet, id_length, is_ipadapter=False)
+        elif not repo_id and not ckpt_path and not cf_model:
             raise "you need choice a model or repo_id or a comfyUI model..."
         elif not repo_id and not ckpt_path and cf_model:
             from comfy.utils import load_torch_file as load_torch_file_
@@ -1593,21 +2277,35 @@ class Storydiffusion_Model_Loader:
                                        trigger_words=trigger_words, lora_scale=lora_scale)
                     set_attention_processor(pipe.unet, id_length, is_ipadapter=False)
                     
-        if vae_id != "none":
+        if vae_id != "none" and registry_entry is None:
             if use_storydif:
-                vae_id = folder_paths.get_full_path("vae", vae_id)
+                vae_path = folder_paths.get_full_path("vae", vae_id)
                 vae_config=os.path.join(dir_path, "local_repo","vae")
-                pipe.vae=AutoencoderKL.from_single_file(vae_id, config=vae_config,torch_dtype=torch.float16)
+                pipe.vae=AutoencoderKL.from_single_file(vae_path, config=vae_config,torch_dtype=torch.float16)
         load_chars = False
+        char_bank = {}
         if use_storydif:
+            if compile_unet and registry_entry is None:
+                if low_vram:
+                    logging.warning("compile is not used together with low_vram (model cpu offload).")
+                else:
+                    logging.info("compile the unet with graph-safe consistent self-attention...")
+                    set_attention_processor(pipe.unet, id_length, is_ipadapter=False, graph_safe=True)
+                    pipe.unet = torch.compile(pipe.unet)
             pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
-            load_chars = load_character_files_on_running(pipe.unet, character_files=char_files)
+            load_chars = load_character_files_on_running(pipe.unet, char_bank, character_files=char_files)
             pipe.enable_freeu(s1=0.6, s2=0.4, b1=1.1, b2=1.2)
             pipe.enable_vae_slicing()
-            if device != "mps":
+            if device != "mps" and registry_entry is None:
                 if low_vram:
                     pipe.enable_model_cpu_offload()
+        if registry_key and registry_entry is None:
+            model_registry.put(registry_key if getattr(pipe, "lora_swap", False) else lora_registry_key, pipe,
+                               {"use_storydif": use_storydif, "use_wrapper": use_wrapper, "use_flux": use_flux},
+                               refs=(clip, front_vae))
         
+        # 文本编码走共享的 LRU 缓存，LoRA 融合进文本编码器时作为键的一部分
+        install_prompt_cache(pipe, lora_state=(lora_path, lora_scale, trigger_words) if lora else None)
         torch.cuda.empty_cache()
         # need get emb
         character_name_dict_, character_list_ = character_to_dict(character_prompt, lora, trigger_words)
@@ -1651,18 +2349,22 @@ class Storydiffusion_Model_Loader:
         
         #print( role_name_list)
         model={"pipe":pipe,"use_flux":use_flux,"use_kolor":use_kolor,"photomake_mode":photomake_mode,"trigger_words":trigger_words,"lora_scale":lora_scale,
-               "load_chars":load_chars,"repo_id":repo_id,"lora_path":lora_path,"ckpt_path":ckpt_path,"model_type":model_type, "lora": lora,
+               "load_chars":load_chars,"repo_id":repo_id,"vae_id":vae_id,"lora_path":lora_path,"ckpt_path":ckpt_path,"model_type":model_type, "lora": lora,
                "scheduler":scheduler,"width":width,"height":height,"kolor_face":kolor_face,"pulid":pulid,"story_maker":story_maker,
                "make_dual_only":make_dual_only,"face_adapter":face_adapter,"clip_vision_path":clip_vision_path,
                "controlnet_path":controlnet_path,"character_prompt":character_prompt,"image":image,"condition_image":condition_image,
                "input_id_emb_s_dict":input_id_emb_s_dict,"input_id_img_s_dict":input_id_img_s_dict,"use_cf":use_cf,"SD35_mode":SD35_mode,"use_wrapper":use_wrapper,
-               "input_id_emb_un_dict":input_id_emb_un_dict,"input_id_cloth_dict":input_id_cloth_dict,"role_name_list":role_name_list,"use_storydif":use_storydif,"low_vram":low_vram,"input_tag_dict":input_tag_dict}
+               "input_id_emb_un_dict":input_id_emb_un_dict,"input_id_cloth_dict":input_id_cloth_dict,"role_name_list":role_name_list,"use_storydif":use_storydif,"low_vram":low_vram,"input_tag_dict":input_tag_dict,
+               "id_length":id_length,"sa32":sa32_degree,"sa64":sa64_degree,"char_bank":char_bank,"bank_dtype":bank_dtype,"bank_offload":bank_offload,"bank_cache":bank_cache,
+               "consistency_profile":consistency_profile,"token_selector":token_selector,
+               "attention_budget_mb":attention_budget_mb,"panel_reuse":panel_reuse}
         return (model,)
 
 
 class Storydiffusion_Sampler:
     def __init__(self):
-        pass
+        # 上一次故事的分镜记录，只重新生成有变化的分镜
+        self.story_record = StoryRecord()
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -1699,6 +2401,10 @@ class Storydiffusion_Sampler:
                 "guidance_list": ("STRING", {"multiline": True, "default": "0., 0.25, 0.4, 0.75;0.6, 0.25, 1., 0.75"}),
             },
             "optional": {"control_image": ("IMAGE",),
+                         "read_batch_size": ("INT", {"default": 1, "min": 1, "max": 8}),
+                         "save_panels": ("BOOLEAN", {"default": False},),
+                         "story_mode": (["full", "draft", "refine"],),
+                         "refine_panels": ("STRING", {"default": ""}),
                          },
             }
 
@@ -1710,7 +2416,15 @@ class Storydiffusion_Sampler:
 
     def story_sampler(self, model,scene_prompts, negative_prompt, img_style, seed, steps,
                   cfg, num_images_per_prompt, denoise_or_ip_sacle, style_strength_ratio,
-                  guidance, mask_threshold, start_step,save_character,controlnet_scale,guidance_list,**kwargs):
+                  guidance, mask_threshold, start_step,save_character,controlnet_scale,guidance_list,*,
+                  keep_pipe_loaded=False,**kwargs):
+        r"""
+        Sampler node entry. `kwargs` carries the optional node inputs (control_image, story_mode, ...).
+        Args:
+            keep_pipe_loaded (`bool`, defaults to `False`):
+                Not a node input: keep the StoryDiffusion pipeline on the gpu after the story instead of
+                moving it back to the cpu. Used by `batch.py`, which runs a group of stories on one pipeline.
+        """
         # get value from dict
         pipe=model.get("pipe")
         use_flux=model.get("use_flux")
@@ -1727,6 +2441,11 @@ class Storydiffusion_Sampler:
         scheduler=model.get("scheduler")
         input_height=model.get("height")
         input_width = model.get("width")
+        # draft: 低分辨率、少步数预览整个故事; refine: 用原分辨率和步数只重新生成选中的分镜(种子相同，角色权重走缓存)
+        story_mode=kwargs.get("story_mode","full")
+        if story_mode=="draft":
+            input_height, input_width, steps = draft_settings(input_height, input_width, steps)
+            print(f"draft mode: {input_width}x{input_height}, {steps} steps")
         height = math.ceil(input_height / 32) * 32
         width = math.ceil(input_width / 32) * 32
         kolor_face= model.get("kolor_face")
@@ -1754,8 +2473,27 @@ class Storydiffusion_Sampler:
         control_image=kwargs.get("control_image")
         input_tag_dict=model.get("input_tag_dict")
         use_wrapper=model.get("use_wrapper")
+        id_length=model.get("id_length")
+        sa32=model.get("sa32")
+        sa64=model.get("sa64")
+        char_bank=model.get("char_bank")
+        bank_dtype=model.get("bank_dtype","fp16")
+        bank_offload=model.get("bank_offload",False)
+        read_batch_size=kwargs.get("read_batch_size",1)
+        save_panels=kwargs.get("save_panels",False)
+        consistency_profile=model.get("consistency_profile","full")
+        token_selector=model.get("token_selector","uniform")
+        attention_budget_mb=model.get("attention_budget_mb")
+        use_bank_cache=model.get("bank_cache",True)
+        panel_reuse=model.get("panel_reuse",True)
+        # 角色权重缓存键中的模型部分
+        model_key={"repo_id":repo_id,"ckpt_path":ckpt_path,"vae_id":model.get("vae_id","none"),"lora_path":lora_path,"lora_scale":lora_scale,
+                   "scheduler":scheduler,"photomake_mode":photomake_mode,"trigger_words":trigger_words}
         
         if use_storydif:
+            # 同一个常驻管线可能被多个加载节点共用，调度器和 LoRA 在每次采样前重新设置
+            pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
+            bind_resident_lora(pipe, lora, lora_path, lora_scale, trigger_words)
             pipe.to(device)
 
         empty_emb_zero = None
@@ -1785,6 +2523,15 @@ class Storydiffusion_Sampler:
         prompts_no_dual = [prompt for prompt in prompts_origin if not len(extract_content_from_brackets(prompt)) >= 2]
         prompts_no_nc_dual = [prompt for prompt in prompts_no_dual if "[NC]" not in prompt]
         
+        panels = None
+        if story_mode != "full":
+            if prompts_dual:
+                raise ValueError("draft and refine mode don't support dual-character scenes yet.")
+            if story_mode == "refine":
+                panels = parse_panel_selection(kwargs.get("refine_panels", ""), len(prompts_no_dual))
+                if not panels:
+                    raise ValueError("refine mode needs the panels to render in refine_panels, such as 2,4")
+        
         if len(char_origin) == 2:
             positions_char_1 = [index for index, prompt in enumerate(prompts_origin) if char_origin[0] in prompt][
                 0]  # 获取角色出现的索引列表，并获取首次出现的位置
@@ -1829,7 +2576,13 @@ class Storydiffusion_Sampler:
                                      load_chars,
                                      lora,
                                      trigger_words,photomake_mode,use_kolor,use_flux,make_dual_only,
-                                     kolor_face,pulid,story_maker,input_id_emb_s_dict, input_id_img_s_dict,input_id_emb_un_dict, input_id_cloth_dict,guidance,condition_image,empty_emb_zero,use_cf,cf_scheduler,controlnet_path,controlnet_scale,cn_dict,input_tag_dict,SD35_mode,use_wrapper)
+                                     kolor_face,pulid,story_maker,input_id_emb_s_dict, input_id_img_s_dict,input_id_emb_un_dict, input_id_cloth_dict,guidance,condition_image,empty_emb_zero,use_cf,cf_scheduler,controlnet_path,controlnet_scale,cn_dict,input_tag_dict,SD35_mode,use_wrapper,
+                                     sa32=sa32, sa64=sa64, char_bank=char_bank, save_character=save_character,
+                                     bank_dtype=bank_dtype, bank_offload=bank_offload,
+                                     bank_cache=character_bank_cache if use_bank_cache else None, model_key=model_key,
+                                     read_batch_size=read_batch_size, consistency_profile=consistency_profile,
+                                     token_selector=token_selector, attention_budget_mb=attention_budget_mb,
+                                     panels=panels, story_record=self.story_record if panel_reuse and model_type == "txt2img" else None)
 
         else:
             if story_maker:
@@ -1846,16 +2599,21 @@ class Storydiffusion_Sampler:
                                      load_chars,
                                      lora,
                                      trigger_words,photomake_mode,use_kolor,use_flux,make_dual_only,kolor_face,
-                                     pulid,story_maker,input_id_emb_s_dict, input_id_img_s_dict,input_id_emb_un_dict, input_id_cloth_dict,guidance,condition_image,empty_emb_zero,use_cf,cf_scheduler,controlnet_path,controlnet_scale,cn_dict,input_tag_dict,SD35_mode,use_wrapper)
-
-        for value in gen:
-            print(type(value))
+                                     pulid,story_maker,input_id_emb_s_dict, input_id_img_s_dict,input_id_emb_un_dict, input_id_cloth_dict,guidance,condition_image,empty_emb_zero,use_cf,cf_scheduler,controlnet_path,controlnet_scale,cn_dict,input_tag_dict,SD35_mode,use_wrapper,
+                                     sa32=sa32, sa64=sa64, char_bank=char_bank, save_character=save_character,
+                                     bank_dtype=bank_dtype, bank_offload=bank_offload,
+                                     bank_cache=character_bank_cache if use_bank_cache else None, model_key=model_key,
+                                     read_batch_size=read_batch_size, consistency_profile=consistency_profile,
+                                     token_selector=token_selector, attention_budget_mb=attention_budget_mb,
+                                     panels=panels, story_record=self.story_record if panel_reuse and model_type == "txt2img" else None)
+
+        # 每完成一个分镜就更新进度条和预览(可选逐张保存)，不用等整个故事结束
+        streamer = PanelStreamer(len(panels) if panels is not None else len(prompts_no_dual), save_prefix="StoryDiffusion_panel" if save_panels else None)
+        value = streamer.consume(gen)
+        prompt_embed_cache.log_stats()
         image_pil_list = phi_list(value)
 
         image_pil_list_ms = image_pil_list.copy()
-        if save_character:
-            print("saving character...")
-            save_results(pipe.unet)
         if prompts_dual:
             if not clip_vision_path:
                 raise "need a clip_vison weight."
@@ -1959,20 +2717,11 @@ class Storydiffusion_Sampler:
                     img = image_dual[j]
                 image_pil_list.insert(int(i), img)
                 j += 1
-            image_list = narry_list(image_pil_list)
             torch.cuda.empty_cache()
-        else:
-            image_list = narry_list(image_pil_list)
-        #print(image_list)
-        image_list_new = []
-        for i in range(len(image_list)):
-            image_reshape = image_list[i].view(-1, height, width, 3)
-            for image_id in range(image_reshape.shape[0]):
-                image_list_new.append(image_reshape[image_id,...][:input_height,:input_width,:])
-        image_list = image_list_new
-        print('!!!!!!len(image_list), image_list[0].shape is', len(image_list), image_list[0].shape)
-        image = torch.from_numpy(np.fromiter(image_list, np.dtype((np.float32, (input_height, input_width, 3)))))
-        if use_storydif and not prompts_dual:
+        # 直接写入预分配的输出张量并裁剪回输入尺寸
+        image = panels_to_tensor(image_pil_list, height, width, input_height, input_width)
+        logging.debug(f"story output shape: {tuple(image.shape)}")
+        if use_storydif and not prompts_dual and not keep_pipe_loaded:
             try:
                pipe.to("cpu")
             except:
@@ -0,0 +1,238 @@
+"""
+不经过 ComfyUI 节点图的批量故事生成，在 ComfyUI 根目录运行:
+    python -m custom_nodes.ComfyUI_StoryDiffusion.batch stories.jsonl --output output/story_batch
+    (作为 comfyui_storydiffusion 包安装时: python -m comfyui_storydiffusion.batch ...)
+stories.jsonl 每行一个故事:
+    {"id": "morning", "characters": ["[Taylor] a woman img, wearing a white T-shirt, blue loose hair."],
+     "scenes": ["[Taylor] wake up in the bed", "[Taylor] have breakfast by the window"],
+     "style": "Japanese_Anime", "seed": 0, "width": 768, "height": 768,
+     "sampler": {"steps": 20, "cfg": 7}, "model": {"repo_id": "stabilityai/stable-diffusion-xl-base-1.0"},
+     "comic": {"comic_type": "Four_Pannel", "text_size": 40}}
+"model" 中是加载节点的参数(ckpt_name、lora、easy_function 等)，"sampler" 中是采样节点的参数，
+未给出的参数使用节点的默认值。模型参数相同的故事共用一次加载，管线在整组故事之间常驻显存。
+输出目录: <id>/panel_XXX.png、<id>/comic.png、manifest.jsonl(每个故事一行)、summary.json(吞吐与耗时)。
+只支持文生图(txt2img)，图生图的角色特征在加载时提取，需要逐个故事加载。
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .Storydiffusion_node import Comic_Type, Storydiffusion_Model_Loader, Storydiffusion_Sampler, fonts_lists, story_id_length
+from .utils.gradio_utils import character_to_dict
+
+# 加载节点里只影响单个故事、不需要重新加载模型的参数
+LOADER_STORY_ARGS = ("character_prompt", "width", "height")
+
+
+def node_defaults(node):
+    """Default value of every required input of a node: the `default` option, or the first choice of a list."""
+    defaults = {}
+    for name, spec in node.INPUT_TYPES()["required"].items():
+        if isinstance(spec[0], list):
+            defaults[name] = spec[0][0] if spec[0] else None
+        elif len(spec) > 1 and "default" in spec[1]:
+            defaults[name] = spec[1]["default"]
+    return defaults
+
+
+def read_stories(path):
+    stories = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            story = json.loads(line)
+            if not story.get("characters") or not story.get("scenes"):
+                raise ValueError(f"{path}:{line_number}: a story needs 'characters' and 'scenes'")
+            if isinstance(story["characters"], str):
+                story["characters"] = story["characters"].splitlines()
+            if isinstance(story["scenes"], str):
+                story["scenes"] = story["scenes"].splitlines()
+            story.setdefault("id", f"story_{len(stories):04d}")
+            stories.append(story)
+    ids = [story["id"] for story in stories]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{path}: story ids must be unique")
+    return stories
+
+
+def model_config(story, defaults):
+    config = {name: value for name, value in defaults.items() if name not in LOADER_STORY_ARGS}
+    model = dict(story.get("model", {}))
+    # 加载节点的参数名是 sampeler_name，也接受 sampler_name
+    if "sampler_name" in model:
+        model["sampeler_name"] = model.pop("sampler_name")
+    unknown = set(model) - set(config)
+    if unknown:
+        raise ValueError(f"story {story['id']}: unknown model options {sorted(unknown)}")
+    config.update(model)
+    return config
+
+
+def group_stories(stories, defaults):
+    """Group stories by model config, keeping the order in which each config first appears."""
+    groups = {}
+    for story in stories:
+        config = model_config(story, defaults)
+        key = json.dumps(config, sort_keys=True)
+        groups.setdefault(key, (config, []))[1].append(story)
+    return list(groups.values())
+
+
+def bind_story(model, story, config):
+    """The loader's model dict with the per-story character fields rebound (txt2img only)."""
+    if model.get("model_type") == "img2img":
+        # 图生图的角色特征(id 图片、embedding)在加载时提取，不能换成其他故事的角色
+        raise ValueError(f"story {story['id']}: batch generation only supports txt2img model configs")
+    character_prompt = "\n".join(story["characters"])
+    character_name_dict, _ = character_to_dict(character_prompt, model.get("lora"), config["trigger_words"])
+    bound = dict(model)
+    bound.update({
+        "character_prompt": character_prompt,
+        "role_name_list": list(character_name_dict.keys()),
+        # 与加载节点相同: 角色数按 character_prompt 的行数计算，上限由 id_bank 的存储方式决定
+        "id_length": story_id_length(character_prompt, model.get("bank_dtype", "fp16"), model.get("bank_offload", False)),
+        "width": story.get("width", model["width"]),
+        "height": story.get("height", model["height"]),
+    })
+    return bound
+
+
+def tensor_to_pil(image):
+    return Image.fromarray(np.clip(255.0 * image.cpu().numpy(), 0, 255).astype(np.uint8))
+
+
+def write_story(output_dir, story, image, comic):
+    story_dir = os.path.join(output_dir, story["id"])
+    os.makedirs(story_dir, exist_ok=True)
+    panels = []
+    for index, panel in enumerate(image):
+        path = os.path.join(story_dir, f"panel_{index:03d}.png")
+        tensor_to_pil(panel).save(path, compress_level=4)
+        panels.append(os.path.relpath(path, output_dir))
+    comic_path = None
+    if comic is not None:
+        comic_path = os.path.join(story_dir, "comic.png")
+        tensor_to_pil(comic[0]).save(comic_path, compress_level=4)
+        comic_path = os.path.relpath(comic_path, output_dir)
+    return panels, comic_path
+
+
+class BatchRunner:
+    r"""
+    Runs a list of stories with the loader and sampler nodes, loading every model config once and
+    keeping its pipeline resident for all the stories of the group.
+    Args:
+        output_dir (`str`):
+            Panels, comics, `manifest.jsonl` and `summary.json` are written here.
+        make_comic (`bool`, defaults to `True`):
+            Also lay out the panels of every story as a comic page with the scene captions.
+    """
+
+    def __init__(self, output_dir, make_comic=True):
+        self.output_dir = output_dir
+        self.make_comic = make_comic
+        self.loader = Storydiffusion_Model_Loader()
+        self.sampler = Storydiffusion_Sampler()
+        self.comic = Comic_Type()
+        self.loader_defaults = node_defaults(Storydiffusion_Model_Loader)
+        self.sampler_defaults = node_defaults(Storydiffusion_Sampler)
+        self.comic_defaults = node_defaults(Comic_Type)
+
+    def load(self, config, story):
+        args = dict(config)
+        args.update(character_prompt="\n".join(story["characters"]),
+                    width=story.get("width", self.loader_defaults["width"]),
+                    height=story.get("height", self.loader_defaults["height"]))
+        return self.loader.story_model_loader(**args)[0]
+
+    def generate(self, model, story):
+        args = {name: value for name, value in self.sampler_defaults.items() if name != "model"}
+        for name in ("seed", "negative_prompt"):
+            if name in story:
+                args[name] = story[name]
+        if "style" in story:
+            args["img_style"] = story["style"]
+        args.update(story.get("sampler", {}))
+        args["scene_prompts"] = "\n".join(story["scenes"])
+        # 管线在同组的故事之间常驻显存，不在每个故事结束时移回 cpu
+        image, scene_prompts = self.sampler.story_sampler(model, keep_pipe_loaded=True, **args)
+        comic = None
+        if self.make_comic:
+            comic_args = {name: value for name, value in self.comic_defaults.items()
+                          if name not in ("image", "scene_prompts")}
+            comic_args["fonts_list"] = comic_args.get("fonts_list") or fonts_lists[0]
+            comic_args.update(story.get("comic", {}))
+            comic = self.comic.comic_gen(image, scene_prompts, **comic_args)[0]
+        return image, comic
+
+    def run(self, stories):
+        os.makedirs(self.output_dir, exist_ok=True)
+        groups = group_stories(stories, self.loader_defaults)
+        manifest_path = os.path.join(self.output_dir, "manifest.jsonl")
+        summary = {"stories": len(stories), "panels": 0, "failed": 0,
+                   "load_seconds": 0.0, "generate_seconds": 0.0, "jobs": []}
+        start = time.perf_counter()
+        with open(manifest_path, "w", encoding="utf-8") as manifest:
+            for group_index, (config, group) in enumerate(groups):
+                load_start = time.perf_counter()
+                model = self.load(config, group[0])
+                load_seconds = time.perf_counter() - load_start
+                summary["load_seconds"] += load_seconds
+                logging.info(f"model config {group_index}: loaded in {load_seconds:.1f}s, {len(group)} stories")
+                for story in group:
+                    job_start = time.perf_counter()
+                    record = {"id": story["id"], "model_config": group_index, "seed": story.get("seed"),
+                              "scenes": story["scenes"]}
+                    try:
+                        image, comic = self.generate(bind_story(model, story, config), story)
+                        panels, comic_path = write_story(self.output_dir, story, image, comic)
+                        record.update(status="ok", panels=panels, comic=comic_path)
+                        summary["panels"] += len(panels)
+                    except Exception as e:
+                        logging.exception(f"story {story['id']} failed")
+                        record.update(status="failed", error=repr(e))
+                        summary["failed"] += 1
+                    record["seconds"] = time.perf_counter() - job_start
+                    summary["generate_seconds"] += record["seconds"]
+                    summary["jobs"].append({"id": story["id"], "model_config": group_index,
+                                            "status": record["status"], "panels": len(record.get("panels", [])),
+                                            "seconds": record["seconds"]})
+                    manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    manifest.flush()
+                    print(f"{story['id']}: {record['status']} in {record['seconds']:.1f}s")
+                del model
+                torch.cuda.empty_cache()
+        summary["model_configs"] = [config for config, _ in groups]
+        summary["wall_seconds"] = time.perf_counter() - start
+        summary["panels_per_second"] = summary["panels"] / summary["generate_seconds"] if summary["generate_seconds"] else 0.0
+        summary["stories_per_hour"] = 3600 * len(stories) / summary["wall_seconds"] if summary["wall_seconds"] else 0.0
+        with open(os.path.join(self.output_dir, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"{len(stories)} stories, {summary['panels']} panels in {summary['wall_seconds']:.1f}s "
+              f"(load {summary['load_seconds']:.1f}s, {summary['panels_per_second']:.3f} panels/s), "
+              f"{summary['failed']} failed")
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a JSONL of stories with a resident StoryDiffusion pipeline")
+    parser.add_argument("stories", help="JSONL file, one story per line")
+    parser.add_argument("--output", default="story_batch", help="output directory")
+    parser.add_argument("--no-comic", action="store_true", help="only write the panels")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    summary = BatchRunner(args.output, make_comic=not args.no_comic).run(read_stories(args.stories))
+    if summary["failed"]:
+        raise SystemExit(f"{summary['failed']} stories failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -36,22 +36,22 @@ def load_pipeline(repo_id,unet_path,gpu_id=0):
         original_config_file = os.path.join(folder_paths.base_path, "custom_nodes/ComfyUI_StoryDiffusion/config/sd_xl_base.yaml")
         from safetensors.torch import load_file
         from diffusers.pipelines.stable_diffusion.convert_from_ckpt import convert_ldm_unet_checkpoint
-        state_dict = load_file(unet_path)
+        from ..utils.single_file_cache import cached_component, load_single_file
         unet_config = ConsistorySDXLUNet2DConditionModel.load_config(config_file)
         Unet = ConsistorySDXLUNet2DConditionModel.from_config(unet_config).to(device,torch.float16)
-        state_dict = convert_ldm_unet_checkpoint(state_dict, Unet.config)
+        cached_unet = cached_component(unet_path, "unet", float_type)
+        if cached_unet:  # 已转换过的 diffusers 权重
+            state_dict = load_file(cached_unet)
+        else:
+            state_dict = convert_ldm_unet_checkpoint(load_file(unet_path), Unet.config)
         Unet.load_state_dict(state_dict, strict=False)
         del state_dict
         clear_memory()
         scheduler = DDIMScheduler.from_pretrained(sdxl_repo, subfolder="scheduler")
-        try:
-            story_pipeline = ConsistoryExtendAttnSDXLPipeline.from_single_file(
-                unet_path,unet=Unet, config=sdxl_repo, original_config=original_config_file, torch_dtype=float_type, variant="fp16", use_safetensors=True, scheduler=scheduler
-            ).to(device)
-        except:
-            story_pipeline = ConsistoryExtendAttnSDXLPipeline.from_single_file(
-                unet_path, unet=Unet,config=sdxl_repo, original_config_file=original_config_file, torch_dtype=float_type, variant="fp16", use_safetensors=True, scheduler=scheduler
-            ).to(device)
+        story_pipeline = load_single_file(
+            ConsistoryExtendAttnSDXLPipeline, unet_path, config=sdxl_repo, original_config=original_config_file,
+            torch_dtype=float_type, unet=Unet, variant="fp16", use_safetensors=True, scheduler=scheduler
+        ).to(device)
        
     else:
         raise "need a repo or chocie a sdxl checkpoints"
@@ -1,6 +1,5 @@
 # !/usr/bin/env python
 # -*- coding: UTF-8 -*-
-import datetime
 import logging
 import os
 import sys
@@ -28,6 +27,8 @@ from .msdiffusion.models.model import MSAdapter
 from .msdiffusion.utils import get_phrase_idx, get_eot_idx
 from .utils.style_template import styles
 from .utils.load_models_utils import  get_lora_dict,get_instance_path
+from .utils.single_file_cache import load_single_file
+from .utils.lora_cache import fuse_lora_cached
 from .PuLID.pulid.utils import resize_numpy_image_long
 from transformers import AutoModel, AutoTokenizer
 from comfy.utils import common_upscale
@@ -124,6 +125,16 @@ def get_easy_function(easy_function, clip_vision, character_weights, ckpt_name,
     low_vram=False
     TAG_mode=False
     SD35_mode=False
+    bank_dtype="fp16"
+    bank_offload=False
+    bank_cache=True
+    consistency_profile="full"
+    token_selector="uniform"
+    attention_budget_mb=None
+    compile_unet=False
+    panel_reuse=True
+    model_cache=True
+    model_cache_gb=None
     if easy_function:
         easy_function = easy_function.strip().lower()
         if "auraface" in easy_function:
@@ -150,6 +161,33 @@ def get_easy_function(easy_function, clip_vision, character_weights, ckpt_name,
             low_vram=True
         if "tag" in easy_function:
             TAG_mode=True
+        if "bank_int8" in easy_function: # id_bank 量化保存，可支持更多角色
+            bank_dtype="int8"
+        if "bank_e4m3" in easy_function:
+            bank_dtype="fp8"
+        if "bank_offload" in easy_function: # id_bank 放在内存中按步分页，不限制角色数量
+            bank_offload=True
+        if "no_bank_cache" in easy_function: # 不使用自动缓存的角色权重
+            bank_cache=False
+        if "draft_consistency" in easy_function: # 只在部分步和层使用一致性注意力，更快
+            consistency_profile="draft"
+        # 参考 token 的选择方式，如 tokens_grid；tokens_crossref 按参考图之间的自注意力相似度选择，
+        # 不是按角色提示词 token 的交叉注意力(显著性)选择
+        for selector in ("grid", "crossref", "mask"):
+            if f"tokens_{selector}" in easy_function:
+                token_selector=selector
+        chunk_attn=re.search(r"chunk_attn(\d*)", easy_function) # 分块注意力的内存预算(MB)，如 chunk_attn512
+        if chunk_attn:
+            attention_budget_mb=int(chunk_attn.group(1)) if chunk_attn.group(1) else 1024
+        if "compile" in easy_function: # torch.compile 编译 UNet(图安全的一致性注意力处理器)
+            compile_unet=True
+        if "no_panel_reuse" in easy_function: # 每次都重新生成整个故事，不复用上一次没有变化的分镜
+            panel_reuse=False
+        if "no_model_cache" in easy_function: # 每次都从磁盘重新加载管线
+            model_cache=False
+        model_cache_size=re.search(r"model_cache(\d+)", easy_function) # 常驻管线的内存预算(GB)，如 model_cache24
+        if model_cache_size:
+            model_cache_gb=int(model_cache_size.group(1))
    
     if clip_vision != "none":
         clip_vision_path = folder_paths.get_full_path("clip_vision", clip_vision)
@@ -181,7 +219,7 @@ def get_easy_function(easy_function, clip_vision, character_weights, ckpt_name,
         else:
             raise "no support repo '/' in repo_id ,please change'\' to '/'"
     
-    return auraface, NF4, save_model, kolor_face, flux_pulid_name, pulid, quantized_mode, story_maker, make_dual_only, clip_vision_path, char_files, ckpt_path, lora, lora_path, use_kolor, photomake_mode, use_flux,onnx_provider,low_vram,TAG_mode,SD35_mode
+    return auraface, NF4, save_model, kolor_face, flux_pulid_name, pulid, quantized_mode, story_maker, make_dual_only, clip_vision_path, char_files, ckpt_path, lora, lora_path, use_kolor, photomake_mode, use_flux,onnx_provider,low_vram,TAG_mode,SD35_mode,bank_dtype,bank_offload,bank_cache,consistency_profile,token_selector,attention_budget_mb,compile_unet,panel_reuse,model_cache,model_cache_gb
 def pre_checkpoint(photomaker_path, photomake_mode, kolor_face, pulid, story_maker, clip_vision_path, use_kolor,
                    model_type):
     if photomake_mode == "v1":
@@ -317,6 +355,20 @@ def narry_list(list_in):
         modified_value = phi2narry(value)
         list_in[i] = modified_value
     return list_in
+def panels_to_tensor(panels, height, width, out_height, out_width):
+    """
+    把分镜(PIL 图像或图像列表)逐张写入预分配的 [N,out_height,out_width,3] float32 张量，
+    同时裁剪回输入尺寸；每张图只有一份 uint8 的临时数组，不再生成整批的 float32 中间结果。
+    """
+    images = []
+    for panel in panels:
+        images.extend(panel if isinstance(panel, (list, tuple)) else [panel])
+    output = torch.empty((len(images), out_height, out_width, 3), dtype=torch.float32)
+    for i, img in enumerate(images):
+        array = np.array(img, dtype=np.uint8).reshape(height, width, 3)
+        output[i].copy_(torch.from_numpy(array[:out_height, :out_width]))
+    return output.div_(255.0)
+
 def remove_punctuation_from_strings(lst):
     pattern = r"[\W]+$"  # 匹配字符串末尾的所有非单词字符
     return [re.sub(pattern, '', s) for s in lst]
@@ -413,17 +465,8 @@ def story_maker_loader(clip_load,clip_vision_path,dir_path,ckpt_path,face_adapte
     from .StoryMaker.pipeline_sdxl_storymaker import StableDiffusionXLStoryMakerPipeline
     original_config_file = os.path.join(dir_path, 'config', 'sd_xl_base.yaml')
     add_config = os.path.join(dir_path, "local_repo")
-    try:
-        pipe = StableDiffusionXLStoryMakerPipeline.from_single_file(
-            ckpt_path, config=add_config, original_config=original_config_file,
-            torch_dtype=torch.float16)
-    except:
-        try:
-            pipe = StableDiffusionXLStoryMakerPipeline.from_single_file(
-                ckpt_path, config=add_config, original_config_file=original_config_file,
-                torch_dtype=torch.float16)
-        except:
-            raise "load pipe error!,check you diffusers"
+    pipe = load_single_file(StableDiffusionXLStoryMakerPipeline, ckpt_path, config=add_config,
+                            original_config=original_config_file, torch_dtype=torch.float16)
     controlnet=None
     if controlnet_path:
         controlnet = ControlNetModel.from_unet(pipe.unet)
@@ -584,12 +627,11 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
                 if_repo,dir_path,clip,onnx_provider):
     # pip install optimum-quanto
     # https://gist.github.com/AmericanPresidentJimmyCarter/873985638e1f3541ba8b00137e7dacd9
-    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    weight_transformer = os.path.join(folder_paths.models_dir, "checkpoints", f"transformer_{timestamp}.pt")
+    # 量化后的 transformer 和 T5 缓存在 models/diffusers/storydiffusion_quanto，再次加载时不用重新量化
+    from .utils.quantized_cache import quantize_cached, artifact_path
     dtype = torch.bfloat16
     if not ckpt_path:
         logging.info("using repo_id ,start flux fp8 quantize processing...")
-        from optimum.quanto import freeze, qfloat8, quantize
         from diffusers.pipelines.flux.pipeline_flux import FluxPipeline
         from diffusers import FlowMatchEulerDiscreteScheduler
         from diffusers.models.transformers.transformer_flux import FluxTransformer2DModel
@@ -599,24 +641,21 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
                                                                     revision=revision)
         text_encoder = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14", torch_dtype=dtype)
         tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14", torch_dtype=dtype)
-        text_encoder_2 = T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2",
-                                                        torch_dtype=dtype,
-                                                        revision=revision)
+        text_encoder_2 = quantize_cached(
+            T5EncoderModel, "flux_t5", repo_id, subfolder="text_encoder_2", revision=revision,
+            load=lambda: T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2", torch_dtype=dtype,
+                                                        revision=revision))
         tokenizer_2 = T5TokenizerFast.from_pretrained(repo_id, subfolder="tokenizer_2",
                                                       torch_dtype=dtype,
                                                       revision=revision)
         vae = AutoencoderKL.from_pretrained(repo_id, subfolder="vae", torch_dtype=dtype,
                                             revision=revision)
-        transformer = FluxTransformer2DModel.from_pretrained(repo_id, subfolder="transformer",
-                                                             torch_dtype=dtype, revision=revision)
-        quantize(transformer, weights=qfloat8)
-        freeze(transformer)
-        if save_model:
-            print(f"saving fp8 pt on '{weight_transformer}'")
-            torch.save(transformer,
-                       weight_transformer)  # https://pytorch.org/tutorials/beginner/saving_loading_models.html.
-        quantize(text_encoder_2, weights=qfloat8)
-        freeze(text_encoder_2)
+        transformer = quantize_cached(
+            FluxTransformer2DModel, "flux_transformer", repo_id, subfolder="transformer", revision=revision,
+            load=lambda: FluxTransformer2DModel.from_pretrained(repo_id, subfolder="transformer", torch_dtype=dtype,
+                                                                revision=revision))
+        if save_model:  # 不再保存 torch.save 的 .pt，量化结果总是写入缓存
+            print(f"fp8 transformer is saved in '{artifact_path('flux_transformer', repo_id, 'transformer', revision)}'")
         if model_type == "img2img":
             # https://github.com/deforum-studio/flux/blob/main/flux_pipeline.py#L536
             from .utils.flux_pipeline import FluxImg2ImgPipeline
@@ -645,7 +684,6 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
     else:  # flux diff unet ,diff 0.30 ckpt or repo
         from diffusers import FluxTransformer2DModel, FluxPipeline
         from transformers import T5EncoderModel, CLIPTextModel
-        from optimum.quanto import freeze, qfloat8, quantize
         if pulid:
             logging.info("using repo_id and ckpt ,start flux-pulid processing...")
             from .PuLID.app_flux import FluxGenerator
@@ -676,16 +714,17 @@ def flux_loader(folder_paths,ckpt_path,repo_id,AutoencoderKL,save_model,model_ty
             else:
                 logging.info("using repo_id and ckpt ,start flux fp8 quantize processing...")
                 if os.path.splitext(ckpt_path)[-1] == ".pt":
+                    # 旧版本 save_model 保存的整个模块，换 torch/quanto 版本后可能无法读取
+                    logging.warning(f"loading the pickled transformer {ckpt_path}, reload it from the repo to get a cached quantized artifact.")
                     transformer = torch.load(ckpt_path)
                     transformer.eval()
                 else:
                     config_file = os.path.join(dir_path, "utils", "config.json")
                     transformer = FluxTransformer2DModel.from_single_file(ckpt_path, config=config_file,
                                                                           torch_dtype=dtype)
-                text_encoder_2 = T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2",
-                                                                torch_dtype=dtype)
-                quantize(text_encoder_2, weights=qfloat8)
-                freeze(text_encoder_2)
+                text_encoder_2 = quantize_cached(
+                    T5EncoderModel, "flux_t5", repo_id, subfolder="text_encoder_2",
+                    load=lambda: T5EncoderModel.from_pretrained(repo_id, subfolder="text_encoder_2", torch_dtype=dtype))
                 
                 if model_type == "img2img":
                     from .utils.flux_pipeline import FluxImg2ImgPipeline
@@ -847,17 +886,8 @@ def msdiffusion_main(image_1, image_2, prompts_dual, width, height, steps, seed,
         raise "no model"
     add_config = os.path.join(cur_path, "local_repo")
     if single_files:
-        try:
-            pipe = StableDiffusionXLPipeline.from_single_file(
-                ckpt_path, config=add_config, original_config=original_config_file,
-                torch_dtype=torch.float16)
-        except:
-            try:
-                pipe = StableDiffusionXLPipeline.from_single_file(
-                    ckpt_path, config=add_config, original_config_file=original_config_file,
-                    torch_dtype=torch.float16)
-            except:
-                raise "load pipe error!,check you diffusers"
+        pipe = load_single_file(StableDiffusionXLPipeline, ckpt_path, config=add_config,
+                                original_config=original_config_file, torch_dtype=torch.float16)
     else:
         pipe = StableDiffusionXLPipeline.from_pretrained(dif_repo, torch_dtype=torch.float16)
     
@@ -870,11 +900,9 @@ def msdiffusion_main(image_1, image_2, prompts_dual, width, height, steps, seed,
     
     if lora:
         if lora in lora_lightning_list:
-            pipe.load_lora_weights(lora_path)
-            pipe.fuse_lora()
+            fuse_lora_cached(pipe, lora_path)
         else:
-            pipe.load_lora_weights(lora_path, adapter_name=trigger_words)
-            pipe.fuse_lora(adapter_names=[trigger_words, ], lora_scale=lora_scale)
+            fuse_lora_cached(pipe, lora_path, lora_scale=lora_scale, adapter_name=trigger_words)
     pipe.scheduler = scheduler_choice.from_config(pipe.scheduler.config)
     pipe.enable_xformers_memory_efficient_attention()
     pipe.enable_freeu(s1=0.6, s2=0.4, b1=1.1, b2=1.2)
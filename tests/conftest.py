@@ -0,0 +1,72 @@
+import importlib
+import os
+import sys
+import types
+
+import pytest
+
+# 测试在 cpu 上运行，需要 ComfyUI 环境(folder_paths、comfy)。插件放在 ComfyUI/custom_nodes 下时
+# 自动找到 ComfyUI 根目录，否则用 COMFYUI_ROOT 环境变量指定，例如:
+#     COMFYUI_ROOT=/path/to/ComfyUI python -m pytest tests
+PACKAGE = "ComfyUI_StoryDiffusion"
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMFYUI_ROOT = os.environ.get("COMFYUI_ROOT", os.path.dirname(os.path.dirname(PACKAGE_DIR)))
+
+if COMFYUI_ROOT not in sys.path:
+    sys.path.insert(0, COMFYUI_ROOT)
+
+
+def import_module(name):
+    """Import a module of the plugin without running its top-level __init__ (which registers the nodes)."""
+    pytest.importorskip("torch")
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [PACKAGE_DIR]
+        sys.modules[PACKAGE] = package
+    try:
+        return importlib.import_module(f"{PACKAGE}.{name}")
+    except ModuleNotFoundError as e:
+        if e.name and e.name.split(".")[0] in ("folder_paths", "comfy"):
+            pytest.skip(f"needs a ComfyUI environment ({e.name}), set COMFYUI_ROOT")
+        raise
+
+
+def plugin_fixture(name):
+    """A session fixture that imports a module of the plugin, shared by the test files."""
+    @pytest.fixture(scope="session")
+    def fixture():
+        return import_module(name)
+    return fixture
+
+
+node = plugin_fixture("Storydiffusion_node")
+batch = plugin_fixture("batch")
+bank_utils = plugin_fixture("utils.bank_utils")
+character_bank = plugin_fixture("utils.character_bank")
+chunked_attention = plugin_fixture("utils.chunked_attention")
+compile_benchmark = plugin_fixture("utils.compile_benchmark")
+gradio_utils = plugin_fixture("utils.gradio_utils")
+lora_cache = plugin_fixture("utils.lora_cache")
+panel_stream = plugin_fixture("utils.panel_stream")
+prompt_cache = plugin_fixture("utils.prompt_cache")
+quantized_cache = plugin_fixture("utils.quantized_cache")
+token_selectors = plugin_fixture("utils.token_selectors")
+
+
+def tiny_unet():
+    """Two-level UNet with the SDXL block layout, small enough for cpu tests."""
+    pytest.importorskip("diffusers")
+    import torch
+    from diffusers import UNet2DConditionModel
+
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        sample_size=8,
+        block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        layers_per_block=1,
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=8,
+    ).eval()
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+TAYLOR = "[Taylor] a woman img, wearing a white T-shirt, blue loose hair."
+LECUN = "[Lecun] a man img, wearing a suit, black hair."
+
+
+def write_jsonl(path, stories):
+    path.write_text("\n".join(json.dumps(story) for story in stories) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def test_read_stories(batch, tmp_path):
+    path = write_jsonl(tmp_path / "stories.jsonl", [
+        {"id": "morning", "characters": [TAYLOR], "scenes": ["[Taylor] wake up", "[Taylor] have breakfast"]},
+        {"characters": f"{TAYLOR}\n{LECUN}", "scenes": "[Taylor] walk\n[Lecun] read"},
+    ])
+    stories = batch.read_stories(path)
+    assert [story["id"] for story in stories] == ["morning", "story_0001"]
+    # 多行字符串按行拆开
+    assert stories[1]["characters"] == [TAYLOR, LECUN]
+    assert stories[1]["scenes"] == ["[Taylor] walk", "[Lecun] read"]
+
+
+@pytest.mark.parametrize("stories", [
+    [{"characters": [TAYLOR]}],
+    [{"id": "a", "characters": [TAYLOR], "scenes": ["x"]}, {"id": "a", "characters": [TAYLOR], "scenes": ["y"]}],
+])
+def test_read_stories_rejects(batch, tmp_path, stories):
+    with pytest.raises(ValueError):
+        batch.read_stories(write_jsonl(tmp_path / "stories.jsonl", stories))
+
+
+def test_group_stories(batch):
+    defaults = batch.node_defaults(batch.Storydiffusion_Model_Loader)
+    stories = [
+        {"id": "a", "characters": [TAYLOR], "scenes": ["x"]},
+        {"id": "b", "characters": [LECUN], "scenes": ["y"], "model": {"lora_scale": 0.5}},
+        # 只有角色和尺寸不同的故事共用一次加载
+        {"id": "c", "characters": [LECUN], "scenes": ["z"], "width": 512},
+        {"id": "d", "characters": [TAYLOR], "scenes": ["w"], "model": {"sampler_name": "euler", "lora_scale": 0.5}},
+    ]
+    groups = batch.group_stories(stories, defaults)
+    assert [[story["id"] for story in group] for _, group in groups] == [["a", "c"], ["b", "d"]]
+    assert groups[1][0]["lora_scale"] == 0.5
+    assert "character_prompt" not in groups[0][0] and "width" not in groups[0][0]
+    with pytest.raises(ValueError):
+        batch.group_stories([{"id": "e", "characters": [TAYLOR], "scenes": ["x"], "model": {"steps": 20}}], defaults)
+
+
+def test_bind_story(batch):
+    config = {"trigger_words": "best quality"}
+    model = {"model_type": "txt2img", "width": 768, "height": 768, "lora": None, "pipe": object()}
+    story = {"id": "a", "characters": [TAYLOR, LECUN, "[Anna] a girl img"], "scenes": ["x"], "height": 512}
+    bound = batch.bind_story(model, story, config)
+    assert bound["role_name_list"] == ["[Taylor]", "[Lecun]", "[Anna]"]
+    assert bound["character_prompt"].splitlines() == story["characters"]
+    assert (bound["width"], bound["height"]) == (768, 512)
+    assert bound["pipe"] is model["pipe"] and "role_name_list" not in model
+    # fp16 的 id_bank 最多两个角色，量化后最多四个
+    assert bound["id_length"] == 2
+    assert batch.bind_story(dict(model, bank_dtype="int8"), story, config)["id_length"] == 3
+    with pytest.raises(ValueError):
+        batch.bind_story(dict(model, model_type="img2img"), story, config)
+
+
+def test_runner_writes_manifest_and_summary(batch, tmp_path, monkeypatch):
+    runner = batch.BatchRunner(str(tmp_path / "out"))
+    loads = []
+
+    def load(config, story):
+        loads.append(story["id"])
+        return {"model_type": "txt2img", "width": 64, "height": 64, "lora": None}
+
+    def generate(model, story):
+        if story["id"] == "broken":
+            raise RuntimeError("out of memory")
+        image = torch.rand((len(story["scenes"]), model["height"], model["width"], 3))
+        return image, torch.rand((1, 32, 48, 3))
+
+    monkeypatch.setattr(runner, "load", load)
+    monkeypatch.setattr(runner, "generate", generate)
+    stories = [
+        {"id": "a", "characters": [TAYLOR], "scenes": ["x", "y"], "seed": 1},
+        {"id": "broken", "characters": [TAYLOR], "scenes": ["x"]},
+        {"id": "c", "characters": [LECUN], "scenes": ["z"], "model": {"lora_scale": 0.5}},
+    ]
+    summary = runner.run(stories)
+    assert loads == ["a", "c"]
+    assert (summary["stories"], summary["panels"], summary["failed"]) == (3, 3, 1)
+    assert len(summary["model_configs"]) == 2
+    assert [(job["id"], job["status"], job["panels"]) for job in summary["jobs"]] == [
+        ("a", "ok", 2), ("broken", "failed", 0), ("c", "ok", 1)]
+
+    output = tmp_path / "out"
+    assert json.loads((output / "summary.json").read_text(encoding="utf-8"))["panels"] == 3
+    records = [json.loads(line) for line in (output / "manifest.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [record["id"] for record in records] == ["a", "broken", "c"]
+    assert records[0]["panels"] == ["a/panel_000.png", "a/panel_001.png"]
+    assert records[0]["comic"] == "a/comic.png" and records[0]["seed"] == 1
+    assert records[1]["status"] == "failed" and "out of memory" in records[1]["error"]
+    assert records[2]["model_config"] == 1
+    for record in (records[0], records[2]):
+        for path in record["panels"] + [record["comic"]]:
+            assert (output / path).is_file()
@@ -0,0 +1,67 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def test_lazy_steps_keep_device_copies(character_bank, tmp_path):
+    steps = {step: {"key": torch.randn(2, 8, 16), "value": torch.randn(2, 8, 16)} for step in range(2)}
+    id_bank = {"up.0": {"[A]": steps}}
+    path = str(tmp_path / f"A{character_bank.CHARACTER_BANK_SUFFIX}")
+    character_bank.save_character_bank(path, id_bank, "[A]", {})
+    bank_file = character_bank.CharacterBankFile(path)
+
+    host_steps = bank_file.steps("up.0")
+    device_steps = host_steps.copy(device="cpu")
+    assert device_steps.device == "cpu" and host_steps.device is None
+    first = device_steps[0]
+    torch.testing.assert_close(first["key"], steps[0]["key"])
+    # 同一层同一步在之后的场景和运行中不再重新读取、拷贝
+    assert device_steps[0]["key"] is first["key"]
+    assert device_steps.copy()[0]["key"] is first["key"]
+    assert sorted(device_steps) == [0, 1] and 1 in device_steps
+
+
+def make_bank(character, num_steps=2, tokens=8):
+    return {"up.0": {character: {step: {"key": torch.randn(2, tokens, 16), "value": torch.randn(2, tokens, 16)}
+                                 for step in range(num_steps)}}}
+
+
+def test_cache_key_depends_on_every_field(character_bank):
+    fields = dict(model={"repo_id": "sdxl"}, character="[A]", description="a man", ref_prompts=["a", "b"], seed=0)
+    key = character_bank.CharacterBankCache.key(**fields)
+    assert key == character_bank.CharacterBankCache.key(**dict(reversed(list(fields.items()))))
+    for name, value in (("description", "a woman"), ("ref_prompts", ["a", "c"]), ("seed", 1)):
+        assert character_bank.CharacterBankCache.key(**dict(fields, **{name: value})) != key
+
+
+def test_cache_keeps_reference_panels(character_bank, tmp_path):
+    from PIL import Image
+
+    cache = character_bank.CharacterBankCache(str(tmp_path))
+    panels = [[Image.new("RGB", (8, 8), "red"), Image.new("RGB", (8, 8), "blue")], None]
+    cache.store("key", make_bank("[A]"), "[A]", {"description": "a man"}, reference_panels=panels).join()
+    path = cache.lookup("key")
+    assert path is not None and cache.lookup("missing") is None
+    restored = character_bank.CharacterBankFile(path).reference_panels()
+    assert restored[1] is None and len(restored[0]) == 2
+    assert [image.getpixel((0, 0)) for image in restored[0]] == [(255, 0, 0), (0, 0, 255)]
+    # lookup 不计数，由调用方按是否跳过写入阶段记录
+    assert cache.stats() == {"hits": 0, "misses": 0}
+    cache.record(True)
+    cache.record(False)
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_cache_evicts_least_recently_used(character_bank, tmp_path):
+    import os
+
+    cache = character_bank.CharacterBankCache(str(tmp_path))
+    assert cache.max_bytes == 2 * 1024 ** 3
+    for index, key in enumerate(("a", "b", "c")):
+        cache.store(key, make_bank("[A]"), "[A]", {}).join()
+        os.utime(cache.path(key), (index, index))
+    size = os.path.getsize(cache.path("a"))
+    cache.lookup("a")  # 最近使用，保留
+    cache.max_bytes = 2 * size
+    cache.evict()
+    assert [key for key in ("a", "b", "c") if os.path.exists(cache.path(key))] == ["a", "c"]
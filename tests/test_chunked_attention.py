@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+BATCH, HEADS, QUERY_LENGTH, KEY_LENGTH, HEAD_DIM = 2, 2, 40, 200, 16
+# 一行 query 的注意力占 2 * 2 * 2 * 4 * 200 = 6400 字节
+BUDGETS = {"query_tiles": 51200, "key_tiles": 6000}
+
+
+def make_mask(kind, generator):
+    if kind is None:
+        return None
+    if kind == "bool":
+        mask = torch.rand((BATCH, 1, QUERY_LENGTH, KEY_LENGTH), generator=generator) > 0.5
+        mask[..., 0] = True  # 每行至少保留一个 key
+        return mask
+    return torch.randn((1, 1, 1, KEY_LENGTH), generator=generator)
+
+
+@pytest.mark.parametrize("budget", list(BUDGETS))
+@pytest.mark.parametrize("mask_kind", [None, "bool", "float"])
+def test_chunked_matches_sdpa(chunked_attention, budget, mask_kind):
+    F = torch.nn.functional
+    generator = torch.Generator().manual_seed(0)
+    query = torch.randn((BATCH, HEADS, QUERY_LENGTH, HEAD_DIM), generator=generator)
+    key = torch.randn((BATCH, HEADS, KEY_LENGTH, HEAD_DIM), generator=generator)
+    value = torch.randn((BATCH, HEADS, KEY_LENGTH, HEAD_DIM), generator=generator)
+    attn_mask = make_mask(mask_kind, generator)
+    query_tile, key_tile = chunked_attention.tile_sizes(query, key, BUDGETS[budget])
+    assert query_tile < QUERY_LENGTH if budget == "query_tiles" else key_tile < KEY_LENGTH
+
+    chunked = chunked_attention.chunked_scaled_dot_product_attention(
+        query, key, value, attn_mask=attn_mask, memory_budget=BUDGETS[budget]
+    )
+    reference = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask)
+    torch.testing.assert_close(chunked, reference, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from conftest import tiny_unet
+
+
+def test_read_phase_has_no_graph_breaks(compile_benchmark):
+    graph_breaks, error = compile_benchmark.check_graph_breaks(num_steps=2)
+    assert graph_breaks == 0
+    assert error < 1e-5
+
+
+def test_write_phase_runs_uncompiled(node, compile_benchmark):
+    unet = tiny_unet()
+
+    class Pipe:
+        def __init__(self):
+            self.unet = torch.compile(unet, backend="eager")
+            self.called_with = []
+
+        def __call__(self):
+            self.called_with.append(self.unet)
+
+    pipe = Pipe()
+    compiled = pipe.unet
+    node.set_attention_processor(unet, id_length=2, graph_safe=True)
+    story_context = node.StoryAttentionContext(unet, 2, 0.5, 0.5, 64, 64, num_steps=2, device="cpu",
+                                               dtype=torch.float32)
+    story_pipe = node.StoryContextPipe(pipe, story_context)
+    story_context.start(["[character]"], write=True)
+    story_pipe()
+    story_context.start(["[character]"], write=False)
+    story_pipe()
+    assert pipe.called_with == [unet, compiled]
+    assert pipe.unet is compiled
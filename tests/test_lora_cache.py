@@ -0,0 +1,152 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+from conftest import tiny_unet
+
+
+def make_pipe(unet):
+    from diffusers.loaders import StableDiffusionXLLoraLoaderMixin
+
+    class Pipe(StableDiffusionXLLoraLoaderMixin):
+        """Just the LoRA loading part of an SDXL pipeline."""
+
+        def __init__(self):
+            self.unet = unet
+            self.text_encoder = None
+            self.text_encoder_2 = None
+            self.hf_device_map = None
+            self.components = {}
+
+    return Pipe()
+
+
+def save_lora(unet, directory, target_modules):
+    from diffusers.loaders import StableDiffusionXLLoraLoaderMixin
+    from diffusers.utils import convert_state_dict_to_diffusers
+    from peft import LoraConfig
+    from peft.utils import get_peft_model_state_dict
+
+    unet.add_adapter(LoraConfig(r=4, lora_alpha=8, target_modules=target_modules, init_lora_weights=False),
+                     adapter_name="source")
+    state_dict = convert_state_dict_to_diffusers(get_peft_model_state_dict(unet, adapter_name="source"))
+    unet.delete_adapters("source")
+    StableDiffusionXLLoraLoaderMixin.save_lora_weights(directory, unet_lora_layers=state_dict)
+    return os.path.join(directory, "pytorch_lora_weights.safetensors")
+
+
+def base_weights(lora_cache, unet, layers):
+    components = {"unet": unet}
+    return {name: lora_cache.base_weight(components, f"unet.{name}").detach().clone() for name in layers}
+
+
+def test_fuse_keeps_other_adapters_and_matches_peft(lora_cache, tmp_path, monkeypatch):
+    from peft.tuners.tuners_utils import BaseTunerLayer
+
+    monkeypatch.setattr(lora_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    lora_cache.lora_delta_lru.clear()
+    unet = tiny_unet()
+    layers = [name for name, module in unet.named_modules() if isinstance(module, (torch.nn.Linear, torch.nn.Conv2d))]
+    photomaker = save_lora(unet, str(tmp_path / "photomaker"), ["to_q", "to_k"])
+    lora_path = save_lora(unet, str(tmp_path / "user"), ["to_q", "to_v", "conv1", "conv2"])
+
+    # peft 直接融合的结果作为参考
+    reference_pipe = make_pipe(tiny_unet())
+    reference_pipe.load_lora_weights(lora_path, adapter_name="user")
+    reference_pipe.fuse_lora(adapter_names=["user"], lora_scale=0.7)
+    reference = base_weights(lora_cache, reference_pipe.unet, layers)
+
+    pipe = make_pipe(unet)
+    pipe.load_lora_weights(photomaker, adapter_name="photomaker")
+    original = base_weights(lora_cache, unet, layers)
+    lora_cache.fuse_lora_cached(pipe, lora_path, lora_scale=0.7)
+
+    # PhotoMaker 的 adapter 没有被卸载，仍然是激活的
+    assert list(unet.peft_config) == ["photomaker"]
+    assert {tuple(module.active_adapters) for module in unet.modules()
+            if isinstance(module, BaseTunerLayer) and "photomaker" in module.lora_A} == {("photomaker",)}
+    # 缓存的是低秩因子，不是稠密的权重差
+    assert all(key.endswith(lora_cache.FACTOR_SUFFIXES) for key in pipe.fused_lora["deltas"])
+    fused = base_weights(lora_cache, unet, layers)
+    for name, weight in reference.items():
+        torch.testing.assert_close(fused[name], weight, rtol=1e-5, atol=1e-5)
+    assert any(not torch.equal(fused[name], original[name]) for name in fused)
+
+    # 换 scale 后恢复底模
+    lora_cache.set_lora_scale(pipe, 0.3)
+    assert lora_cache.swap_lora(pipe, None)
+    restored = base_weights(lora_cache, unet, layers)
+    for name, weight in original.items():
+        torch.testing.assert_close(restored[name], weight, rtol=1e-5, atol=1e-5)
+
+    # 第二次从缓存文件读取，不再经过 peft
+    lora_cache.lora_delta_lru.clear()
+    assert os.path.exists(lora_cache.delta_path(pipe, lora_path))
+    lora_cache.fuse_lora_cached(pipe, lora_path, lora_scale=0.7)
+    fused = base_weights(lora_cache, unet, layers)
+    for name, weight in reference.items():
+        torch.testing.assert_close(fused[name], weight, rtol=1e-5, atol=1e-5)
+
+
+def test_set_lora_scale_without_fused_lora(lora_cache):
+    with pytest.raises(RuntimeError):
+        lora_cache.set_lora_scale(make_pipe(tiny_unet()), 0.5)
+
+
+def test_swaps_restore_the_fp16_base_exactly(lora_cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(lora_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    lora_cache.lora_delta_lru.clear()
+    unet = tiny_unet()
+    layers = [name for name, module in unet.named_modules() if isinstance(module, (torch.nn.Linear, torch.nn.Conv2d))]
+    lora_a = save_lora(unet, str(tmp_path / "a"), ["to_q", "to_v", "conv1"])
+    lora_b = save_lora(unet, str(tmp_path / "b"), ["to_q", "to_k", "conv2"])
+    unet.half()
+    pipe = make_pipe(unet)
+    original = base_weights(lora_cache, unet, layers)
+
+    lora_cache.fuse_lora_cached(pipe, lora_a, lora_scale=0.7)
+    fused_a = base_weights(lora_cache, unet, layers)
+    # A -> B -> A 来回切换，fp16 下先加后减会累积舍入误差，拷回原始权重则完全一致
+    for _ in range(4):
+        lora_cache.fuse_lora_cached(pipe, lora_b, lora_scale=0.9)
+        lora_cache.set_lora_scale(pipe, 0.4)
+        lora_cache.fuse_lora_cached(pipe, lora_a, lora_scale=0.7)
+        again = base_weights(lora_cache, unet, layers)
+        assert all(torch.equal(again[name], fused_a[name]) for name in layers)
+    assert lora_cache.swap_lora(pipe, None)
+    restored = base_weights(lora_cache, unet, layers)
+    assert all(torch.equal(restored[name], original[name]) for name in layers)
+    # 只保存被 LoRA 改动过的层
+    assert set(pipe.lora_base_weights) == {key[:-len(".lora_A")] for factors in (
+        lora_cache.load_deltas(pipe, lora_a), lora_cache.load_deltas(pipe, lora_b)) for key in factors
+        if key.endswith(".lora_A")}
+
+
+def test_sampler_alternates_two_loras_on_a_resident_pipe(node, lora_cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(lora_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    lora_cache.lora_delta_lru.clear()
+    unet = tiny_unet()
+    layers = [name for name, module in unet.named_modules() if isinstance(module, (torch.nn.Linear, torch.nn.Conv2d))]
+    loras = {
+        "a.safetensors": (save_lora(unet, str(tmp_path / "a"), ["to_q", "to_v", "conv1"]), 0.7),
+        "b.safetensors": (save_lora(unet, str(tmp_path / "b"), ["to_q", "to_out.0", "conv2"]), 0.9),
+        None: (None, 0.8),
+    }
+    unet.half()
+    pipe = make_pipe(unet)
+    pipe.lora_swap = True
+    expected = {None: base_weights(lora_cache, unet, layers)}
+    # 两个加载节点共用一个常驻管线，采样节点按顺序交替使用各自的 LoRA，中间夹着不带 LoRA 的加载节点
+    for _ in range(3):
+        for lora in ("a.safetensors", "b.safetensors", None, "b.safetensors", "a.safetensors"):
+            lora_path, lora_scale = loras[lora]
+            node.bind_resident_lora(pipe, lora, lora_path, lora_scale, "best quality")
+            weights = base_weights(lora_cache, unet, layers)
+            expected.setdefault(lora, weights)
+            assert all(torch.equal(weights[name], expected[lora][name]) for name in layers)
+            assert pipe.prompt_cache_state == ((lora_path, lora_scale, "best quality") if lora else None)
+    assert any(not torch.equal(expected["a.safetensors"][name], expected[None][name]) for name in layers)
+    assert any(not torch.equal(expected["b.safetensors"][name], expected[None][name]) for name in layers)
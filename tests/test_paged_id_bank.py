@@ -0,0 +1,56 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def make_bank(paged, attn_names=("up.0", "up.1"), characters=("[A]", "[B]"), num_steps=4):
+    generator = torch.Generator().manual_seed(0)
+    id_bank = {}
+    for attn_name in attn_names:
+        id_bank[attn_name] = {}
+        for character in characters:
+            id_bank[attn_name][character] = {
+                step: paged.offload({"key": torch.randn(2, 8, 16, generator=generator),
+                                     "value": torch.randn(2, 8, 16, generator=generator)})
+                for step in range(num_steps)
+            }
+    return id_bank
+
+
+def test_paged_bank_prefetch_and_release(bank_utils):
+    paged = bank_utils.PagedIdBank(bank_utils.get_bank_device("cpu"), prefetch_steps=1)
+    id_bank = make_bank(paged)
+    paged.advance(id_bank, ["[A]"], 0)
+    assert sorted(paged.resident) == [0, 1]
+    # 只预取当前场景的角色
+    assert {key[1] for key in paged.resident[0]} == {"[A]"}
+
+    paged.advance(id_bank, ["[A]"], 2)
+    assert sorted(paged.resident) == [2, 3]
+    for attn_name in id_bank:
+        entry = paged.get(id_bank, attn_name, "[A]", 2)
+        assert entry["key"].device.type == "cpu"
+        torch.testing.assert_close(entry["key"], id_bank[attn_name]["[A]"][2]["key"])
+        torch.testing.assert_close(entry["value"], id_bank[attn_name]["[A]"][2]["value"])
+    assert paged.hits == 2 and paged.misses == 0
+
+
+def test_paged_bank_miss_falls_back_to_sync_copy(bank_utils):
+    paged = bank_utils.PagedIdBank(bank_utils.get_bank_device("cpu"), prefetch_steps=0)
+    id_bank = make_bank(paged)
+    paged.advance(id_bank, ["[A]"], 1)
+    assert sorted(paged.resident) == [1]
+    entry = paged.get(id_bank, "up.0", "[B]", 1)
+    torch.testing.assert_close(entry["key"], id_bank["up.0"]["[B]"][1]["key"])
+    assert paged.misses == 1
+    paged.reset()
+    assert paged.resident == {}
+
+
+def test_paged_bank_quantized_entries(bank_utils):
+    paged = bank_utils.PagedIdBank(bank_utils.get_bank_device("cpu"))
+    entry = {"key": torch.randn(2, 8, 16), "value": torch.randn(2, 8, 16)}
+    id_bank = {"up.0": {"[A]": {0: paged.offload(bank_utils.pack_entry(entry, "int8"))}}}
+    paged.advance(id_bank, ["[A]"], 0)
+    restored = bank_utils.unpack_entry(paged.get(id_bank, "up.0", "[A]", 0), torch.float32)
+    torch.testing.assert_close(restored["key"], entry["key"], rtol=0, atol=entry["key"].abs().max().item() / 100)
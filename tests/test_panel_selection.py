@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("torch")
+
+
+def test_parse_panel_selection(gradio_utils):
+    assert gradio_utils.parse_panel_selection("1, 3，5-7;3", 8) == [0, 2, 4, 5, 6]
+    assert gradio_utils.parse_panel_selection("", 8) == []
+
+
+@pytest.mark.parametrize("text", ["a", "2-x", "0", "9", "5-3"])
+def test_parse_panel_selection_rejects(gradio_utils, text):
+    with pytest.raises(ValueError):
+        gradio_utils.parse_panel_selection(text, 8)
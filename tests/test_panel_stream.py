@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+
+def image():
+    return Image.new("RGB", (8, 8))
+
+
+def test_reference_batch_counts_every_image(panel_stream):
+    # SDXL 文生图: 角色的两张参考图作为一批存在第一个参考分镜的位置
+    refs, scenes = [image(), image()], [image(), image()]
+    streamer = panel_stream.PanelStreamer(4)
+    streamer.consume([[refs], [refs, scenes[0]], [refs, scenes[0], scenes[1]]])
+    assert (streamer.done, streamer.total) == (4, 4)
+
+
+def test_refined_reference_grows_the_total(panel_stream):
+    # 精修模式只选了一个参考分镜，但返回整批参考图
+    refs = [image(), image()]
+    streamer = panel_stream.PanelStreamer(1)
+    streamer.consume([[refs]])
+    assert (streamer.done, streamer.total) == (2, 2)
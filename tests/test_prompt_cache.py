@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+diffusers = pytest.importorskip("diffusers")
+transformers = pytest.importorskip("transformers")
+
+from conftest import PACKAGE_DIR, tiny_unet
+
+# SD3.5 配置里带的 CLIP 分词器，测试不需要下载
+TOKENIZER_DIR = os.path.join(PACKAGE_DIR, "config", "stable-diffusion-3.5-large", "tokenizer")
+PROMPTS = ["a man in a red coat, walking", "a man in a red coat, reading"]
+
+
+def tiny_sdxl(force_zeros_for_empty_prompt=True, pipeline_class=None):
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLPipeline
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+    tokenizer = CLIPTokenizer.from_pretrained(TOKENIZER_DIR)
+    config = CLIPTextConfig(
+        vocab_size=tokenizer.vocab_size, hidden_size=16, intermediate_size=32, num_attention_heads=2,
+        num_hidden_layers=3, max_position_embeddings=tokenizer.model_max_length, projection_dim=16,
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(config).eval()
+    text_encoder_2 = CLIPTextModelWithProjection(config).eval()
+    vae = AutoencoderKL(block_out_channels=(8,), norm_num_groups=8, latent_channels=4)
+    pipeline_class = pipeline_class or StableDiffusionXLPipeline
+    return pipeline_class(
+        vae=vae, text_encoder=text_encoder, text_encoder_2=text_encoder_2, tokenizer=tokenizer,
+        tokenizer_2=tokenizer, unet=tiny_unet(), scheduler=EulerDiscreteScheduler(),
+        force_zeros_for_empty_prompt=force_zeros_for_empty_prompt,
+    )
+
+
+def encode(pipe, prompt, negative_prompt, **kwargs):
+    with torch.no_grad():
+        return pipe.encode_prompt(
+            prompt=prompt, device=torch.device("cpu"), num_images_per_prompt=2,
+            do_classifier_free_guidance=True, negative_prompt=negative_prompt, **kwargs
+        )
+
+
+def assert_same(cached, reference):
+    assert len(cached) == len(reference)
+    for got, expected in zip(cached, reference):
+        # 缓存逐条编码，和整批编码相比只有批大小带来的浮点误差(约 1e-7)
+        torch.testing.assert_close(got, expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("force_zeros_for_empty_prompt", [True, False])
+@pytest.mark.parametrize("negative_prompt", [None, "", ["blurry", "lowres, bad hands"]])
+def test_cached_encode_prompt_matches_sdxl(prompt_cache, force_zeros_for_empty_prompt, negative_prompt):
+    pipe = tiny_sdxl(force_zeros_for_empty_prompt)
+    reference = encode(pipe, PROMPTS, negative_prompt)
+    cache = prompt_cache.PromptEmbedCache()
+    prompt_cache.install_prompt_cache(pipe, cache=cache)
+    assert_same(encode(pipe, PROMPTS, negative_prompt), reference)
+    # 第二次全部命中缓存，结果不变
+    misses = cache.misses
+    assert_same(encode(pipe, PROMPTS, negative_prompt), reference)
+    assert cache.misses == misses and cache.hits > 0
+
+
+def test_cached_encode_prompt_clip_skip(prompt_cache):
+    pipe = tiny_sdxl()
+    reference = encode(pipe, PROMPTS, "blurry", clip_skip=1)
+    prompt_cache.install_prompt_cache(pipe, cache=prompt_cache.PromptEmbedCache())
+    assert_same(encode(pipe, PROMPTS, "blurry", clip_skip=1), reference)
+
+
+def test_overridden_encode_prompt_is_cached_per_call(prompt_cache):
+    from diffusers import StableDiffusionXLPipeline
+
+    class NegativeScaled(StableDiffusionXLPipeline):
+        # 负面分支和正面分支不同的 encode_prompt，不能按文本拆开缓存
+        def encode_prompt(self, *args, **kwargs):
+            embeds, negative, pooled, negative_pooled = super().encode_prompt(*args, **kwargs)
+            return embeds, negative * 0.5, pooled, negative_pooled * 0.5
+
+    pipe = tiny_sdxl(pipeline_class=NegativeScaled)
+    reference = encode(pipe, PROMPTS, "blurry")
+    cache = prompt_cache.PromptEmbedCache()
+    prompt_cache.install_prompt_cache(pipe, cache=cache)
+    assert_same(encode(pipe, PROMPTS, "blurry"), reference)
+    assert_same(encode(pipe, PROMPTS, "blurry"), reference)
+    assert (cache.hits, cache.misses) == (1, 1)
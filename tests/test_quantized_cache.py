@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+huggingface_hub = pytest.importorskip("huggingface_hub")
+
+
+def fake_cache(commit):
+    def try_to_load_from_cache(repo_id, filename, revision=None):
+        return os.path.join("hub", "models--org--flux", "snapshots", commit, *filename.split("/"))
+    return try_to_load_from_cache
+
+
+def test_hub_fingerprint_follows_the_snapshot(quantized_cache, monkeypatch):
+    monkeypatch.setattr(huggingface_hub, "try_to_load_from_cache", fake_cache("1111"))
+    assert quantized_cache.snapshot_commit("org/flux", "transformer") == "1111"
+    assert quantized_cache.snapshot_commit("org/flux") == "1111"
+    old = quantized_cache.source_fingerprint("org/flux", "transformer")
+    monkeypatch.setattr(huggingface_hub, "try_to_load_from_cache", fake_cache("2222"))
+    assert quantized_cache.source_fingerprint("org/flux", "transformer") != old
+
+
+def test_unresolved_snapshot_keeps_the_repo_key(quantized_cache, monkeypatch):
+    class OfflineApi:
+        def model_info(self, repo_id, revision=None):
+            raise OSError("offline")
+
+    monkeypatch.setattr(huggingface_hub, "try_to_load_from_cache", lambda *args, **kwargs: None)
+    monkeypatch.setattr(huggingface_hub, "HfApi", OfflineApi)
+    assert quantized_cache.snapshot_commit("org/flux", "transformer") is None
+    assert quantized_cache.source_fingerprint("org/flux", "transformer") == \
+        quantized_cache.source_fingerprint("org/flux", "transformer")
@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def test_group_read_batches_keeps_order(gradio_utils):
+    inds = [3, 4, 5, 6, 7, 8, 9]
+    characters = [["[A]"], ["[B]"], ["[A]"], ["[A]", "[B]"], ["[A]"], ["[B]"], ["[A]"]]
+    batches = gradio_utils.group_read_batches(inds, characters, 2)
+    assert batches == [
+        ([3, 5], ["[A]"]),
+        ([7, 9], ["[A]"]),
+        ([4, 8], ["[B]"]),
+        ([6], ["[A]", "[B]"]),
+    ]
+    # 每个场景只出现一次
+    assert sorted(ind for batch_inds, _ in batches for ind in batch_inds) == inds
+
+
+def test_group_read_batches_batch_size_one(gradio_utils):
+    inds = [0, 1, 2]
+    characters = [["[A]"], ["[B]"], ["[A]"]]
+    assert gradio_utils.group_read_batches(inds, characters, 1) == [
+        ([0], ["[A]"]), ([2], ["[A]"]), ([1], ["[B]"])
+    ]
+
+
+def test_batched_generators_match_single_seed():
+    # 批次里每个场景一个同种子的 generator，初始噪声与逐个采样时相同
+    from diffusers.utils.torch_utils import randn_tensor
+
+    shape = (1, 4, 8, 8)
+    single = randn_tensor(shape, generator=torch.Generator().manual_seed(42))
+    batched = randn_tensor((3,) + shape[1:], generator=[torch.Generator().manual_seed(42) for _ in range(3)])
+    for latents in batched:
+        torch.testing.assert_close(latents, single[0], rtol=0, atol=0)
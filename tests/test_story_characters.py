@@ -0,0 +1,64 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from conftest import tiny_unet
+
+CHARACTERS = ["[A] a man", "[B] a woman", "[C] a dog"]
+
+
+def write_characters(node, character_prompt, bank_dtype="fp16", bank_offload=False, num_steps=2, size=64):
+    """Run the write phase of every character of the prompt on a tiny UNet, returns the story context."""
+    id_length = node.story_id_length(character_prompt, bank_dtype, bank_offload)
+    unet = tiny_unet()
+    node.set_attention_processor(unet, id_length=id_length)
+    story_context = node.StoryAttentionContext(unet, id_length, 0.5, 0.5, size, size, num_steps=num_steps,
+                                               bank_dtype=bank_dtype, bank_offload=bank_offload,
+                                               device="cpu", dtype=torch.float32)
+    generator = torch.Generator().manual_seed(0)
+    latent = size // 8
+    with torch.no_grad():
+        for line in character_prompt.splitlines():
+            story_context.start([line.split()[0]], write=True)
+            with story_context:
+                for step in range(num_steps):
+                    unet(torch.randn((2 * id_length, 4, latent, latent), generator=generator), step,
+                         encoder_hidden_states=torch.randn((2 * id_length, 7, 32), generator=generator))
+    return story_context
+
+
+@pytest.mark.parametrize("bank_dtype, bank_offload, expected", [
+    ("fp16", False, 2), ("int8", False, 4), ("fp8", False, 4), ("fp16", True, None),
+])
+def test_max_story_characters(node, bank_dtype, bank_offload, expected):
+    assert node.max_story_characters(bank_dtype, bank_offload) == expected
+
+
+def test_id_length_follows_the_bank(node):
+    five = "\n".join(CHARACTERS + ["[D] a cat", "[E] a bird"])
+    assert node.story_id_length(five) == 2
+    assert node.story_id_length(five, "int8") == 4
+    assert node.story_id_length(five, "fp16", bank_offload=True) == 5
+
+
+def test_three_characters_written_with_int8_bank(node):
+    story_context = write_characters(node, "\n".join(CHARACTERS), bank_dtype="int8")
+    assert story_context.id_length == 3
+    for attn_name, characters in story_context.id_bank.items():
+        assert sorted(characters) == ["[A]", "[B]", "[C]"]
+        for steps in characters.values():
+            assert sorted(steps) == [0, 1]
+            assert steps[0]["key"].dtype == torch.int8
+
+
+def test_offloaded_bank_pages_more_than_two_characters(node):
+    story_context = write_characters(node, "\n".join(CHARACTERS), bank_offload=True)
+    assert story_context.id_length == 3
+    pager = story_context.pager
+    attn_name = next(iter(story_context.id_bank))
+    for character in ("[A]", "[B]", "[C]"):
+        story_context.start([character], write=False)
+        assert {key[1] for key in pager.resident[0]} == {character}
+        entry = story_context.fetch(attn_name, character, 0)
+        torch.testing.assert_close(entry["key"], story_context.id_bank[attn_name][character][0]["key"])
+    assert pager.misses == 0
@@ -0,0 +1,71 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+STEPS, IMAGES, ROWS, COLS, K = 3, 2, 8, 12, 20
+
+
+def check_indices(indices, leading):
+    assert indices.shape == (*leading, K)
+    assert indices.dtype == torch.long
+    assert int(indices.min()) >= 0 and int(indices.max()) < ROWS * COLS
+    # 每张图 k 个升序且不重复的索引
+    assert bool((indices[..., 1:] > indices[..., :-1]).all())
+
+
+@pytest.mark.parametrize("name", ["uniform", "grid"])
+def test_static_selector_shape_and_determinism(token_selectors, name):
+    selector = token_selectors.get_token_selector(name)
+    assert not selector.dynamic
+
+    def sample(seed):
+        generator = torch.Generator().manual_seed(seed)
+        return selector.sample(generator, STEPS, IMAGES, ROWS, COLS, K)
+
+    indices = sample(0)
+    check_indices(indices, (STEPS, IMAGES))
+    assert torch.equal(indices, sample(0))
+    assert not torch.equal(indices, sample(1))
+
+
+def test_grid_selector_spreads_over_the_image(token_selectors):
+    generator = torch.Generator().manual_seed(0)
+    indices = token_selectors.get_token_selector("grid").sample(generator, STEPS, IMAGES, ROWS, COLS, K)
+    rows = indices // COLS
+    # 网格覆盖整张图，而不是聚在一角
+    assert int(rows.min()) <= 1 and int(rows.max()) >= ROWS - 2
+
+
+def subject_hidden_states(generator, channel=16):
+    """Background tokens around a centred subject block, each with its own feature direction."""
+    background, subject = torch.randn((2, channel), generator=generator)
+    hidden_states = background.repeat(IMAGES, ROWS * COLS, 1)
+    mask = torch.zeros((ROWS, COLS), dtype=torch.bool)
+    mask[2:6, 3:9] = True
+    hidden_states[:, mask.flatten()] = subject
+    hidden_states = hidden_states + 0.05 * torch.randn(hidden_states.shape, generator=generator)
+    return hidden_states, mask.flatten()
+
+
+def test_mask_selector_shape_and_determinism(token_selectors):
+    selector = token_selectors.get_token_selector("mask")
+    assert selector.dynamic
+    hidden_states, subject = subject_hidden_states(torch.Generator().manual_seed(0))
+    indices = selector.select(hidden_states, K, ROWS, COLS)
+    check_indices(indices, (IMAGES,))
+    assert torch.equal(indices, selector.select(hidden_states.clone(), K, ROWS, COLS))
+    # 主体有 24 个 token，k=20 时全部落在主体内
+    assert bool(subject[indices].all())
+
+
+def test_mask_selector_tops_up_small_subjects(token_selectors):
+    hidden_states, subject = subject_hidden_states(torch.Generator().manual_seed(0))
+    k = int(subject.sum()) + 10
+    indices = token_selectors.get_token_selector("mask").select(hidden_states, k, ROWS, COLS)
+    assert indices.shape == (IMAGES, k)
+    assert bool(subject[indices].sum(dim=-1).eq(int(subject.sum())).all())
+
+
+def test_unknown_selector(token_selectors):
+    with pytest.raises(ValueError):
+        token_selectors.get_token_selector("saliency")
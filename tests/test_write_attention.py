@@ -0,0 +1,36 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def per_image_write(processor, attn, hidden_states, indices):
+    """The write phase before batching: one __call2__ per reference image."""
+    _, img_nums, _, _ = hidden_states.shape
+    outputs = []
+    for img_ind in range(img_nums):
+        others = torch.cat(
+            [hidden_states[:, ind, indices[ind], :] for ind in range(img_nums) if ind != img_ind], dim=1
+        )
+        own = hidden_states[:, img_ind]
+        outputs.append(processor.__call2__(
+            attn, own, own, None, None, cached_key=[attn.to_k(others)], cached_value=[attn.to_v(others)]
+        ))
+    return torch.stack(outputs, dim=1)
+
+
+@pytest.mark.parametrize("img_nums", [2, 3])
+def test_batched_write_matches_per_image(node, img_nums):
+    from diffusers.models.attention_processor import Attention
+
+    torch.manual_seed(0)
+    channel, nums_token = 64, 16
+    attn = Attention(query_dim=channel, heads=4, dim_head=16).eval()
+    processor = node.SpatialAttnProcessor2_0(hidden_size=channel, id_length=img_nums, device="cpu",
+                                             dtype=torch.float32, name="attn1")
+    hidden_states = torch.randn(2, img_nums, nums_token, channel)
+    generator = torch.Generator().manual_seed(0)
+    indices = [torch.randperm(nums_token, generator=generator)[:6] for _ in range(img_nums)]
+    with torch.no_grad():
+        batched = processor.__call_write__(attn, hidden_states, indices)
+        reference = per_image_write(processor, attn, hidden_states, indices)
+    torch.testing.assert_close(batched, reference, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,243 @@
+import logging
+import torch
+
+# id_bank 条目的存储格式: "fp16" 原样保存，"int8" / "fp8" 按通道量化并保存 scale
+BANK_DTYPES = ["fp16", "int8", "fp8"]
+INT8_MAX = 127.0
+FP8_MAX = 448.0
+
+
+def quantize_tensor(tensor, bank_dtype):
+    """
+    按通道(最后一维)量化 (2, tokens, channel) 的 key/value。
+    返回 (quantized, scale)，scale 形状为 (2, 1, channel)。
+    """
+    scale = tensor.abs().amax(dim=1, keepdim=True).float().clamp(min=1e-8)
+    if bank_dtype == "int8":
+        quantized = torch.round(tensor.float() / scale * INT8_MAX).clamp(-INT8_MAX, INT8_MAX).to(torch.int8)
+    elif bank_dtype == "fp8":
+        if not hasattr(torch, "float8_e4m3fn"):
+            raise ImportError("fp8 id_bank requires torch>=2.1, please use int8 instead.")
+        quantized = (tensor.float() / scale * FP8_MAX).to(torch.float8_e4m3fn)
+    else:
+        raise ValueError(f"unsupported id_bank dtype:{bank_dtype}")
+    return quantized, scale.to(torch.float16)
+
+
+def dequantize_tensor(quantized, scale, dtype=torch.float16):
+    if quantized.dtype == torch.int8:
+        return (quantized.to(dtype) * scale.to(dtype)) / INT8_MAX
+    return (quantized.to(dtype) * scale.to(dtype)) / FP8_MAX
+
+
+def pack_entry(entry, bank_dtype):
+    """把 {"key","value"} 转成 id_bank 的存储格式。"""
+    if bank_dtype == "fp16":
+        return entry
+    packed = {}
+    for name, tensor in entry.items():
+        packed[name], packed[f"{name}_scale"] = quantize_tensor(tensor, bank_dtype)
+    return packed
+
+
+def unpack_entry(entry, dtype=torch.float16):
+    """返回反量化后的 {"key","value"}，未量化的条目原样返回。"""
+    if "key_scale" not in entry:
+        return entry
+    return {
+        name: dequantize_tensor(entry[name], entry[f"{name}_scale"], dtype)
+        for name in ("key", "value")
+    }
+
+
+def entry_nbytes(entry):
+    if isinstance(entry, dict):
+        tensors = entry.values()
+    else:
+        tensors = entry
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def bank_memory_report(id_bank):
+    """
+    统计 id_bank 的显存占用: {character: bytes}，以及按 fp16 保存时的大小。
+    id_bank: {attn_name: {character: {step: entry}}}
+    """
+    report = {}
+    fp16_bytes = 0
+    for characters in id_bank.values():
+        for character, steps in characters.items():
+            for entry in steps.values():
+                nbytes = entry_nbytes(entry)
+                report[character] = report.get(character, 0) + nbytes
+                if isinstance(entry, dict) and "key_scale" in entry:
+                    fp16_bytes += sum(entry[name].numel() * 2 for name in ("key", "value"))
+                else:
+                    fp16_bytes += nbytes
+    return report, fp16_bytes
+
+
+class BankQuantizationStats:
+    """
+    累计量化误差(相对 fp16 存储)，在写入阶段结束后一次性汇总，避免每层同步。
+    """
+    def __init__(self):
+        self.error = None
+        self.reference = None
+        self.max_error = None
+
+    def update(self, entry, packed):
+        for name, tensor in unpack_entry(packed, dtype=torch.float32).items():
+            reference = entry[name].float()
+            diff = tensor - reference
+            error = diff.pow(2).sum()
+            max_error = diff.abs().amax()
+            if self.error is None:
+                self.error, self.reference, self.max_error = error, reference.pow(2).sum(), max_error
+            else:
+                self.error = self.error + error
+                self.reference = self.reference + reference.pow(2).sum()
+                self.max_error = torch.maximum(self.max_error, max_error)
+
+    def summary(self):
+        if self.error is None:
+            return None
+        return {
+            "relative_error": (self.error / self.reference.clamp(min=1e-12)).sqrt().item(),
+            "max_abs_error": self.max_error.item(),
+        }
+
+
+def log_bank_report(id_bank, bank_dtype, stats=None):
+    report, fp16_bytes = bank_memory_report(id_bank)
+    total = sum(report.values())
+    for character, nbytes in report.items():
+        logging.info(f"id_bank {character}: {nbytes / 1024 ** 2:.1f} MB ({bank_dtype})")
+    logging.info(f"id_bank total: {total / 1024 ** 2:.1f} MB, fp16 storage: {fp16_bytes / 1024 ** 2:.1f} MB")
+    summary = stats.summary() if stats is not None else None
+    if summary is not None:
+        logging.info(f"id_bank {bank_dtype} vs fp16: relative error {summary['relative_error']:.4f}, "
+                     f"max abs error {summary['max_abs_error']:.4f}")
+    return {"characters": report, "total": total, "fp16": fp16_bytes, "accuracy": summary}
+
+
+class BankDevice:
+    """
+    id_bank 分页使用的设备抽象: 主机内存与计算设备之间的拷贝。
+    默认实现是普通的同步拷贝，计算设备为 cpu 时分页逻辑同样可以运行。
+    """
+    def __init__(self, device="cpu"):
+        self.device = torch.device(device)
+
+    def to_host(self, tensor):
+        return tensor.to("cpu")
+
+    def to_device(self, tensor):
+        return tensor.to(self.device)
+
+    def prefetch(self, copy_fn):
+        copy_fn()
+
+    def wait(self, tensors):
+        pass
+
+    def synchronize(self):
+        pass
+
+
+class CudaBankDevice(BankDevice):
+    """锁页内存 + 独立 stream 的异步拷贝，预取与当前步的计算重叠。"""
+    def __init__(self, device="cuda"):
+        super().__init__(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+
+    def to_host(self, tensor):
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host.copy_(tensor, non_blocking=True)
+        return host
+
+    def to_device(self, tensor):
+        return tensor.to(self.device, non_blocking=True)
+
+    def prefetch(self, copy_fn):
+        # 写入阶段的 D2H 拷贝在当前 stream 上，预取前先等待
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            copy_fn()
+
+    def wait(self, tensors):
+        current = torch.cuda.current_stream(self.device)
+        current.wait_stream(self.stream)
+        for tensor in tensors:
+            tensor.record_stream(current)
+
+    def synchronize(self):
+        torch.cuda.synchronize(self.device)
+
+
+def get_bank_device(device):
+    device = torch.device(device)
+    if device.type == "cuda" and torch.cuda.is_available():
+        return CudaBankDevice(device)
+    return BankDevice(device)
+
+
+def map_entry(entry, fn):
+    if isinstance(entry, dict):
+        return {name: fn(tensor) for name, tensor in entry.items()}
+    return [fn(tensor) for tensor in entry]
+
+
+class PagedIdBank:
+    """
+    id_bank 分页: 条目保存在主机内存，每一步只有当前步(和预取的下一步)的条目在计算设备上。
+    读取第 t 步时预取第 t+1 步，进入新的一步时释放已经用完的步。
+    """
+    def __init__(self, bank_device, prefetch_steps=1):
+        self.bank_device = bank_device
+        self.prefetch_steps = prefetch_steps
+        self.resident = {}  # step -> {(attn_name, character): entry}
+        self.hits = 0
+        self.misses = 0
+
+    def offload(self, entry):
+        return map_entry(entry, self.bank_device.to_host)
+
+    def prefetch(self, id_bank, characters, step):
+        if step in self.resident:
+            return
+        entries = {}
+        for attn_name, bank in id_bank.items():
+            for character in characters:
+                steps = bank.get(character)
+                if steps is not None and step in steps:
+                    entries[(attn_name, character)] = steps[step]
+
+        def copy_fn():
+            self.resident[step] = {
+                key: map_entry(entry, self.bank_device.to_device) for key, entry in entries.items()
+            }
+        self.bank_device.prefetch(copy_fn)
+
+    def advance(self, id_bank, characters, step):
+        """进入第 step 步: 释放之前的步，预取后面的步。"""
+        for resident_step in [s for s in self.resident if s < step]:
+            del self.resident[resident_step]
+        for next_step in range(step, step + self.prefetch_steps + 1):
+            self.prefetch(id_bank, characters, next_step)
+
+    def get(self, id_bank, attn_name, character, step):
+        entry = self.resident.get(step, {}).get((attn_name, character))
+        if entry is None:
+            # 未预取(例如旧格式条目被替换)，同步拷贝
+            self.misses += 1
+            return map_entry(id_bank[attn_name][character][step], self.bank_device.to_device)
+        self.hits += 1
+        self.bank_device.wait(entry.values() if isinstance(entry, dict) else entry)
+        return entry
+
+    def reset(self):
+        self.resident = {}
+
+    def synchronize(self):
+        self.bank_device.synchronize()
@@ -0,0 +1,56 @@
+"""
+各基准脚本共用的计时和生成辅助函数(consistency_benchmark、compile_benchmark、token_selector_benchmark)。
+"""
+import time
+
+import torch
+
+SCENES = ("reading a book in a library", "riding a bike on the street", "cooking in the kitchen",
+          "sitting on a bench at night")
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timed(function, *args, **kwargs):
+    """Run `function` between two device synchronizations, returns (result, seconds)."""
+    synchronize()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    synchronize()
+    return result, time.perf_counter() - start
+
+
+def story_prompts(character, num_scenes=len(SCENES)):
+    """The reference prompts and the scene prompts of a one-character benchmark story."""
+    ref_prompts = [f"{character}, portrait", f"{character}, standing in a park"]
+    return ref_prompts, [f"{character}, {scene}" for scene in SCENES[:num_scenes]]
+
+
+def run_story(pipe, character, ref_prompts, scene_prompts, steps, seed, height, width, policy=None):
+    r"""
+    Write the character from `ref_prompts`, then generate every scene in the read phase with the same seed.
+    Returns (scene images, seconds per scene).
+    """
+    # 在函数内导入，token_selector_benchmark 只用计时函数，不需要加载节点模块
+    from ..Storydiffusion_node import StoryAttentionContext, StoryContextPipe
+    story_context = StoryAttentionContext(pipe.unet, len(ref_prompts), 0.5, 0.5, height, width,
+                                          num_steps=steps, seed=seed, policy=policy)
+    story_pipe = StoryContextPipe(pipe, story_context)
+
+    def generate(prompts):
+        generator = [torch.Generator(device=pipe.device).manual_seed(seed) for _ in prompts]
+        return story_pipe(prompts, num_inference_steps=steps, height=height, width=width,
+                          generator=generator).images
+
+    story_context.start([character], write=True)
+    generate(ref_prompts)
+    images, latency = [], []
+    for prompt in scene_prompts:
+        story_context.start([character], write=False)
+        scene_images, seconds = timed(generate, [prompt])
+        images.append(scene_images[0])
+        latency.append(seconds)
+    return images, latency
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+from PIL import Image
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# 角色权重文件格式: safetensors，键为 "{attn_name}/{step}/{slot}"，
+# slot 为 key/value(/key_scale/value_scale)，旧格式的 hidden states 列表用 0,1,... 表示。
+# 缓存的文件还可以带上写入阶段生成的参考分镜(uint8 的 HWC 图片，键为 "reference/{position}/{index}")，
+# 各参考分镜的结构(单张图、图片列表或不存在)记录在 metadata 的 reference_layout 中。
+CHARACTER_BANK_VERSION = "1"
+CHARACTER_BANK_SUFFIX = ".safetensors"
+REFERENCE_PREFIX = "reference/"
+
+
+def model_fingerprint(unet):
+    """unet 的简短指纹(config + 首尾卷积的部分权重)，用于检查角色权重是否来自同一模型。"""
+    sha = hashlib.sha256()
+    sha.update(json.dumps(dict(unet.config), sort_keys=True, default=str).encode())
+    for module in (unet.conv_in, unet.conv_out):
+        weight = module.weight.detach().flatten()[:4096].float().cpu()
+        sha.update(weight.numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def flatten_character_bank(id_bank, character):
+    """{attn_name: {character: {step: entry}}} -> {"attn_name/step/slot": cpu tensor}"""
+    tensors = {}
+    for attn_name, characters in id_bank.items():
+        if character not in characters:
+            continue
+        for step, entry in characters[character].items():
+            slots = entry.items() if isinstance(entry, dict) else enumerate(entry)
+            for slot, tensor in slots:
+                tensors[f"{attn_name}/{step}/{slot}"] = tensor.detach().to("cpu").contiguous()
+    return tensors
+
+
+def flatten_reference_panels(reference_panels):
+    """[None | image | [image]] -> ({"reference/position/index": uint8 tensor}, layout)"""
+    tensors, layout = {}, []
+    for position, panel in enumerate(reference_panels):
+        if panel is None:
+            layout.append(None)
+            continue
+        images = panel if isinstance(panel, (list, tuple)) else [panel]
+        layout.append(len(images) if isinstance(panel, (list, tuple)) else "image")
+        for index, image in enumerate(images):
+            tensors[f"{REFERENCE_PREFIX}{position}/{index}"] = torch.from_numpy(np.array(image.convert("RGB")))
+    return tensors, layout
+
+
+def save_character_bank(filepath, id_bank, character, metadata, reference_panels=None):
+    tensors = flatten_character_bank(id_bank, character)
+    metadata = {name: str(value) for name, value in metadata.items()}
+    if reference_panels is not None:
+        reference_tensors, layout = flatten_reference_panels(reference_panels)
+        tensors.update(reference_tensors)
+        metadata["reference_layout"] = json.dumps(layout)
+    metadata["format_version"] = CHARACTER_BANK_VERSION
+    metadata["character"] = character
+    save_file(tensors, filepath, metadata=metadata)
+    logging.info(f"saved character weights {character} to {filepath}")
+
+
+def save_character_bank_async(filepath, id_bank, character, metadata):
+    """在后台线程中拷贝到 cpu 并写文件，不阻塞采样。"""
+    thread = threading.Thread(
+        target=save_character_bank,
+        args=(filepath, id_bank, character, metadata),
+        name=f"save_character_bank:{character}",
+    )
+    thread.start()
+    return thread
+
+
+class CharacterBankFile:
+    """
+    以 mmap 方式打开的角色权重文件，只建立索引，张量在处理器读取某一步时才读出。
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.handle = safe_open(filepath, framework="pt", device="cpu")
+        self.metadata = self.handle.metadata() or {}
+        version = self.metadata.get("format_version")
+        if version != CHARACTER_BANK_VERSION:
+            raise ValueError(f"unsupported character weights version {version} in {filepath}")
+        self.character = self.metadata["character"]
+        self.description = self.metadata.get("description", "")
+        self.index = {}  # attn_name -> {step: [slot]}
+        for key in self.handle.keys():
+            if key.startswith(REFERENCE_PREFIX):
+                continue
+            attn_name, step, slot = key.rsplit("/", 2)
+            self.index.setdefault(attn_name, {}).setdefault(int(step), []).append(slot)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def read(self, attn_name, step, device=None):
+        """
+        一层一步的条目。指定 device 时缓存拷贝到该设备上的张量，之后的场景和运行不再重复拷贝；
+        不指定时返回主机内存中的张量(分页的 id_bank 自己管理拷贝)。
+        """
+        key = (attn_name, step, None if device is None else str(torch.device(device)))
+        with self.lock:
+            if key not in self.cache:
+                slots = self.index[attn_name][step]
+                tensors = {slot: self.handle.get_tensor(f"{attn_name}/{step}/{slot}") for slot in slots}
+                if device is not None:
+                    tensors = {slot: tensor.to(device) for slot, tensor in tensors.items()}
+                if all(slot.isdigit() for slot in slots):
+                    self.cache[key] = [tensors[slot] for slot in sorted(slots, key=int)]
+                else:
+                    self.cache[key] = tensors
+            return self.cache[key]
+
+    def steps(self, attn_name, device=None):
+        return LazySteps(self, attn_name, device=device)
+
+    def reference_panels(self):
+        """The reference panels saved with the weights, in the layout of results_dict, or None."""
+        layout = self.metadata.get("reference_layout")
+        if layout is None:
+            return None
+        panels = []
+        for position, kind in enumerate(json.loads(layout)):
+            if kind is None:
+                panels.append(None)
+                continue
+            images = [Image.fromarray(self.handle.get_tensor(f"{REFERENCE_PREFIX}{position}/{index}").numpy())
+                      for index in range(1 if kind == "image" else kind)]
+            panels.append(images[0] if kind == "image" else images)
+        return panels
+
+
+class LazySteps(Mapping):
+    """
+    id_bank 中一个角色在某一层的 {step: entry}，条目在第一次访问时从文件读取，
+    指定 device 时读出后留在该设备上。
+    写入的条目(例如旧格式投影后的替换)只保存在本对象中，不影响文件和其它运行。
+    """
+    def __init__(self, bank_file, attn_name, entries=None, device=None):
+        self.bank_file = bank_file
+        self.attn_name = attn_name
+        self.entries = dict(entries) if entries else {}
+        self.device = device
+
+    def __getitem__(self, step):
+        if step in self.entries:
+            return self.entries[step]
+        if step not in self.bank_file.index[self.attn_name]:
+            raise KeyError(step)
+        return self.bank_file.read(self.attn_name, step, self.device)
+
+    def __setitem__(self, step, entry):
+        self.entries[step] = entry
+
+    def __iter__(self):
+        return iter(sorted(set(self.bank_file.index[self.attn_name]) | set(self.entries)))
+
+    def __len__(self):
+        return len(set(self.bank_file.index[self.attn_name]) | set(self.entries))
+
+    def __contains__(self, step):
+        return step in self.entries or step in self.bank_file.index[self.attn_name]
+
+    def copy(self, device=None):
+        return LazySteps(self.bank_file, self.attn_name, self.entries, device=device or self.device)
+
+
+class CharacterBankCache:
+    """
+    按内容寻址的角色权重缓存: 键为模型/LoRA/角色描述/风格/种子/分辨率/步数等参数的哈希，
+    命中时直接加载角色权重，跳过参考图的写入阶段，参考分镜使用与角色权重一起保存的图片，
+    与未命中时生成的相同。超出容量时按最近使用时间淘汰。
+    hits/misses 按运行计数: 只有全部角色命中、真正跳过写入阶段时才算命中。
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(**fields):
+        text = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{CHARACTER_BANK_SUFFIX}")
+
+    def lookup(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.utime(path)  # 更新最近使用时间
+            return path
+        return None
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def store(self, key, id_bank, character, metadata, reference_panels=None):
+        """后台线程写入缓存文件，写完后按容量淘汰。"""
+        thread = threading.Thread(
+            target=self._store,
+            args=(key, id_bank, character, metadata, reference_panels),
+            name=f"character_bank_cache:{character}",
+        )
+        thread.start()
+        return thread
+
+    def _store(self, key, id_bank, character, metadata, reference_panels=None):
+        path = self.path(key)
+        tmp_path = f"{path}.tmp"
+        save_character_bank(tmp_path, id_bank, character, metadata, reference_panels)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(CHARACTER_BANK_SUFFIX):
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                    files.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:  # 仍被占用的文件下次再淘汰
+                    continue
+                total -= size
+                logging.info(f"character bank cache evicted {name}")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
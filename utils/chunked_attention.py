@@ -0,0 +1,105 @@
+import torch
+import torch.nn.functional as F
+
+# 没有显存高效 SDPA 内核(例如 cpu)时，拼接了参考 token 的注意力矩阵会非常大。
+# 这里把 query 分块(必要时 key 也分块，使用 online softmax)，块大小由内存预算决定，
+# 峰值显存/内存与拼接的参考图数量无关。
+
+
+def attention_nbytes(query, key):
+    batch_size, heads, query_length, _ = query.shape
+    # scores 与 softmax 结果各一份
+    return 2 * batch_size * heads * query_length * key.shape[-2] * query.element_size()
+
+
+def has_efficient_sdpa(device):
+    device = torch.device(device)
+    if device.type != "cuda":
+        return False
+    return torch.backends.cuda.flash_sdp_enabled() or torch.backends.cuda.mem_efficient_sdp_enabled()
+
+
+def tile_sizes(query, key, memory_budget):
+    batch_size, heads, query_length, _ = query.shape
+    key_length = key.shape[-2]
+    row_bytes = 2 * batch_size * heads * query.element_size()
+    query_tile = memory_budget // (row_bytes * key_length)
+    if query_tile >= 1:
+        return min(query_tile, query_length), key_length
+    # 一行 query 都放不下时再按 key 分块
+    query_tile = min(query_length, 64)
+    key_tile = max(memory_budget // (row_bytes * query_tile), 1)
+    return query_tile, min(key_tile, key_length)
+
+
+def slice_mask(attn_mask, query_slice, key_slice):
+    if attn_mask is None:
+        return None
+    if attn_mask.shape[-2] != 1:
+        attn_mask = attn_mask[..., query_slice, :]
+    if attn_mask.shape[-1] != 1:
+        attn_mask = attn_mask[..., key_slice]
+    return attn_mask
+
+
+def online_softmax_attention(query, key, value, attn_mask, key_tile):
+    """逐块累加 key/value，保存每行的最大值和归一化系数(online softmax)。"""
+    scale = query.shape[-1] ** -0.5
+    query = query.float() * scale
+    row_max = torch.full(query.shape[:-1], float("-inf"), device=query.device)
+    row_sum = torch.zeros(query.shape[:-1], device=query.device)
+    output = torch.zeros(query.shape, device=query.device)
+    for start in range(0, key.shape[-2], key_tile):
+        key_slice = slice(start, start + key_tile)
+        scores = query @ key[..., key_slice, :].float().transpose(-1, -2)
+        mask = slice_mask(attn_mask, slice(None), key_slice)
+        if mask is not None:
+            if mask.dtype == torch.bool:
+                scores = scores.masked_fill(~mask, float("-inf"))
+            else:
+                scores = scores + mask.float()
+        new_max = torch.maximum(row_max, scores.amax(dim=-1))
+        # 整块被 mask 时最大值仍是 -inf，避免 -inf - -inf
+        safe_max = torch.where(torch.isinf(new_max), torch.zeros_like(new_max), new_max)
+        probs = torch.exp(scores - safe_max.unsqueeze(-1))
+        correction = torch.exp(row_max - safe_max)
+        row_sum = row_sum * correction + probs.sum(dim=-1)
+        output = output * correction.unsqueeze(-1) + probs @ value[..., key_slice, :].float()
+        row_max = new_max
+    return output / row_sum.clamp(min=1e-20).unsqueeze(-1)
+
+
+def chunked_scaled_dot_product_attention(query, key, value, attn_mask=None, memory_budget=1024 ** 3):
+    r"""
+    Drop-in for `F.scaled_dot_product_attention` (no dropout, not causal) whose attention matrix per
+    tile stays within `memory_budget` bytes: queries are split into tiles, and when a single query row
+    over all keys does not fit, keys are split too and combined with an online softmax.
+    query/key/value: (batch, heads, length, head_dim); attn_mask broadcastable to (batch, heads, q, k).
+    """
+    query_tile, key_tile = tile_sizes(query, key, memory_budget)
+    if query_tile >= query.shape[-2] and key_tile >= key.shape[-2]:
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=0.0, is_causal=False)
+    output = torch.empty(query.shape[:-1] + (value.shape[-1],), dtype=query.dtype, device=query.device)
+    for start in range(0, query.shape[-2], query_tile):
+        query_slice = slice(start, start + query_tile)
+        mask = slice_mask(attn_mask, query_slice, slice(None))
+        if key_tile >= key.shape[-2]:
+            output[..., query_slice, :] = F.scaled_dot_product_attention(
+                query[..., query_slice, :], key, value, attn_mask=mask, dropout_p=0.0, is_causal=False
+            )
+        else:
+            output[..., query_slice, :] = online_softmax_attention(
+                query[..., query_slice, :], key, value, mask, key_tile
+            ).to(query.dtype)
+    return output
+
+
+def scaled_dot_product_attention(query, key, value, attn_mask=None, memory_budget=None):
+    """Chunk only when a memory budget is set, the backend has no efficient kernel and the matrix is too big."""
+    if (
+        memory_budget is not None
+        and not has_efficient_sdpa(query.device)
+        and attention_nbytes(query, key) > memory_budget
+    ):
+        return chunked_scaled_dot_product_attention(query, key, value, attn_mask, memory_budget)
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=0.0, is_causal=False)
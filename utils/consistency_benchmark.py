@@ -0,0 +1,67 @@
+"""
+一致性注意力策略的速度/一致性对比，在 ComfyUI 根目录运行:
+    python -m custom_nodes.ComfyUI_StoryDiffusion.utils.consistency_benchmark --repo stabilityai/stable-diffusion-xl-base-1.0
+每个策略用相同的种子生成同一组场景，记录每张图的耗时，并以 "full" 策略的结果为参考计算 PSNR，
+PSNR 越高说明越接近完整一致性注意力的效果。
+"""
+import argparse
+
+import numpy as np
+import torch
+from diffusers import StableDiffusionXLPipeline
+
+from ..Storydiffusion_node import set_attention_processor
+from .benchmark_utils import run_story, story_prompts
+from .gradio_utils import CONSISTENCY_PROFILES, ConsistencyPolicy
+
+BENCHMARK_POLICIES = {
+    "full": CONSISTENCY_PROFILES["full"],
+    "steps_0-0.75": ConsistencyPolicy(step_window=(0.0, 0.75)),
+    "steps_0-0.5": ConsistencyPolicy(step_window=(0.0, 0.5)),
+    "up_blocks.0": ConsistencyPolicy(layers=("up_blocks.0",)),
+    "draft": CONSISTENCY_PROFILES["draft"],
+    "steps_0-0.3_up_blocks.0": ConsistencyPolicy(step_window=(0.0, 0.3), layers=("up_blocks.0",)),
+}
+
+
+def psnr(image, reference):
+    mse = np.mean((image - reference) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def benchmark(pipe, character, ref_prompts, scene_prompts, steps=20, seed=0, height=1024, width=1024,
+              policies=None):
+    policies = policies or BENCHMARK_POLICIES
+    results = {}
+    for name, policy in policies.items():
+        images, latency = run_story(pipe, character, ref_prompts, scene_prompts, steps, seed, height, width,
+                                    policy=policy)
+        results[name] = {"images": [np.asarray(image, dtype=np.float32) for image in images], "latency": float(np.mean(latency))}
+    reference = results.get("full")
+    for name, result in results.items():
+        if reference is not None:
+            result["psnr_vs_full"] = float(np.mean(
+                [psnr(image, ref) for image, ref in zip(result["images"], reference["images"])]
+            ))
+        print(f"{name:28s} {result['latency']:.2f}s/image  PSNR vs full: {result.get('psnr_vs_full', float('nan')):.2f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="latency / consistency of consistent self-attention policies")
+    parser.add_argument("--repo", required=True, help="SDXL diffusers repo or local path")
+    parser.add_argument("--character", default="a man with short black hair, wearing a red hoodie")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    args = parser.parse_args()
+
+    pipe = StableDiffusionXLPipeline.from_pretrained(args.repo, torch_dtype=torch.float16).to("cuda")
+    set_attention_processor(pipe.unet, id_length=2)
+    ref_prompts, scene_prompts = story_prompts(args.character, num_scenes=3)
+    benchmark(pipe, "[character]", ref_prompts, scene_prompts, args.steps, args.seed, args.height, args.width)
+
+
+if __name__ == "__main__":
+    main()
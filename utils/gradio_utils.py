@@ -6,7 +6,9 @@ import random
 import torch.nn as nn
 import torch.nn.functional as F
 import re
+import math
 from .load_models_utils import get_lora_dict
+from .token_selectors import get_token_selector
 
 global lora_get
 lora_get=get_lora_dict()
@@ -271,6 +273,122 @@ def cal_attn_indice_xl_effcient_memory(total_length,id_length,sa32,sa64,height_s
     return indices1024,indices4096
 
 
+class AttentionPlan:
+    r"""
+    Static layer-to-resolution plan of the SpatialAttnProcessor2_0 layers for one resolution.
+    The layers and their downsample factors are fixed when the processors are installed, only this
+    plan is rebuilt when the height/width changes, so the UNet never has to be reloaded.
+    Args:
+        layers (`dict`):
+            {attn_name: downsample} of the consistent self-attention layers.
+        height (`int`), width (`int`):
+            The image size, rounded up to a multiple of 32 like the latents.
+        sa32 (`float`), sa64 (`float`):
+            The sampled token ratio of the 1/32 layers and of the higher resolution layers.
+    """
+    def __init__(self,layers,height,width,sa32,sa64):
+        self.height_s = math.ceil(height / 32) * 32
+        self.width_s = math.ceil(width / 32) * 32
+        self.layers = dict(layers)
+        self.ratios = (sa32,sa64)
+        # downsample: (rows, cols, nums_token, k)，同一分辨率的层共用一份索引
+        self.grids = {}
+        for downsample in sorted(set(self.layers.values()),reverse=True):
+            rows,cols = self.height_s // downsample,self.width_s // downsample
+            sa = sa32 if downsample >= 32 else sa64
+            self.grids[downsample] = (rows,cols,rows * cols,int(round(sa * rows * cols)))
+
+    def matches(self,height,width):
+        return (math.ceil(height / 32) * 32,math.ceil(width / 32) * 32) == (self.height_s,self.width_s)
+
+    def nums_token(self,attn_name):
+        return self.grids[self.layers[attn_name]][2]
+
+
+class AttnIndiceSchedule:
+    r"""
+    Token-sampling schedule of consistent self-attention for a whole run, built once from a seeded generator.
+    Replaces calling `cal_attn_indice_xl_effcient_memory` every step and `random.random()` every layer:
+    each row keeps a fixed `round(sa * nums)` tokens, so the hot path has no `torch.nonzero` sync and
+    no python RNG call, and the result only depends on the seed.
+    Args:
+        num_steps (`int`):
+            The number of denoising steps, steps beyond it reuse the schedule from the start.
+        total_count (`int`):
+            The number of SpatialAttnProcessor2_0 calls per step.
+        total_length (`int`):
+            The number of index rows (images) per resolution.
+        plan (`AttentionPlan`):
+            The resolutions (downsample factors) of the layers, one index buffer is kept per resolution.
+        seed (`int`):
+            The seed of the CPU generator the schedule is drawn from.
+        selector (`str` or `TokenSelector`, defaults to "uniform"):
+            How the reference tokens are chosen, see `utils.token_selectors`.
+    """
+    def __init__(self,num_steps,total_count,total_length,plan,seed=0,device="cuda",selector=None):
+        generator = torch.Generator().manual_seed(seed)
+        self.num_steps = max(num_steps,1)
+        self.selector = get_token_selector(selector or "uniform")
+        self.grids = plan.grids
+        self.indices = {}
+        if not self.selector.dynamic:
+            # downsample: (num_steps, total_length, k)，按 1/32、1/16 的顺序抽取
+            for downsample,(rows,cols,_,k) in self.grids.items():
+                self.indices[downsample] = self.selector.sample(generator,self.num_steps,total_length,rows,cols,k).to(device)
+        # 第0步不使用一致性注意力，20步之前70%的层使用，之后90%
+        rand_num = torch.tensor([0.3 if step < 20 else 0.1 for step in range(self.num_steps)])
+        consistent = torch.rand((self.num_steps,total_count),generator=generator) > rand_num[:,None]
+        consistent[0] = False
+        self.consistent = consistent.tolist()
+
+    def get_indices(self,step,downsample,hidden_states=None):
+        """
+        Token indices per image at this step for the layers of this downsample factor; dynamic
+        selectors choose them from hidden_states (img_nums, nums_token, channel) of the reference images.
+        """
+        if self.selector.dynamic:
+            rows,cols,_,k = self.grids[downsample]
+            return self.selector.select(hidden_states,k,rows,cols)
+        return self.indices[downsample][step % self.num_steps]
+
+    def is_consistent(self,step,attn_count):
+        return self.consistent[step % self.num_steps][attn_count]
+
+
+class ConsistencyPolicy:
+    r"""
+    Which denoising steps and attention layers use consistent self-attention; everything outside
+    the policy falls through to plain self-attention and stores nothing in the id_bank.
+    Args:
+        step_window (`tuple`, *optional*):
+            (start, end) as fractions of the run's steps, both inclusive, e.g. (0.0, 0.5).
+        layers (`tuple`, *optional*):
+            Prefixes of the attention processor names, e.g. ("up_blocks.0",).
+    """
+    def __init__(self,step_window=None,layers=None):
+        self.step_window = step_window
+        self.layers = tuple(layers) if layers else None
+
+    def steps(self,num_steps):
+        if self.step_window is None:
+            return [True] * num_steps
+        start,end = self.step_window
+        return [start <= step / max(num_steps - 1,1) <= end for step in range(num_steps)]
+
+    def allows_layer(self,attn_name):
+        return self.layers is None or attn_name.startswith(self.layers)
+
+    def describe(self):
+        return {"step_window": self.step_window, "layers": self.layers}
+
+
+# "draft": 只在前60%的步、最低分辨率的 up_blocks.0 使用一致性注意力，用于快速预览
+CONSISTENCY_PROFILES = {
+    "full": ConsistencyPolicy(),
+    "draft": ConsistencyPolicy(step_window=(0.0, 0.6), layers=("up_blocks.0",)),
+}
+
+
 class AttnProcessor(nn.Module):
     r"""
     Default processor for performing attention-related computations.
@@ -529,3 +647,55 @@ def get_ref_character(real_prompt,character_dict):
         if keys in real_prompt:
             list_arr = list_arr + [keys]
     return list_arr
+
+def group_read_batches(real_prompts_inds, cur_characters, batch_size):
+    """
+    把角色相同的场景按出现顺序分成不超过 batch_size 的小批次
+    return: [(inds, cur_character)]
+    """
+    groups = {}
+    for ind, cur_character in zip(real_prompts_inds, cur_characters):
+        groups.setdefault(tuple(cur_character), []).append(ind)
+    batches = []
+    for cur_character, inds in groups.items():
+        for start in range(0, len(inds), batch_size):
+            batches.append((inds[start:start + batch_size], list(cur_character)))
+    return batches
+
+
+DRAFT_SCALE = 0.5  # 草稿分辨率相对于成图的比例
+DRAFT_STEPS_RATIO = 0.3
+DRAFT_MIN_STEPS = 4
+DRAFT_MIN_SIZE = 256
+
+
+def draft_settings(height, width, steps):
+    """
+    草稿模式的分辨率和步数: 边长约为一半(32 的倍数，不小于 256)，步数约为三成(不少于 4 步)，
+    单张图的耗时大约降到成图的十分之一。
+    return: (height, width, steps)
+    """
+    def scale(size):
+        return min(size, max(DRAFT_MIN_SIZE, int(round(size * DRAFT_SCALE / 32)) * 32))
+
+    return scale(height), scale(width), min(steps, max(DRAFT_MIN_STEPS, int(round(steps * DRAFT_STEPS_RATIO))))
+
+
+def parse_panel_selection(text, total):
+    """
+    "1,3,5-7" 形式的分镜编号(从 1 开始) 转成排序后的索引列表(从 0 开始)
+    """
+    panels = set()
+    for part in text.replace("，", ",").replace(";", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        try:
+            start, end = int(start), int(end or start)
+        except ValueError:
+            raise ValueError(f"can't parse panel selection '{part}', use numbers like 1,3,5-7")
+        if start < 1 or end > total or start > end:
+            raise ValueError(f"panel selection '{part}' is out of range, the story has {total} panels")
+        panels.update(range(start - 1, end))
+    return sorted(panels)
@@ -2,6 +2,8 @@ import yaml
 import torch
 from diffusers import StableDiffusionXLPipeline
 from .pipeline import PhotoMakerStableDiffusionXLPipeline
+from .single_file_cache import load_single_file
+from .lora_cache import fuse_lora_cached
 
 import os
 import sys
@@ -42,18 +44,9 @@ def load_models(path,model_type,single_files,use_safetensors,photomake_mode,phot
     path=get_instance_path(path)
     if model_type == "txt2img":
         if single_files:
-         
-            try:
-                pipe = StableDiffusionXLPipeline.from_single_file(
-                    path,config=add_config, original_config=original_config_file, torch_dtype=torch.float16)
-            except:
-                try:
-                    pipe = StableDiffusionXLPipeline.from_single_file(
-                        path,config=add_config, original_config_file=original_config_file,
-                        torch_dtype=torch.float16
-                    )
-                except:
-                    raise "load pipe error"
+            # 转换后的权重缓存在磁盘上，之后的加载不再重复转换
+            pipe = load_single_file(StableDiffusionXLPipeline, path, config=add_config,
+                                    original_config=original_config_file, torch_dtype=torch.float16)
 
         else:
             pipe = StableDiffusionXLPipeline.from_pretrained(
@@ -62,28 +55,17 @@ def load_models(path,model_type,single_files,use_safetensors,photomake_mode,phot
 
         if lora:
             if lora in lora_lightning_list:
-                pipe.load_lora_weights(lora_path)
-                pipe.fuse_lora()
+                fuse_lora_cached(pipe, lora_path)
             else:
-                pipe.load_lora_weights(lora_path, adapter_name=trigger_words)
-                pipe.fuse_lora(adapter_names=[trigger_words, ], lora_scale=lora_scale)
+                fuse_lora_cached(pipe, lora_path, lora_scale=lora_scale, adapter_name=trigger_words)
 
     elif model_type == "img2img":
         if photomake_mode=="v1":
             if single_files:
                 # print("loading from a single_files")
-                try:
-                    pipe = PhotoMakerStableDiffusionXLPipeline.from_single_file(
-                        path,config=add_config, original_config=original_config_file,
-                        torch_dtype=torch.float16, use_safetensors=use_safetensors)
-                except:
-                    try:
-                        pipe = PhotoMakerStableDiffusionXLPipeline.from_single_file(
-                            path, config=add_config,original_config_file=original_config_file,
-                            torch_dtype=torch.float16, use_safetensors=use_safetensors
-                        )
-                    except:
-                        raise "load pipe error"
+                pipe = load_single_file(PhotoMakerStableDiffusionXLPipeline, path, config=add_config,
+                                        original_config=original_config_file, torch_dtype=torch.float16,
+                                        use_safetensors=use_safetensors)
             
             else:
                 pipe = PhotoMakerStableDiffusionXLPipeline.from_pretrained(
@@ -99,18 +81,9 @@ def load_models(path,model_type,single_files,use_safetensors,photomake_mode,phot
             from .pipeline_v2 import PhotoMakerStableDiffusionXLPipeline as PhotoMakerStableDiffusionXLPipelineV2
             if single_files:
                 # print("loading from a single_files")
-                try:
-                    pipe = PhotoMakerStableDiffusionXLPipelineV2.from_single_file(
-                        path,config=add_config, original_config=original_config_file,
-                        torch_dtype=torch.float16, use_safetensors=use_safetensors)
-                except:
-                    try:
-                        pipe = PhotoMakerStableDiffusionXLPipelineV2.from_single_file(
-                            path, config=add_config,original_config_file=original_config_file,
-                            torch_dtype=torch.float16, use_safetensors=use_safetensors
-                        )
-                    except:
-                        raise "load pipe error"
+                pipe = load_single_file(PhotoMakerStableDiffusionXLPipelineV2, path, config=add_config,
+                                        original_config=original_config_file, torch_dtype=torch.float16,
+                                        use_safetensors=use_safetensors)
             else:
                 pipe = PhotoMakerStableDiffusionXLPipelineV2.from_pretrained(
                     path, torch_dtype=torch.float16, use_safetensors=use_safetensors
@@ -126,13 +99,12 @@ def load_models(path,model_type,single_files,use_safetensors,photomake_mode,phot
             
         if lora:
             if lora in lora_lightning_list:
-                pipe.load_lora_weights(lora_path)
-                pipe.fuse_lora()
+                fuse_lora_cached(pipe, lora_path)
             else:
-                pipe.load_lora_weights(lora_path, adapter_name=trigger_words)
-                pipe.fuse_lora(adapter_names=[trigger_words, ], lora_scale=lora_scale)
+                fuse_lora_cached(pipe, lora_path, lora_scale=lora_scale, adapter_name=trigger_words)
 
     else:
         raise f"using{model_type}node,must choice{model_type}type in model_loader node"
+    pipe.lora_swap = True  # LoRA 通过权重差融合，常驻时可以用 swap_lora 切换
     return pipe
 
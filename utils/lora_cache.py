@@ -0,0 +1,310 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import diffusers
+import folder_paths
+import torch
+import torch.nn.functional as F
+from safetensors.torch import load_file, save_file
+
+from .single_file_cache import file_fingerprint
+
+# 融合 LoRA 的低秩因子缓存。fuse_lora 每次加载都要走一遍 LoRA 覆盖的所有线性层，
+# 这里第一次融合时把 unet 和两个文本编码器每层的 lora_A、lora_B 和 scaling 保存为 safetensors，
+# 之后直接内存映射读取，逐层算出 B @ A 加到权重上，不再经过 peft。只存低秩因子，一个 LoRA 只有几十到几百 MB，
+# 不是与底模同样大小的稠密权重差。因子与底模的数值无关，所以缓存键是 LoRA 文件的指纹加上模型结构(各组件的 config)
+# 和 dtype，同结构的底模共用。
+# 第一次改动某层时在内存中保存该层原始权重的精确副本(参数的 dtype)，切换 lora_scale 或 LoRA 时(swap_lora)
+# 直接拷回原始权重，而不是减去权重差: fp16/bf16 下先加后减会有舍入误差，来回切换多次后底模会慢慢漂移。
+# 之后再从内存中的 LRU(或缓存文件)取新 LoRA 的因子融合。
+
+CACHE_VERSION = "2"
+CACHE_DIR = os.path.join(folder_paths.models_dir, "diffusers", "storydiffusion_lora_delta")
+LORA_COMPONENTS = ("unet", "text_encoder", "text_encoder_2")
+DELTA_ADAPTER = "storydiffusion_delta"
+FACTOR_SUFFIXES = (".lora_A", ".lora_B", ".scaling")
+
+
+def lora_components(pipe):
+    components = [(name, getattr(pipe, name)) for name in LORA_COMPONENTS if getattr(pipe, name, None) is not None]
+    # torch.compile 后的 unet 参数名带 _orig_mod 前缀，直接改原模块的权重
+    return [(name, getattr(module, "_orig_mod", module)) for name, module in components]
+
+
+def architecture_key(pipe):
+    configs = {}
+    for name, module in lora_components(pipe):
+        config = module.config.to_dict() if hasattr(module.config, "to_dict") else dict(module.config)
+        configs[name] = {key: value for key, value in config.items() if not key.startswith("_")}
+        configs[name]["class"] = type(module).__name__
+        configs[name]["dtype"] = str(module.dtype)
+    return configs
+
+
+def delta_path(pipe, lora_path):
+    key = hashlib.sha256(
+        f"{file_fingerprint(lora_path)}|{json.dumps(architecture_key(pipe), sort_keys=True, default=str)}|"
+        f"{diffusers.__version__}|{CACHE_VERSION}".encode()
+    ).hexdigest()[:32]
+    name = os.path.splitext(os.path.basename(lora_path))[0]
+    return os.path.join(CACHE_DIR, f"{name}-{key}.safetensors")
+
+
+class LoraDeltaLRU:
+    r"""
+    In-memory LRU of the per-layer low-rank factors of recently used LoRAs, so swapping between a
+    few LoRAs on a resident pipeline doesn't read the cache files again.
+    Args:
+        max_bytes (`int`, defaults to 1 GB):
+            Total size of the kept factors, the least recently used are dropped first.
+    """
+
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def nbytes(deltas):
+        return sum(delta.numel() * delta.element_size() for delta in deltas.values())
+
+    def get(self, key):
+        with self._lock:
+            deltas = self.entries.get(key)
+            if deltas is not None:
+                self.entries.move_to_end(key)
+            return deltas
+
+    def put(self, key, deltas):
+        with self._lock:
+            self.entries.pop(key, None)
+            if self.nbytes(deltas) > self.max_bytes:
+                return
+            self.entries[key] = deltas
+            while sum(self.nbytes(value) for value in self.entries.values()) > self.max_bytes:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+lora_delta_lru = LoraDeltaLRU()
+
+
+def layer_factors(factors):
+    """(layer, lora_A, lora_B, scaling) of every layer in a flat factor dict."""
+    for key, lora_A in factors.items():
+        if key.endswith(".lora_A"):
+            layer = key[:-len(".lora_A")]
+            yield layer, lora_A, factors[f"{layer}.lora_B"], factors[f"{layer}.scaling"]
+
+
+def factor_delta(lora_A, lora_B, scaling, device):
+    """scaling * B @ A in float32, the conv form follows peft's Conv2d.get_delta_weight."""
+    lora_A = lora_A.to(device, torch.float32)
+    lora_B = lora_B.to(device, torch.float32)
+    if lora_A.dim() == 2:
+        delta = lora_B @ lora_A
+    elif lora_A.shape[2:] == (1, 1):
+        delta = (lora_B.squeeze(3).squeeze(2) @ lora_A.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
+    else:
+        delta = F.conv2d(lora_A.permute(1, 0, 2, 3), lora_B).permute(1, 0, 2, 3)
+    return delta * scaling.to(device, torch.float32)
+
+
+def base_weight(components, layer):
+    component_name, name = layer.split(".", 1)
+    module = components[component_name].get_submodule(name)
+    # 其他未融合的 peft adapter(例如 PhotoMaker 的 "photomaker")还在时，权重在 base_layer 上
+    if hasattr(module, "get_base_layer"):
+        module = module.get_base_layer()
+    return module.weight
+
+
+@torch.no_grad()
+def extract_deltas(pipe, lora_path):
+    """Load the LoRA with peft, read lora_A, lora_B and scaling of every adapted layer, then delete the adapter."""
+    from peft.tuners.tuners_utils import BaseTunerLayer
+    active_adapters = pipe.get_active_adapters()
+    pipe.load_lora_weights(lora_path, adapter_name=DELTA_ADAPTER)
+    factors = {}
+    try:
+        for component_name, component in lora_components(pipe):
+            for name, module in component.named_modules():
+                # 只读取临时 adapter 的因子，同一层上其他 adapter 的不计入
+                if not isinstance(module, BaseTunerLayer) or DELTA_ADAPTER not in getattr(module, "lora_A", {}):
+                    continue
+                if getattr(module, "use_dora", {}).get(DELTA_ADAPTER):
+                    raise ValueError("DoRA weights are not a plain low-rank delta")
+                if getattr(module, "fan_in_fan_out", False) or not isinstance(
+                        module.get_base_layer(), (torch.nn.Linear, torch.nn.Conv2d)):
+                    raise ValueError(f"unsupported LoRA layer {component_name}.{name}")
+                dtype = module.get_base_layer().weight.dtype
+                layer = f"{component_name}.{name}"
+                factors[f"{layer}.lora_A"] = module.lora_A[DELTA_ADAPTER].weight.to("cpu", dtype).contiguous()
+                factors[f"{layer}.lora_B"] = module.lora_B[DELTA_ADAPTER].weight.to("cpu", dtype).contiguous()
+                factors[f"{layer}.scaling"] = torch.tensor([module.scaling[DELTA_ADAPTER]], dtype=torch.float32)
+    finally:
+        # 只删除临时 adapter，PhotoMaker 等已有的 adapter 保留。加载时 diffusers 只激活了临时 adapter，先重新激活原来的
+        if active_adapters:
+            pipe.set_adapters(active_adapters)
+        pipe.delete_adapters(DELTA_ADAPTER)
+    if not factors:
+        raise ValueError(f"no layer of the pipeline is adapted by {os.path.basename(lora_path)}")
+    return factors
+
+
+def write_deltas(deltas, path, lora_path):
+    nbytes = sum(delta.numel() * delta.element_size() for delta in deltas.values())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if shutil.disk_usage(os.path.dirname(path)).free < 2 * nbytes:
+        logging.warning(f"not enough disk space to cache the fused {os.path.basename(lora_path)}")
+        return None
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        save_file(deltas, tmp_path, metadata={"source": os.path.realpath(lora_path), "version": CACHE_VERSION})
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def load_deltas(pipe, lora_path):
+    """The per-layer low-rank factors of a LoRA for this pipeline, from the LRU, the cache or extracted and cached."""
+    path = delta_path(pipe, lora_path)
+    deltas = lora_delta_lru.get(path)
+    if deltas is not None:
+        return deltas
+    if os.path.exists(path):
+        try:
+            return load_file(path)
+        except Exception as e:
+            logging.warning(f"can't read the cached factors of {os.path.basename(lora_path)} ({e}), extract again")
+    deltas = extract_deltas(pipe, lora_path)
+    try:
+        write_deltas(deltas, path, lora_path)
+    except Exception as e:
+        logging.warning(f"can't cache the fused {os.path.basename(lora_path)}: {e}")
+    return deltas
+
+
+@torch.no_grad()
+def add_deltas(pipe, factors, lora_scale):
+    """W += lora_scale * scaling * B @ A for every layer, one layer's dense delta at a time."""
+    components = dict(lora_components(pipe))
+    for layer, lora_A, lora_B, scaling in layer_factors(factors):
+        param = base_weight(components, layer)
+        delta = factor_delta(lora_A, lora_B, scaling, param.device)
+        param.copy_((param.float() + lora_scale * delta).to(param.dtype))
+    return pipe
+
+
+@torch.no_grad()
+def save_base_weights(pipe, factors):
+    r"""
+    Keep an exact cpu copy of every base weight the LoRA is about to change, in the dtype of the weight.
+    A layer is copied the first time any LoRA changes it and the copy is kept for later swaps.
+    """
+    saved = getattr(pipe, "lora_base_weights", None)
+    if saved is None:
+        saved = pipe.lora_base_weights = {}
+    components = dict(lora_components(pipe))
+    for layer, _, _, _ in layer_factors(factors):
+        if layer not in saved:
+            saved[layer] = base_weight(components, layer).detach().to("cpu", copy=True)
+    return saved
+
+
+@torch.no_grad()
+def restore_base(pipe):
+    """Copy the saved base weights back into the layers the fused LoRA changed."""
+    fused = getattr(pipe, "fused_lora", None)
+    if not fused or fused["deltas"] is None:
+        return pipe
+    components = dict(lora_components(pipe))
+    saved = pipe.lora_base_weights
+    for layer, _, _, _ in layer_factors(fused["deltas"]):
+        base_weight(components, layer).copy_(saved[layer])
+    pipe.fused_lora = None
+    return pipe
+
+
+def apply_deltas(pipe, factors, lora_scale=1.0):
+    """Unfuse the current LoRA, then W = W_base + lora_scale * scaling * B @ A for every layer."""
+    restore_base(pipe)
+    save_base_weights(pipe, factors)
+    return add_deltas(pipe, factors, lora_scale)
+
+
+def fuse_deltas(pipe, lora_path, factors, lora_scale=1.0):
+    apply_deltas(pipe, factors, lora_scale)
+    # 低秩因子很小，直接保存在管线上，恢复和重新融合时不用再读文件
+    pipe.fused_lora = {"lora_path": lora_path, "lora_scale": lora_scale, "deltas": factors}
+    lora_delta_lru.put(delta_path(pipe, lora_path), factors)
+    return pipe
+
+
+def fuse_lora_cached(pipe, lora_path, lora_scale=1.0, adapter_name=None):
+    r"""
+    Fuse a LoRA into the unet and text encoders of an SDXL-style pipeline through the factor cache.
+    Falls back to `load_lora_weights` + `fuse_lora` when the deltas can't be extracted (e.g. DoRA).
+    """
+    try:
+        deltas = load_deltas(pipe, lora_path)
+    except Exception as e:
+        logging.warning(f"fuse {os.path.basename(lora_path)} without the delta cache: {e}")
+        pipe.load_lora_weights(lora_path, adapter_name=adapter_name)
+        if adapter_name:
+            pipe.fuse_lora(adapter_names=[adapter_name, ], lora_scale=lora_scale)
+        else:
+            pipe.fuse_lora(lora_scale=lora_scale)
+        # peft 直接融合的 LoRA 没有保存低秩因子，不能切换
+        pipe.fused_lora = {"lora_path": lora_path, "lora_scale": lora_scale, "deltas": None}
+        return pipe
+    return fuse_deltas(pipe, lora_path, deltas, lora_scale)
+
+
+def set_lora_scale(pipe, lora_scale):
+    """Re-fuse the current LoRA at another scale from its factors, without reloading the pipeline."""
+    fused = getattr(pipe, "fused_lora", None)
+    if not fused or fused["deltas"] is None:
+        raise RuntimeError("the pipeline has no LoRA fused through the delta cache")
+    if fused["lora_scale"] != lora_scale:
+        fuse_deltas(pipe, fused["lora_path"], fused["deltas"], lora_scale)
+    return pipe
+
+
+def swap_lora(pipe, lora_path=None, lora_scale=1.0):
+    r"""
+    Switch the LoRA fused into a resident pipeline without reloading it: copy back the base weights
+    saved when the old LoRA was fused and fuse the new one (`lora_path=None` leaves the base model). Returns `False` when
+    the current LoRA was fused by peft and can't be removed, the caller then has to reload the pipeline.
+    """
+    fused = getattr(pipe, "fused_lora", None)
+    if fused and fused["lora_path"] == lora_path:
+        if fused["lora_scale"] == lora_scale:
+            return True
+        if fused["deltas"] is None:
+            return False
+        set_lora_scale(pipe, lora_scale)
+        return True
+    if fused and fused["deltas"] is None:
+        return False
+    if lora_path is None:
+        restore_base(pipe)
+        return True
+    logging.info(f"swap the LoRA of the resident pipeline to {os.path.basename(lora_path)}")
+    try:
+        deltas = load_deltas(pipe, lora_path)
+    except Exception as e:
+        logging.warning(f"can't swap to {os.path.basename(lora_path)}: {e}")
+        return False
+    fuse_deltas(pipe, lora_path, deltas, lora_scale)
+    return True
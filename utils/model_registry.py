@@ -0,0 +1,134 @@
+import gc
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import psutil
+import torch
+
+# 进程内常驻的管线注册表: 键为规范化后的加载配置(ckpt/repo、vae、LoRA 与权重、photomaker 版本、
+# easy_function 中影响加载的开关、controlnet 等)。配置相同时加载节点直接取回已加载的管线，
+# 只重新设置调度器、注意力处理器等开销很小的部分；超出内存预算时按最近使用时间淘汰。
+
+DEFAULT_BUDGET_RATIO = 0.5  # 默认预算为系统内存的一半
+
+
+def module_nbytes(module, seen):
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if id(tensor) in seen:
+            continue
+        seen.add(id(tensor))
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def pipeline_nbytes(pipe):
+    """Size of the weights of a pipeline, a wrapper holding pipelines, or a single module."""
+    seen = set()
+    if isinstance(pipe, torch.nn.Module):
+        return module_nbytes(pipe, seen)
+    total = 0
+    components = getattr(pipe, "components", None)
+    values = list(components.values()) if isinstance(components, dict) else list(vars(pipe).values())
+    for value in values:
+        if isinstance(value, torch.nn.Module):
+            total += module_nbytes(value, seen)
+        elif hasattr(value, "__dict__") and not isinstance(value, type):
+            # FluxGenerator、SD35Wrapper 等把管线或模型放在属性里
+            inner = getattr(value, "components", None)
+            inner = inner.values() if isinstance(inner, dict) else vars(value).values()
+            total += sum(module_nbytes(module, seen) for module in inner if isinstance(module, torch.nn.Module))
+    return total
+
+
+class RegistryEntry:
+    def __init__(self, pipe, state, nbytes, refs):
+        self.pipe = pipe
+        self.state = state
+        self.nbytes = nbytes
+        # 键中用 id() 表示的 ComfyUI 对象(clip、vae)在条目存在期间保持引用，id 不会被复用
+        self.refs = refs
+
+
+class ModelRegistry:
+    r"""
+    Process-wide registry of loaded pipelines keyed by their normalised load config.
+    Args:
+        budget_bytes (`int`, *optional*):
+            Total size of the resident pipelines, the least recently used are evicted first.
+            Defaults to half of the system memory.
+    """
+
+    def __init__(self, budget_bytes=None):
+        if budget_bytes is None:
+            budget_bytes = int(psutil.virtual_memory().total * DEFAULT_BUDGET_RATIO)
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(**config):
+        text = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self.entries.values())
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, pipe, state, refs=()):
+        nbytes = pipeline_nbytes(pipe)
+        with self._lock:
+            self.entries.pop(key, None)
+            self._evict(self.budget_bytes - nbytes)
+            if nbytes > self.budget_bytes:
+                logging.info(f"model registry: {nbytes / 1024 ** 3:.1f} GB is over the budget, not kept resident")
+                return None
+            entry = self.entries[key] = RegistryEntry(pipe, state, nbytes, tuple(refs))
+        logging.info(f"model registry: keep {nbytes / 1024 ** 3:.1f} GB resident, "
+                     f"{len(self.entries)} models, {self.nbytes / 1024 ** 3:.1f}/{self.budget_bytes / 1024 ** 3:.1f} GB")
+        return entry
+
+    def _evict(self, budget_bytes):
+        evicted = False
+        while self.entries and self.nbytes > max(budget_bytes, 0):
+            nbytes = self.entries.popitem(last=False)[1].nbytes
+            logging.info(f"model registry: evict {nbytes / 1024 ** 3:.1f} GB")
+            evicted = True
+        if evicted:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def set_budget(self, budget_bytes):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict(budget_bytes)
+
+    def remove(self, key):
+        with self._lock:
+            return self.entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._evict(0)
+
+    def stats(self):
+        return {"models": len(self.entries), "nbytes": self.nbytes, "budget_bytes": self.budget_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+model_registry = ModelRegistry()
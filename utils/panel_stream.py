@@ -0,0 +1,66 @@
+import os
+
+import comfy.utils
+import folder_paths
+
+# process_generation 每完成一批分镜就 yield 一次当前的 results_dict 列表，
+# 这里把新完成的分镜立即推送到 ComfyUI: 进度条 + 预览图，可选地逐张保存到输出目录。
+
+PREVIEW_SIZE = 512
+
+
+class PanelStreamer:
+    r"""
+    Consumes the partial results yielded by `process_generation` and pushes every newly finished
+    panel to the UI as soon as it exists, instead of waiting for the whole story.
+    Args:
+        total (`int`):
+            The number of images the story is expected to produce, the length of the progress bar. A panel
+            holding a batch (the reference images of a character, or all of them when a refined panel is one
+            of the references) counts every image, and the bar grows when a story yields more than expected.
+        save_prefix (`str`, *optional*):
+            Filename prefix in the ComfyUI output directory, every panel is also saved as a png.
+    """
+
+    def __init__(self, total, save_prefix=None, preview_size=PREVIEW_SIZE):
+        self.total = max(total, 1)
+        self.save_prefix = save_prefix
+        self.preview_size = preview_size
+        self.pbar = comfy.utils.ProgressBar(self.total)
+        self.done = 0
+        self.files = []
+        self._seen = set()
+
+    def update(self, results):
+        """results: the list yielded by process_generation, a panel is an image or a list of images."""
+        for panel in results:
+            if id(panel) in self._seen:
+                continue
+            # 已完成的分镜一直留在 results_dict 中，id 不会被复用
+            self._seen.add(id(panel))
+            images = panel if isinstance(panel, (list, tuple)) else [panel]
+            if self.save_prefix:
+                for image in images:
+                    self.save(image)
+            # 一个分镜可能是一批图(角色的参考图)，按图片数计数
+            self.done += len(images)
+            self.total = max(self.total, self.done)
+            self.pbar.update_absolute(self.done, self.total,
+                                      ("JPEG", images[-1], self.preview_size))
+        return results
+
+    def save(self, image):
+        full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path(
+            self.save_prefix, folder_paths.get_output_directory(), image.width, image.height
+        )
+        path = os.path.join(full_output_folder, f"{filename}_{counter:05}_.png")
+        image.save(path, compress_level=4)
+        self.files.append(path)
+        return path
+
+    def consume(self, gen):
+        """Run the generator to the end, streaming every panel, and return its last value."""
+        value = None
+        for value in gen:
+            self.update(value)
+        return value
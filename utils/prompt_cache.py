@@ -0,0 +1,274 @@
+import functools
+import inspect
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+# 文本编码结果的 LRU 缓存。一个故事里参考图和每个场景都会用同一个负面提示词调用 pipe，
+# 每次都要重新过一遍 SDXL 的两个文本编码器；缓存按文本逐条保存 (prompt_embeds, pooled)，
+# 负面提示词整个故事只编码一次。键里包含文本编码器的身份、LoRA 状态、lora_scale 和 clip_skip。
+
+_encoder_ids = itertools.count()
+
+
+def encoder_token(module):
+    """A process-unique id of a text encoder object (id() could be reused by a later model)."""
+    if module is None:
+        return None
+    token = getattr(module, "_prompt_cache_token", None)
+    if token is None:
+        token = next(_encoder_ids)
+        try:
+            module._prompt_cache_token = token
+        except AttributeError:
+            return id(module)
+    return token
+
+
+def encoder_key(pipe):
+    """Identity of the text encoders of a pipeline plus its LoRA state (set by the loader)."""
+    encoders = tuple(
+        encoder_token(getattr(pipe, name, None))
+        for name in ("text_encoder", "text_encoder_2", "text_encoder_3", "clip")
+    )
+    return encoders, getattr(pipe, "prompt_cache_state", None)
+
+
+class PromptEmbedCache:
+    r"""
+    LRU cache of text-encoder outputs shared by every pipeline of the process.
+    Args:
+        max_entries (`int`, defaults to 256):
+            The number of cached encodings, the least recently used are dropped first.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_encode(self, key, encode):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        value = encode()
+        with self._lock:
+            self.misses += 1
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(
+            f"prompt embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%}), {stats['entries']} entries"
+        )
+        return stats
+
+
+prompt_embed_cache = PromptEmbedCache()
+
+
+def _tensor_args(arguments):
+    return any(isinstance(value, torch.Tensor) for name, value in arguments.items() if name.endswith("embeds"))
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, (torch.device, torch.dtype)):
+        return str(value)
+    return value
+
+
+def _clone(output):
+    if isinstance(output, torch.Tensor):
+        return output.clone()
+    if isinstance(output, (list, tuple)):
+        return type(output)(_clone(value) for value in output)
+    return output
+
+
+def cached_call(pipe, method, cache):
+    r"""
+    Memoize a whole encode call (PhotoMaker `encode_prompt_with_trigger_word`, Flux `encode_prompt`,
+    the SD3.5 wrapper's `encode`) by its text arguments. Calls that pass precomputed embeddings,
+    or any other tensor, go straight to the original method.
+    """
+    signature = inspect.signature(method)
+    var_names = {
+        name for name, parameter in signature.parameters.items()
+        if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD)
+    }
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        # 子类常用 *args, **kwargs 转发给父类，把它们展开到键里
+        for name in var_names:
+            value = arguments.pop(name, None)
+            if isinstance(value, dict):
+                arguments.update(value)
+            elif value:
+                arguments.update((f"{name}[{index}]", item) for index, item in enumerate(value))
+        if _tensor_args(arguments):
+            return method(*args, **kwargs)
+        key_args = tuple(
+            (name, _hashable(value)) for name, value in arguments.items()
+            if name not in ("device", "class_tokens_mask") and not isinstance(value, torch.Tensor)
+        )
+        key = (method.__name__, encoder_key(pipe), key_args)
+        # 调用方可能原地修改返回的张量，缓存里保留一份原始结果
+        return _clone(cache.get_or_encode(key, lambda: method(*args, **kwargs)))
+
+    return wrapper
+
+
+def sdxl_encode_prompts():
+    r"""
+    The `encode_prompt` functions of the diffusers SDXL pipelines. Their negative branch tokenizes and
+    encodes exactly like the positive branch without clip_skip, so a negative text can be cached as a
+    positive one. Pipelines that override `encode_prompt` (Kolors, ...) are not in this set.
+    """
+    from diffusers import (
+        StableDiffusionXLImg2ImgPipeline,
+        StableDiffusionXLInpaintPipeline,
+        StableDiffusionXLPipeline,
+    )
+
+    return {
+        pipeline.encode_prompt
+        for pipeline in (StableDiffusionXLPipeline, StableDiffusionXLImg2ImgPipeline, StableDiffusionXLInpaintPipeline)
+    }
+
+
+def cached_encode_prompt(pipe, method, cache):
+    r"""
+    Per-text cache of the diffusers SDXL `encode_prompt` (see `sdxl_encode_prompts`) that returns
+    (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds).
+    Every positive and negative text is encoded on its own as a positive prompt without guidance,
+    which gives the same embeddings as the negative branch, and the batch is assembled from the
+    cached (prompt_embeds, pooled) pairs.
+    """
+    signature = inspect.signature(method)
+    parameters = signature.parameters
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = arguments.arguments
+        prompt = arguments.get("prompt")
+        if (
+            _tensor_args(arguments)
+            or not isinstance(prompt, (str, list))
+            or arguments.get("prompt_2") is not None
+            or arguments.get("negative_prompt_2") is not None
+        ):
+            return method(*args, **kwargs)
+        device = arguments.get("device")
+        lora_scale = arguments.get("lora_scale")
+        clip_skip = arguments.get("clip_skip")
+        num_images_per_prompt = arguments.get("num_images_per_prompt") or 1
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+
+        def encode(text, clip_skip=None):
+            def run():
+                encode_kwargs = {"prompt": text, "device": device, "num_images_per_prompt": 1,
+                                 "do_classifier_free_guidance": False, "lora_scale": lora_scale}
+                if "clip_skip" in parameters:
+                    encode_kwargs["clip_skip"] = clip_skip
+                prompt_embeds, _, pooled_prompt_embeds, _ = method(**encode_kwargs)
+                return prompt_embeds, pooled_prompt_embeds
+
+            key = ("encode_prompt", encoder_key(pipe), text, lora_scale, clip_skip, str(device))
+            return cache.get_or_encode(key, run)
+
+        def assemble(texts, clip_skip=None):
+            encoded = [encode(text, clip_skip) for text in texts]
+            prompt_embeds = torch.cat([embeds for embeds, _ in encoded])
+            pooled_prompt_embeds = torch.cat([pooled for _, pooled in encoded])
+            bs_embed, seq_len, _ = prompt_embeds.shape
+            prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1).view(
+                bs_embed * num_images_per_prompt, seq_len, -1
+            )
+            pooled_prompt_embeds = pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(
+                bs_embed * num_images_per_prompt, -1
+            )
+            return prompt_embeds, pooled_prompt_embeds
+
+        prompt_embeds, pooled_prompt_embeds = assemble(prompts, clip_skip)
+        if not arguments.get("do_classifier_free_guidance"):
+            return prompt_embeds, None, pooled_prompt_embeds, None
+        negative_prompt = arguments.get("negative_prompt")
+        if negative_prompt is None and getattr(pipe.config, "force_zeros_for_empty_prompt", False):
+            return (prompt_embeds, torch.zeros_like(prompt_embeds),
+                    pooled_prompt_embeds, torch.zeros_like(pooled_prompt_embeds))
+        if negative_prompt is not None and type(negative_prompt) is not type(prompt):
+            return method(*args, **kwargs)  # 类型不一致时由原方法报错
+        negative_prompts = negative_prompt if isinstance(negative_prompt, list) else [negative_prompt or ""] * len(prompts)
+        if len(negative_prompts) != len(prompts):
+            return method(*args, **kwargs)
+        # 负面提示词的编码不使用 clip_skip
+        negative_prompt_embeds, negative_pooled_prompt_embeds = assemble(negative_prompts)
+        return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
+
+    return wrapper
+
+
+def install_prompt_cache(pipe, lora_state=None, cache=prompt_embed_cache):
+    r"""
+    Route the text encoding of a pipeline through the shared PromptEmbedCache: the diffusers SDXL
+    `encode_prompt` (SDXL, PhotoMaker v1/v2, StoryMaker) per text; any other `encode_prompt` (Kolors,
+    Flux), PhotoMaker's `encode_prompt_with_trigger_word` and the SD3.5 wrapper's `encode` per call.
+    `lora_state` identifies the LoRA fused into the text encoders; change `pipe.prompt_cache_state`
+    whenever the LoRA changes.
+    """
+    if pipe is None:
+        return pipe
+    if getattr(pipe, "prompt_cache", None) is cache:
+        pipe.prompt_cache_state = lora_state  # 常驻的管线可能换了 LoRA
+        return pipe
+    try:
+        pipe.prompt_cache_state = lora_state
+    except AttributeError:
+        return pipe
+    verified = sdxl_encode_prompts()
+    for name in ("encode_prompt", "encode_prompt_with_trigger_word", "encode"):
+        method = getattr(pipe, name, None)
+        if method is None or not callable(method):
+            continue
+        if name == "encode" and not hasattr(pipe, "clip_prompt"):
+            continue  # 只有 SD3.5 wrapper 的 encode 是文本编码
+        # 只有确认负面分支和正面分支编码方式相同的管线才逐条缓存，其余按整次调用缓存
+        if name == "encode_prompt" and getattr(method, "__func__", None) in verified:
+            setattr(pipe, name, cached_encode_prompt(pipe, method, cache))
+        else:
+            setattr(pipe, name, cached_call(pipe, method, cache))
+    pipe.prompt_cache = cache
+    return pipe
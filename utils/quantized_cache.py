@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import diffusers
+import folder_paths
+import torch
+from safetensors.torch import load_file, save_file
+
+from .single_file_cache import file_fingerprint
+
+# optimum-quanto 量化结果的磁盘缓存。Flux 的 transformer 和 T5 每次加载都要重新量化为 qfloat8，
+# 这里第一次量化后把量化后的 state dict 存为 safetensors，另存 quantization_map.json(与 PuLID
+# load_flow_model_quintized 读取的格式相同)和模型 config，之后在 meta 设备上建模型，用 requantize 载入，
+# 不再量化。缓存键为源权重的指纹(本地文件的大小、修改时间和首尾哈希，或 repo_id、revision 与解析出的快照 commit)。
+
+CACHE_VERSION = "1"
+CACHE_DIR = os.path.join(folder_paths.models_dir, "diffusers", "storydiffusion_quanto")
+WEIGHTS_NAME = "model.safetensors"
+QUANTIZATION_MAP_NAME = "quantization_map.json"
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".json")
+
+
+def snapshot_commit(repo_id, subfolder=None, revision=None):
+    """The commit of the hub snapshot a repo_id/revision resolves to, from the local hf cache or the hub."""
+    from huggingface_hub import HfApi, try_to_load_from_cache
+    filename = f"{subfolder}/config.json" if subfolder else "model_index.json"
+    try:
+        cached = try_to_load_from_cache(repo_id, filename, revision=revision)
+        if isinstance(cached, str):
+            # .../snapshots/<commit>/<filename>
+            return os.path.normpath(cached).split(os.sep)[-(len(filename.split("/")) + 1)]
+        return HfApi().model_info(repo_id, revision=revision).sha
+    except Exception as e:
+        logging.warning(f"can't resolve the snapshot of {repo_id}: {e}")
+        return None
+
+
+def source_fingerprint(source, subfolder=None, revision=None):
+    if os.path.isfile(source):
+        return file_fingerprint(source)
+    folder = os.path.join(source, subfolder) if subfolder else source
+    sha = hashlib.sha256(f"{source}|{subfolder}|{revision}".encode())
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(WEIGHT_SUFFIXES):
+                sha.update(f"{name}|{file_fingerprint(os.path.join(folder, name))}".encode())
+    elif not os.path.isdir(source):
+        # hub 仓库: 同一个 revision(例如 main)更新后指向新的 commit，缓存随之失效
+        sha.update(f"|{snapshot_commit(source, subfolder, revision)}".encode())
+    return sha.hexdigest()
+
+
+def artifact_path(name, source, subfolder=None, revision=None, weights="qfloat8"):
+    from optimum.quanto import __version__ as quanto_version
+    key = hashlib.sha256(
+        f"{source_fingerprint(source, subfolder, revision)}|{weights}|{quanto_version}|"
+        f"{diffusers.__version__}|{CACHE_VERSION}".encode()
+    ).hexdigest()[:32]
+    return os.path.join(CACHE_DIR, f"{name}-{key}")
+
+
+def is_cached(artifact):
+    return all(os.path.exists(os.path.join(artifact, name)) for name in (WEIGHTS_NAME, QUANTIZATION_MAP_NAME))
+
+
+def save_quantized(model, artifact):
+    """Write the frozen quantized model as safetensors + quantization map + config."""
+    from optimum.quanto import quantization_map
+    state_dict = {}
+    storages = set()
+    for key, tensor in model.state_dict().items():
+        tensor = tensor.contiguous()
+        # safetensors 不能保存共享存储的张量(T5 的 shared 与 embed_tokens)，重复的另存一份
+        if tensor.data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.data_ptr())
+        state_dict[key] = tensor
+    nbytes = sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+    os.makedirs(os.path.dirname(artifact), exist_ok=True)
+    if shutil.disk_usage(os.path.dirname(artifact)).free < 2 * nbytes:
+        logging.warning(f"not enough disk space to cache the quantized {os.path.basename(artifact)}")
+        return None
+    tmp_dir = f"{artifact}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        save_file(state_dict, os.path.join(tmp_dir, WEIGHTS_NAME))
+        with open(os.path.join(tmp_dir, QUANTIZATION_MAP_NAME), "w", encoding="utf-8") as f:
+            json.dump(quantization_map(model), f)
+        if hasattr(model, "save_config"):
+            model.save_config(tmp_dir)  # diffusers
+        else:
+            model.config.save_pretrained(tmp_dir)  # transformers
+        if os.path.exists(artifact):
+            shutil.rmtree(artifact)
+        os.replace(tmp_dir, artifact)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logging.info(f"cached the quantized model in {artifact}")
+    return artifact
+
+
+def load_quantized(model_class, artifact, torch_dtype=torch.bfloat16):
+    """Build the model on the meta device and requantize it from the memory-mapped artifact."""
+    from optimum.quanto import requantize
+    with torch.device("meta"):
+        if hasattr(model_class, "load_config"):
+            model = model_class.from_config(model_class.load_config(artifact))
+        else:
+            model = model_class(model_class.config_class.from_pretrained(artifact))
+    model.to(torch_dtype)
+    state_dict = load_file(os.path.join(artifact, WEIGHTS_NAME))
+    with open(os.path.join(artifact, QUANTIZATION_MAP_NAME), encoding="utf-8") as f:
+        quantization_map = json.load(f)
+    requantize(model, state_dict, quantization_map, device=torch.device("cpu"))
+    # requantize 用 strict=False 载入，缺键时模型里是未初始化的权重
+    missing = set(model.state_dict()) - set(state_dict)
+    if missing:
+        raise ValueError(f"{len(missing)} weights missing in the quantized artifact")
+    model.eval()
+    return model
+
+
+def quantize_cached(model_class, name, source, load, subfolder=None, revision=None, torch_dtype=torch.bfloat16):
+    r"""
+    A qfloat8 model from the artifact cache, or `load()` quantized with optimum-quanto and cached.
+    Args:
+        model_class: the diffusers or transformers class, used to rebuild the model from its config.
+        name (`str`): prefix of the artifact folder.
+        source (`str`): checkpoint file, local folder or repo_id of the source weights.
+        load (`callable`): loads the unquantized model on a cache miss.
+    """
+    from optimum.quanto import freeze, qfloat8, quantize
+    artifact = artifact_path(name, source, subfolder, revision)
+    if is_cached(artifact):
+        try:
+            model = load_quantized(model_class, artifact, torch_dtype)
+            logging.info(f"loaded the quantized {name} from {artifact}")
+            return model
+        except Exception as e:
+            logging.warning(f"can't load the quantized {name} ({e}), quantize again")
+    model = load()
+    quantize(model, weights=qfloat8)
+    freeze(model)
+    try:
+        save_quantized(model, artifact)
+    except Exception as e:
+        logging.warning(f"can't cache the quantized {name}: {e}")
+    return model
@@ -0,0 +1,168 @@
+"""
+单文件 SDXL checkpoint 的转换缓存。from_single_file 每次加载都要把 LDM 格式的键转换成 diffusers 格式，
+这里在第一次加载时把转换后的 unet/vae/text_encoder 按 diffusers 目录结构保存为 safetensors，
+之后直接 from_pretrained(内存映射读取)。缓存键为文件路径、大小、修改时间和首尾数据的哈希。
+预先生成缓存，在 ComfyUI 根目录运行:
+    python -m custom_nodes.ComfyUI_StoryDiffusion.utils.single_file_cache sd_xl_base_1.0.safetensors
+    python -m custom_nodes.ComfyUI_StoryDiffusion.utils.single_file_cache --all
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import diffusers
+import folder_paths
+import torch
+
+CACHE_VERSION = "1"
+CACHE_DIR = os.path.join(folder_paths.models_dir, "diffusers", "storydiffusion_single_file")
+CACHE_INFO = "cache_info.json"
+WEIGHT_COMPONENTS = ("unet", "vae", "text_encoder", "text_encoder_2")
+CONFIG_COMPONENTS = ("scheduler", "tokenizer", "tokenizer_2")
+FINGERPRINT_BYTES = 4 * 1024 * 1024
+
+dir_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_config = os.path.join(dir_path, "local_repo")
+default_original_config = os.path.join(dir_path, "config", "sd_xl_base.yaml")
+
+
+def file_fingerprint(path):
+    """Hash of the path, size, mtime and the first/last 4 MB, cheap even for multi-GB checkpoints."""
+    stat = os.stat(path)
+    sha = hashlib.sha256()
+    sha.update(f"{os.path.realpath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        sha.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(stat.st_size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            sha.update(f.read(FINGERPRINT_BYTES))
+    return sha.hexdigest()
+
+
+def cache_path(path, torch_dtype=torch.float16):
+    key = hashlib.sha256(
+        f"{file_fingerprint(path)}|{torch_dtype}|{diffusers.__version__}|{CACHE_VERSION}".encode()
+    ).hexdigest()[:32]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_DIR, f"{name}-{key}")
+
+
+def is_cached(cache_dir):
+    return os.path.exists(os.path.join(cache_dir, CACHE_INFO))
+
+
+def cached_component(path, component, torch_dtype=torch.float16):
+    """The converted safetensors file of one component, or None when the checkpoint is not cached yet."""
+    cache_dir = cache_path(path, torch_dtype)
+    if not is_cached(cache_dir):
+        return None
+    component_dir = os.path.join(cache_dir, component)
+    for name in os.listdir(component_dir):
+        if name.endswith(".safetensors"):
+            return os.path.join(component_dir, name)
+    return None
+
+
+def write_cache(pipe, path, cache_dir, config=default_config):
+    """Save the converted components plus the tokenizer/scheduler configs as a diffusers folder."""
+    stat = os.stat(path)
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    if shutil.disk_usage(os.path.dirname(cache_dir)).free < 2 * stat.st_size:
+        logging.warning(f"not enough disk space to cache the converted {os.path.basename(path)}")
+        return None
+    tmp_dir = f"{cache_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        for name in WEIGHT_COMPONENTS:
+            pipe.components[name].save_pretrained(os.path.join(tmp_dir, name), safe_serialization=True)
+        for name in CONFIG_COMPONENTS:
+            shutil.copytree(os.path.join(config, name), os.path.join(tmp_dir, name))
+        shutil.copy(os.path.join(config, "model_index.json"), tmp_dir)
+        with open(os.path.join(tmp_dir, CACHE_INFO), "w", encoding="utf-8") as f:
+            json.dump({"source": os.path.realpath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                       "diffusers": diffusers.__version__, "version": CACHE_VERSION}, f, indent=2)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logging.info(f"cached the converted checkpoint in {cache_dir}")
+    return cache_dir
+
+
+def from_single_file(pipeline_class, path, config=default_config, original_config=default_original_config,
+                     torch_dtype=torch.float16, **kwargs):
+    """from_single_file with the original_config / original_config_file fallback of older diffusers."""
+    try:
+        return pipeline_class.from_single_file(path, config=config, original_config=original_config,
+                                               torch_dtype=torch_dtype, **kwargs)
+    except Exception:
+        try:
+            return pipeline_class.from_single_file(path, config=config, original_config_file=original_config,
+                                                   torch_dtype=torch_dtype, **kwargs)
+        except Exception as e:
+            raise RuntimeError("load pipe error, check your diffusers version") from e
+
+
+def load_single_file(pipeline_class, path, config=default_config, original_config=default_original_config,
+                     torch_dtype=torch.float16, **kwargs):
+    r"""
+    Load an SDXL single-file checkpoint into `pipeline_class`: from the converted cache when it exists,
+    otherwise with `from_single_file`, writing the cache for the next load. Extra keyword arguments
+    (components such as `unet=` or `scheduler=`) are passed to both loaders.
+    """
+    cache_dir = cache_path(path, torch_dtype)
+    if is_cached(cache_dir):
+        try:
+            pipe = pipeline_class.from_pretrained(cache_dir, torch_dtype=torch_dtype,
+                                                  **{k: v for k, v in kwargs.items() if k not in ("use_safetensors", "variant")})
+            logging.info(f"loaded {os.path.basename(path)} from the converted cache")
+            return pipe
+        except Exception as e:
+            logging.warning(f"can't load the converted cache of {os.path.basename(path)} ({e}), convert again")
+    pipe = from_single_file(pipeline_class, path, config, original_config, torch_dtype, **kwargs)
+    try:
+        write_cache(pipe, path, cache_dir, config)
+    except Exception as e:
+        logging.warning(f"can't cache the converted {os.path.basename(path)}: {e}")
+    return pipe
+
+
+def prewarm(paths, torch_dtype=torch.float16):
+    from diffusers import StableDiffusionXLPipeline
+    for path in paths:
+        cache_dir = cache_path(path, torch_dtype)
+        if is_cached(cache_dir):
+            print(f"{os.path.basename(path)}: already cached")
+            continue
+        pipe = from_single_file(StableDiffusionXLPipeline, path, torch_dtype=torch_dtype)
+        write_cache(pipe, path, cache_dir)
+        print(f"{os.path.basename(path)}: cached in {cache_dir}")
+        del pipe
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert SDXL single-file checkpoints once into the diffusers cache")
+    parser.add_argument("checkpoints", nargs="*", help="file names in models/checkpoints or full paths")
+    parser.add_argument("--all", action="store_true", help="every SDXL checkpoint in models/checkpoints")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    names = list(args.checkpoints)
+    if args.all:
+        # flux、sd3.5 的单文件不走这里的转换
+        names += [name for name in folder_paths.get_filename_list("checkpoints")
+                  if name.endswith(".safetensors") and "flux" not in name.lower() and "3.5" not in name]
+    paths = [name if os.path.isfile(name) else folder_paths.get_full_path("checkpoints", name) for name in names]
+    missing = [name for name, path in zip(names, paths) if not path]
+    if missing:
+        raise SystemExit(f"checkpoints not found: {missing}")
+    prewarm(paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import hashlib
+import json
+import logging
+
+# 上一次故事的分镜记录(按节点实例保存，即每个 ComfyUI 会话一份): 分镜输入的签名 -> 生成结果。
+# 下一次运行时逐个比对签名，只重新生成输入有变化的分镜；角色参考分镜整组记录，
+# 参考分镜的提示词决定了 id_bank，所以它们变化时该角色的所有分镜都会重新生成。
+
+
+class StoryRecord:
+    r"""
+    Outputs of the last story keyed by the signature of their inputs, used by `process_generation`
+    to regenerate only the panels whose prompt, characters, seed, style or sampling settings changed.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.reused = 0
+        self.generated = 0
+
+    @staticmethod
+    def signature(**fields):
+        text = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def lookup(self, signature):
+        return self.entries.get(signature)
+
+    def update(self, entries, reused, generated):
+        """Replace the record with the panels of the current story, dropping everything else."""
+        self.entries = entries
+        self.reused = reused
+        self.generated = generated
+        logging.info(f"story record: {reused} panels reused, {generated} regenerated")
+
+    def clear(self):
+        self.entries = {}
@@ -0,0 +1,100 @@
+"""
+参考 token 选择器的 CPU 对比(不需要模型和显卡)，在 ComfyUI 根目录运行:
+    python -m custom_nodes.ComfyUI_StoryDiffusion.utils.token_selector_benchmark
+合成若干张"同一角色、不同背景"的参考图特征，目标图的角色 token 对参考 token 做扩展注意力:
+  identity: 目标图角色 token 对参考 token 的注意力中落在参考图角色区域上的比例(越高角色越一致)
+  fidelity: 只用选出的 token 时，目标图角色区域的输出与使用全部参考 token 时输出的余弦相似度
+"""
+import argparse
+import math
+
+import torch
+
+from .benchmark_utils import timed
+from .token_selectors import TOKEN_SELECTORS
+
+
+def make_story(generator, img_nums, rows, cols, channel, noise=1.0):
+    """每张图: 随机位置的椭圆角色区域(共享的角色特征 + 噪声)，其余为各自的背景特征。"""
+    character = torch.randn(channel, generator=generator)
+    ys, xs = torch.meshgrid(torch.arange(rows), torch.arange(cols), indexing="ij")
+    images, masks = [], []
+    for _ in range(img_nums + 1):
+        center_y, center_x = torch.rand(2, generator=generator).tolist()
+        radius_y, radius_x = 0.15 + 0.15 * torch.rand(2, generator=generator)
+        mask = (((ys / rows - center_y) / radius_y) ** 2 + ((xs / cols - center_x) / radius_x) ** 2 <= 1).flatten()
+        background = torch.randn(channel, generator=generator)
+        features = torch.where(mask[:, None], character, background) + noise * torch.randn(
+            (rows * cols, channel), generator=generator
+        )
+        images.append(features)
+        masks.append(mask)
+    return torch.stack(images[:-1]), torch.stack(masks[:-1]), images[-1], masks[-1]
+
+
+def extended_attention(query, key, value):
+    attention = torch.softmax(query @ key.T / math.sqrt(query.shape[-1]), dim=-1)
+    return attention @ value, attention
+
+
+def run(selectors, ratios, img_nums=2, rows=32, cols=32, channel=64, trials=5, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    # query/key 共用投影，相似的 token 相互关注
+    projection = torch.randn((channel, channel), generator=generator) / channel
+    projections = [projection, projection, torch.randn((channel, channel), generator=generator) / math.sqrt(channel)]
+    nums = rows * cols
+    results = []
+    for name in selectors:
+        selector = TOKEN_SELECTORS[name]()
+        for ratio in ratios:
+            k = int(round(ratio * nums))
+            similarity, identity, elapsed = 0.0, 0.0, 0.0
+            for trial in range(trials):
+                references, reference_masks, target, target_mask = make_story(generator, img_nums, rows, cols, channel)
+                if selector.dynamic:
+                    indices, seconds = timed(selector.select, references, k, rows, cols)
+                else:
+                    indices, seconds = timed(selector.sample, generator, 1, img_nums, rows, cols, k)
+                    indices = indices[0]
+                elapsed += seconds
+                query = target[target_mask] @ projections[0]
+                own_key, own_value = target @ projections[1], target @ projections[2]
+                full = references.reshape(-1, channel)
+                sampled = torch.cat([references[image, indices[image]] for image in range(img_nums)])
+                sampled_masks = torch.cat([reference_masks[image, indices[image]] for image in range(img_nums)])
+                reference_out, _ = extended_attention(
+                    query, torch.cat([full @ projections[1], own_key]), torch.cat([full @ projections[2], own_value])
+                )
+                selected_out, attention = extended_attention(
+                    query, torch.cat([sampled @ projections[1], own_key]), torch.cat([sampled @ projections[2], own_value])
+                )
+                similarity += torch.nn.functional.cosine_similarity(reference_out, selected_out, dim=-1).mean().item()
+                reference_attention = attention[:, :sampled.shape[0]]
+                identity += (reference_attention[:, sampled_masks].sum() / reference_attention.sum()).item()
+            results.append({
+                "selector": name,
+                "tokens": k * img_nums,
+                "ratio": ratio,
+                "identity": identity / trials,
+                "fidelity": similarity / trials,
+                "select_ms": elapsed / trials * 1000,
+            })
+            print(f"{name:9s} tokens {k * img_nums:5d} ({ratio:.2f})  identity {identity / trials:.4f}  "
+                  f"fidelity {similarity / trials:.4f}  "
+                  f"select {elapsed / trials * 1000:.2f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="token count vs consistency of the reference-token selectors")
+    parser.add_argument("--selectors", nargs="+", default=list(TOKEN_SELECTORS))
+    parser.add_argument("--ratios", nargs="+", type=float, default=[0.05, 0.1, 0.25, 0.5])
+    parser.add_argument("--rows", type=int, default=32)
+    parser.add_argument("--cols", type=int, default=32)
+    parser.add_argument("--trials", type=int, default=5)
+    args = parser.parse_args()
+    run(args.selectors, args.ratios, rows=args.rows, cols=args.cols, trials=args.trials)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import math
+
+import torch
+
+# 一致性注意力写入阶段选择参考 token 的方式。
+# 静态选择器(uniform/grid)在 AttnIndiceSchedule 建立时一次生成全部步的索引；
+# 动态选择器(crossref/mask)在写入时根据当前 hidden states 选择。
+# 所有选择器对每张图都返回固定的 k 个升序索引，保证写入阶段的张量形状不变。
+
+
+class TokenSelector:
+    r"""
+    Common interface of the reference-token selectors.
+    Static selectors implement `sample` and are evaluated once per run; dynamic selectors implement
+    `select` and are evaluated in the write phase from the hidden states of the reference images.
+    """
+    name = "base"
+    dynamic = False
+
+    def sample(self, generator, num_steps, total_length, rows, cols, k):
+        """Return (num_steps, total_length, k) token indices."""
+        raise NotImplementedError
+
+    def select(self, hidden_states, k, rows, cols):
+        """hidden_states: (img_nums, rows * cols, channel), return (img_nums, k) token indices."""
+        raise NotImplementedError
+
+
+class UniformTokenSelector(TokenSelector):
+    """每张图均匀随机选 k 个 token(原始 StoryDiffusion 的做法)。"""
+    name = "uniform"
+
+    def sample(self, generator, num_steps, total_length, rows, cols, k):
+        rand = torch.rand((num_steps, total_length, rows * cols), generator=generator)
+        return rand.argsort(dim=-1)[..., :k].sort(dim=-1).values
+
+
+class GridTokenSelector(TokenSelector):
+    """按步长均匀铺开的网格，每步每张图随机平移网格，覆盖整张图且不会聚在一起。"""
+    name = "grid"
+
+    def sample(self, generator, num_steps, total_length, rows, cols, k):
+        nums = rows * cols
+        stride = max(int(math.sqrt(nums / max(k, 1))), 1)
+        offsets = torch.randint(0, stride, (num_steps, total_length, 2), generator=generator).tolist()
+        indices = torch.empty((num_steps, total_length, k), dtype=torch.long)
+        for step in range(num_steps):
+            for image in range(total_length):
+                offset_y, offset_x = offsets[step][image]
+                ys = torch.arange(offset_y, rows, stride)
+                xs = torch.arange(offset_x, cols, stride)
+                grid = (ys[:, None] * cols + xs[None, :]).flatten()
+                if grid.numel() < k:
+                    # 平移后点数不足时补上网格外的 token
+                    rest = torch.ones(nums, dtype=torch.bool)
+                    rest[grid] = False
+                    grid = torch.cat([grid, rest.nonzero().flatten()])
+                pick = torch.linspace(0, grid.numel() - 1, k).round().long()
+                indices[step, image] = grid[pick].sort().values
+        return indices
+
+
+class CrossRefTokenSelector(TokenSelector):
+    r"""
+    Top-k tokens by the strongest self-attention logit they receive from a strided subset of queries of
+    the other reference images. The reference images share the character but not the background,
+    so character tokens find a close match in every other image while background tokens do not.
+    With a single reference image the mean attention from its own queries is used.
+    This is a cross-image heuristic on the hidden states: it does not look at the attention to the
+    character tokens of the prompt (attn2), so it is not a character-token saliency map.
+    """
+    name = "crossref"
+    dynamic = True
+
+    def __init__(self, num_queries=256):
+        self.num_queries = num_queries
+
+    def scores(self, hidden_states):
+        img_nums, nums, channel = hidden_states.shape
+        stride = max(nums // self.num_queries, 1)
+        hidden_states = torch.nn.functional.normalize(hidden_states.float(), dim=-1)
+        query = hidden_states[:, ::stride]
+        # logits[i, j]: 图 i 的查询与图 j 的 token 的相似度
+        logits = torch.einsum("iqc,jkc->ijqk", query, hidden_states)
+        if img_nums == 1:
+            return torch.softmax(logits[0, 0] * math.sqrt(channel), dim=-1).mean(dim=0)
+        others = torch.eye(img_nums, dtype=torch.bool, device=hidden_states.device)
+        logits = logits.masked_fill(others[:, :, None, None], -1.0)
+        return logits.amax(dim=2).amax(dim=0)  # img_nums, nums
+
+    def select(self, hidden_states, k, rows, cols):
+        return self.scores(hidden_states).topk(k, dim=-1).indices.sort(dim=-1).values
+
+
+class MaskTokenSelector(TokenSelector):
+    r"""
+    Tokens inside a cheap subject mask: the tokens of each image are split into two clusters
+    (a few k-means iterations), the cluster that owns most of the image border is the background.
+    k tokens are spread evenly over the subject, topped up from the background for small subjects.
+    """
+    name = "mask"
+    dynamic = True
+
+    def __init__(self, iterations=5):
+        self.iterations = iterations
+
+    def subject_mask(self, hidden_states, rows, cols):
+        img_nums, nums, _ = hidden_states.shape
+        features = torch.nn.functional.normalize(hidden_states.float(), dim=-1)
+        border = torch.zeros((rows, cols), dtype=torch.bool, device=hidden_states.device)
+        border[0], border[-1], border[:, 0], border[:, -1] = True, True, True, True
+        border = border.flatten()
+        # 初始化: 背景中心为边缘 token 的均值，主体中心为中间 token 的均值
+        centers = torch.stack([features[:, border].mean(dim=1), features[:, ~border].mean(dim=1)], dim=1)
+        for _ in range(self.iterations):
+            assign = (features @ centers.transpose(1, 2)).argmax(dim=-1)  # img_nums, nums
+            for cluster in range(2):
+                weight = (assign == cluster).float().unsqueeze(-1)
+                centers[:, cluster] = (features * weight).sum(dim=1) / weight.sum(dim=1).clamp(min=1)
+        subject = assign == 1
+        # 占据边缘更多的一类是背景
+        flip = (subject[:, border].float().mean(dim=1) > 0.5)
+        return torch.where(flip[:, None], ~subject, subject)
+
+    def select(self, hidden_states, k, rows, cols):
+        subject = self.subject_mask(hidden_states, rows, cols)
+        indices = []
+        for mask in subject:
+            inside = mask.nonzero().flatten()
+            outside = (~mask).nonzero().flatten()
+            if inside.numel() >= k:
+                picked = inside[torch.linspace(0, inside.numel() - 1, k, device=inside.device).round().long()]
+            else:
+                rest = k - inside.numel()
+                picked = torch.cat(
+                    [inside, outside[torch.linspace(0, outside.numel() - 1, rest, device=inside.device).round().long()]]
+                )
+            indices.append(picked.sort().values)
+        return torch.stack(indices)
+
+
+TOKEN_SELECTORS = {
+    "uniform": UniformTokenSelector,
+    "grid": GridTokenSelector,
+    "crossref": CrossRefTokenSelector,
+    "mask": MaskTokenSelector,
+}
+
+
+def get_token_selector(name):
+    if isinstance(name, TokenSelector):
+        return name
+    if name not in TOKEN_SELECTORS:
+        raise ValueError(f"unknown token selector {name}, choose from {list(TOKEN_SELECTORS)}")
+    return TOKEN_SELECTORS[name]()